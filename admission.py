@@ -0,0 +1,71 @@
+# -*- coding: utf-8 -*-
+"""Контроль допуска апдейтов: ограничение частоты и сброс нагрузки.
+
+TokenBuckets — по «ведру» токенов на ключ (чат): ведро вмещает burst
+токенов и пополняется со скоростью rate в секунду, каждый запрос забирает
+cost токенов. Пустое ведро — запрос отклоняется сразу, ничего не ожидая.
+ConcurrencyLimiter — общий предел одновременно выполняемых обработчиков:
+если все места заняты, запрос отклоняется, а не встаёт в очередь.
+"""
+import collections
+import threading
+import time
+
+
+class TokenBuckets:
+    """Ведро токенов на ключ; хранится не больше max_keys вёдер.
+
+    Вытесняется ведро, к которому дольше всего не обращались: такое
+    ведро, скорее всего, уже полное, и его потеря ничего не меняет.
+    """
+
+    def __init__(self, rate, burst, max_keys=10000, clock=time.monotonic):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._clock = clock
+        self._buckets = collections.OrderedDict()  # key -> [токены, время обновления]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def allow(self, key, cost=1):
+        """Забрать cost токенов из ведра key; False — если их не хватает"""
+        now = self._clock()
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [float(self.burst), now]
+                while len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+                bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+                bucket[1] = now
+            if bucket[0] < cost:
+                return False
+            bucket[0] -= cost
+            return True
+
+
+class ConcurrencyLimiter:
+    """Не больше limit одновременных задач; limit <= 0 — без ограничения"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_flight = 0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        """Занять место без ожидания; False — если мест нет"""
+        with self._lock:
+            if 0 < self.limit <= self.in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self):
+        with self._lock:
+            if self.in_flight > 0:
+                self.in_flight -= 1
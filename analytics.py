@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Аналитика по броням на дневных агрегатах.
+
+Агрегаты (rollups) пересчитываются по датам, на которые пришлись
+изменения броней, и хранятся в таблицах booking_daily_stats /
+booking_hourly_stats (PostgreSQL) или в machata_stats.json. Сводка для
+админ-панели собирается только из агрегатов, без чтения самих броней.
+"""
+from datetime import datetime, timedelta
+
+# Брони с оплатой «в процессе», дата которых прошла, считаются брошенными
+UNPAID_STATUSES = ('pending', 'awaiting_payment')
+
+WEEKDAYS = ('Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс')
+
+_HEAT = " ▁▂▃▄▅▆▇█"
+
+
+def rollup(bookings):
+    """Агрегаты по списку броней.
+
+    daily: {(date, service, status): {'bookings', 'hours', 'revenue'}}
+    hourly: {(date, hour): оплаченные часы}
+    """
+    daily = {}
+    hourly = {}
+    for b in bookings:
+        date = b.get('date', '')
+        times = b.get('times') or []
+        key = (date, b.get('service', ''), b.get('status', ''))
+        row = daily.setdefault(key, {'bookings': 0, 'hours': 0, 'revenue': 0})
+        row['bookings'] += 1
+        row['hours'] += len(times)
+        row['revenue'] += b.get('price') or 0
+        if b.get('status') == 'paid':
+            for hour in times:
+                hourly[(date, hour)] = hourly.get((date, hour), 0) + 1
+    return daily, hourly
+
+
+def working_hours(date_from, date_to, config):
+    """Число рабочих часов студии в периоде (без выходных из конфига)"""
+    start = datetime.strptime(date_from, "%Y-%m-%d")
+    end = datetime.strptime(date_to, "%Y-%m-%d")
+    per_day = config['work_hours']['end'] - config['work_hours']['start']
+    off_days = set(config.get('off_days', []))
+    days = sum(
+        1 for i in range((end - start).days + 1)
+        if (start + timedelta(days=i)).weekday() not in off_days
+    )
+    return days * per_day
+
+
+def summarize(daily_rows, hourly_rows, date_from, date_to, config, today):
+    """Сводка за период из агрегатов.
+
+    daily_rows: [{'date', 'service', 'status', 'bookings', 'hours', 'revenue'}]
+    hourly_rows: [{'date', 'hour', 'hours'}]
+    """
+    summary = {
+        'date_from': date_from,
+        'date_to': date_to,
+        'total': 0,
+        'paid': 0,
+        'paid_hours': 0,
+        'revenue': 0,
+        'cancelled': 0,
+        'abandoned': 0,
+        'services': {},
+        'heatmap': {},
+    }
+    for row in daily_rows:
+        summary['total'] += row['bookings']
+        status = row['status']
+        if status == 'paid':
+            summary['paid'] += row['bookings']
+            summary['paid_hours'] += row['hours']
+            summary['revenue'] += row['revenue']
+            service = summary['services'].setdefault(row['service'], {'bookings': 0, 'hours': 0, 'revenue': 0})
+            service['bookings'] += row['bookings']
+            service['hours'] += row['hours']
+            service['revenue'] += row['revenue']
+        elif status == 'cancelled':
+            summary['cancelled'] += row['bookings']
+        elif status in UNPAID_STATUSES and row['date'] < today:
+            summary['abandoned'] += row['bookings']
+
+    for row in hourly_rows:
+        weekday = datetime.strptime(row['date'], "%Y-%m-%d").weekday()
+        key = (weekday, int(row['hour']))
+        summary['heatmap'][key] = summary['heatmap'].get(key, 0) + row['hours']
+
+    available = working_hours(date_from, date_to, config)
+    summary['available_hours'] = available
+    summary['utilization'] = summary['paid_hours'] / available if available else 0.0
+    for service in summary['services'].values():
+        service['utilization'] = service['hours'] / available if available else 0.0
+    total = summary['total']
+    summary['cancel_rate'] = summary['cancelled'] / total if total else 0.0
+    summary['abandon_rate'] = summary['abandoned'] / total if total else 0.0
+    return summary
+
+
+def heatmap_lines(heatmap, start_hour, end_hour):
+    """Строки тепловой карты «день недели × час» из символов ▁…█"""
+    peak = max(heatmap.values(), default=0)
+    lines = ["   " + "".join(str(h % 10) for h in range(start_hour, end_hour))]
+    for weekday, name in enumerate(WEEKDAYS):
+        cells = []
+        for hour in range(start_hour, end_hour):
+            value = heatmap.get((weekday, hour), 0)
+            level = 0 if not peak else round(value / peak * (len(_HEAT) - 1))
+            cells.append(_HEAT[level] if value else "·")
+        lines.append(f"{name} " + "".join(cells))
+    return lines
@@ -0,0 +1,270 @@
+# -*- coding: utf-8 -*-
+"""Режим BOT_RUNTIME=asyncio: webhook-сервер на aiohttp и общий пул HTTP-соединений.
+
+Апдейты принимает aiohttp-сервер и сразу отвечает Telegram; апдейты
+одного чата обрабатываются строго по очереди. Сами обработчики бота
+синхронные (та же семантика, что в режиме threaded: psycopg2, файлы) и
+выполняются в пуле из ASYNC_HANDLER_WORKERS потоков. Запросы к Bot API и
+ЮKassa из обработчиков и фоновых потоков идут через общую aiohttp-сессию
+цикла (keep-alive и общий лимит соединений), но поток обработчика ждёт
+ответа — поэтому одновременно обрабатывается не больше ASYNC_HANDLER_WORKERS
+апдейтов, остальные ждут своей очереди на цикле.
+
+Ожидание ответа ограничено таймаутом запроса (без него — ASYNC_REQUEST_TIMEOUT).
+При остановке цикл и сессия живут, пока не доработают начатые обработчики и
+вторые фазы оплаты (не дольше ASYNC_DRAIN_TIMEOUT); оставшиеся запросы
+отменяются, и ждущие их потоки получают ошибку, а не висят.
+
+aiohttp импортируется только в этом режиме.
+"""
+import asyncio
+import concurrent.futures
+import json
+import os
+import threading
+
+import metrics
+
+HANDLER_WORKERS = int(os.environ.get("ASYNC_HANDLER_WORKERS", "32"))
+HTTP_CONNECTIONS = int(os.environ.get("ASYNC_HTTP_CONNECTIONS", "100"))
+REQUEST_TIMEOUT = float(os.environ.get("ASYNC_REQUEST_TIMEOUT", "60"))
+DRAIN_TIMEOUT = float(os.environ.get("ASYNC_DRAIN_TIMEOUT", "20"))
+
+aiohttp = None
+web = None
+
+_runtime = None
+
+
+def _load_aiohttp():
+    """Ленивый импорт aiohttp; None, если он не установлен"""
+    global aiohttp, web
+    if aiohttp is None:
+        try:
+            import aiohttp as _aiohttp
+            from aiohttp import web as _web
+        except ImportError:
+            return None
+        aiohttp, web = _aiohttp, _web
+    return aiohttp
+
+
+def available():
+    return _load_aiohttp() is not None
+
+
+INFLIGHT = metrics.gauge(
+    "machata_async_inflight_updates",
+    "Апдейты, принятые, но ещё не обработанные (режим asyncio): в пуле потоков и в очереди к нему",
+    lambda: _runtime.inflight if _runtime else None,
+)
+
+
+class _Response:
+    """Ответ с интерфейсом requests.Response, который ждут telebot и код ЮKassa"""
+
+    def __init__(self, status, reason, body):
+        self.status_code = status
+        self.reason = reason
+        self.content = body
+        self.text = body.decode("utf-8", errors="replace")
+
+    def json(self):
+        return json.loads(self.text)
+
+
+def _query(params):
+    """Параметры запроса как их кодирует requests: None пропускается, остальное — str"""
+    return {k: v if isinstance(v, str) else str(v) for k, v in (params or {}).items() if v is not None}
+
+
+def _wait_timeout(timeout):
+    """Сколько поток ждёт ответа: connect + read запроса с запасом"""
+    parts = timeout if isinstance(timeout, tuple) else (timeout,)
+    if any(part is None for part in parts):
+        return REQUEST_TIMEOUT
+    return sum(parts) + 1
+
+
+def _chat_id(data):
+    """Чат апдейта — ключ очереди, в которой апдейты идут по порядку"""
+    for key in ("message", "edited_message", "callback_query"):
+        obj = data.get(key)
+        if not obj:
+            continue
+        chat = (obj.get("message") or {}).get("chat") if key == "callback_query" else obj.get("chat")
+        if chat:
+            return chat.get("id")
+        return (obj.get("from") or {}).get("id")
+    return None
+
+
+class AsyncRuntime:
+    """aiohttp-приложение бота; bot_module — загруженный machata_bot"""
+
+    def __init__(self, bot_module, workers=HANDLER_WORKERS, connections=HTTP_CONNECTIONS, wait_handlers=False):
+        self.mb = bot_module
+        self.workers = workers
+        self.connections = connections
+        # Отвечать на webhook после обработки апдейта (для бенчмарка); иначе — сразу
+        self.wait_handlers = wait_handlers
+        self.loop = None
+        self.session = None
+        self.executor = None
+        self.inflight = 0
+        self._loop_thread = None
+        self._chats = {}  # chat_id -> [asyncio.Lock, число апдейтов в очереди]
+        self._tasks = set()
+        self._requests = set()  # concurrent.futures.Future запросов, которые ждут потоки
+        self._closing = False
+        self._saved = None
+
+    # ---------- исходящие запросы ----------
+
+    def request(self, method, url, params=None, files=None, timeout=None, json=None, headers=None, **_):
+        """Блокирующий HTTP-запрос из потока обработчика через сессию цикла.
+
+        Сигнатура совместима с apihelper.CUSTOM_REQUEST_SENDER и requests.request.
+        """
+        if threading.get_ident() == self._loop_thread:
+            raise RuntimeError("блокирующий HTTP-запрос из потока event loop")
+        if self._closing:
+            raise RuntimeError("HTTP-сессия рантайма закрывается")
+        future = asyncio.run_coroutine_threadsafe(
+            self._request(method, url, params, files, timeout, json, headers), self.loop
+        )
+        self._requests.add(future)
+        future.add_done_callback(self._requests.discard)
+        try:
+            return future.result(timeout=_wait_timeout(timeout))
+        except concurrent.futures.TimeoutError:
+            # Отмена future отменяет и корутину на цикле — соединение освобождается
+            future.cancel()
+            raise
+
+    async def _request(self, method, url, params, files, timeout, json_body, headers):
+        connect, read = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        data = None
+        if files:
+            data = aiohttp.FormData()
+            for name, value in files.items():
+                filename, fileobj = (value[0], value[1]) if isinstance(value, tuple) else (name, value)
+                data.add_field(name, fileobj, filename=filename)
+        async with self.session.request(
+            method.upper(), url,
+            params=_query(params), data=data, json=json_body, headers=headers,
+            timeout=aiohttp.ClientTimeout(sock_connect=connect, sock_read=read),
+        ) as resp:
+            return _Response(resp.status, resp.reason, await resp.read())
+
+    # ---------- входящие апдейты ----------
+
+    async def dispatch(self, data):
+        """Обработка одного апдейта; апдейты одного чата — по очереди"""
+        self.inflight += 1
+        chat_id = _chat_id(data)
+        try:
+            update = self.mb.telebot.types.Update.de_json(data)
+            if chat_id is None:
+                await self._process(update)
+                return
+            entry = self._chats.setdefault(chat_id, [asyncio.Lock(), 0])
+            entry[1] += 1
+            try:
+                async with entry[0]:
+                    await self._process(update)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    self._chats.pop(chat_id, None)
+        except Exception as e:
+            self.mb.log_error(f"async dispatch: {str(e)}", e)
+        finally:
+            self.inflight -= 1
+
+    async def _process(self, update):
+        # Поток пула занят до конца обработчика, включая ожидание HTTP-ответов
+        await self.loop.run_in_executor(self.executor, self.mb.process_updates, [update])
+
+    async def _webhook(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            return web.Response(text="error", status=400)
+        if data:
+            if self.wait_handlers:
+                await self.dispatch(data)
+            else:
+                task = asyncio.create_task(self.dispatch(data))
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+        return web.Response(text="ok")
+
+    async def _payment(self, request):
+        try:
+            data = await request.json()
+        except ValueError:
+            data = None
+        body, status = await self.loop.run_in_executor(self.executor, self.mb.handle_payment_notification, data)
+        return web.Response(text=body, status=status)
+
+    async def _health(self, request):
+        return web.Response(text="🎵 MACHATA bot работает!")
+
+    async def _metrics(self, request):
+        return web.Response(body=metrics.render().encode("utf-8"), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+    # ---------- жизненный цикл ----------
+
+    async def _on_startup(self, app):
+        self.loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self.executor = concurrent.futures.ThreadPoolExecutor(self.workers, thread_name_prefix="async-handler")
+        self.session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=self.connections))
+        apihelper = self.mb.apihelper
+        self._saved = (self.mb.bot.threaded, apihelper.CUSTOM_REQUEST_SENDER, self.mb.yookassa_http)
+        # Обработчик выполняется прямо в потоке пула, без второй очереди telebot
+        self.mb.bot.threaded = False
+        apihelper.CUSTOM_REQUEST_SENDER = self.request
+        self.mb.yookassa_http = self.request
+
+    async def _on_cleanup(self, app):
+        # Новые апдейты уже не принимаются. Начатые обработчики и вторые фазы
+        # оплаты ходят в сеть через эту сессию — ждём их, не блокируя цикл
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        if not await asyncio.to_thread(self.mb.drain_payments, DRAIN_TIMEOUT):
+            self.mb.log_error(f"Вторые фазы оплаты не завершились за {DRAIN_TIMEOUT:g} с — ссылки создадутся после рестарта")
+        self._closing = True
+        for future in list(self._requests):
+            future.cancel()
+        # Платежи, которые ещё не начались, пойдут уже через requests
+        if self._saved:
+            self.mb.bot.threaded, self.mb.apihelper.CUSTOM_REQUEST_SENDER, self.mb.yookassa_http = self._saved
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        await self.session.close()
+
+    def make_app(self):
+        app = web.Application()
+        app.router.add_get("/", self._health)
+        app.router.add_get("/metrics", self._metrics)
+        app.router.add_post(f"/{self.mb.API_TOKEN}/", self._webhook)
+        app.router.add_post("/payment", self._payment)
+        app.on_startup.append(self._on_startup)
+        app.on_cleanup.append(self._on_cleanup)
+        return app
+
+
+def create_runtime(bot_module, **kwargs):
+    """Создание рантайма; aiohttp должен быть установлен"""
+    global _runtime
+    if _load_aiohttp() is None:
+        raise RuntimeError("Для BOT_RUNTIME=asyncio нужен aiohttp: pip install aiohttp")
+    _runtime = AsyncRuntime(bot_module, **kwargs)
+    return _runtime
+
+
+def run(bot_module, host, port):
+    """Запуск webhook-сервера бота на aiohttp (блокирует до остановки)"""
+    runtime = create_runtime(bot_module)
+    web.run_app(runtime.make_app(), host=host, port=port, print=None)
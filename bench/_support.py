@@ -0,0 +1,181 @@
+# -*- coding: utf-8 -*-
+"""Общие помощники для нагрузочных тестов и бенчмарков.
+
+Фейковые Telegram Bot API и ЮKassa на локальных портах и запуск
+machata_bot в изолированной рабочей папке с нужными переменными окружения.
+"""
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOADTEST_TOKEN = "123456:LOADTEST"
+
+
+def percentile(sorted_values, pct):
+    """Перцентиль по уже отсортированному списку (nearest-rank)"""
+    if not sorted_values:
+        return 0.0
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+class _FakeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, payload, status=200):
+        body = json.dumps(payload).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return self.rfile.read(length) if length else b""
+
+    def do_GET(self):
+        self._read_body()
+        self._delay()
+        self._reply(*self.server.route("GET", self.path))
+
+    def do_POST(self):
+        self._read_body()
+        self._delay()
+        self._reply(*self.server.route("POST", self.path))
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+
+class _FakeServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        super().__init__(("127.0.0.1", 0), _FakeHandler)
+        self.latency = latency
+        self.requests = 0
+        self._ids = itertools.count(1)
+        self._thread = None
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def route(self, method, path):
+        self.requests += 1
+        return self.handle_route(method, path)
+
+
+class FakeTelegramServer(_FakeServer):
+    """Минимальный Bot API: отвечает успехом на любые методы бота"""
+
+    def handle_route(self, method, path):
+        api_method = path.rstrip("/").rsplit("/", 1)[-1].split("?", 1)[0]
+        if api_method in ("answerCallbackQuery", "setWebhook", "deleteWebhook"):
+            return {"ok": True, "result": True}, 200
+        if api_method == "getWebhookInfo":
+            return {"ok": True, "result": {"url": "", "has_custom_certificate": False, "pending_update_count": 0}}, 200
+        if api_method == "getUpdates":
+            return {"ok": True, "result": []}, 200
+        message = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": 1, "type": "private"},
+            "text": "ok",
+        }
+        return {"ok": True, "result": message}, 200
+
+
+class FakeYooKassaServer(_FakeServer):
+    """Создание платежа и проверка статуса в формате API ЮKassa v3"""
+
+    def handle_route(self, method, path):
+        if method == "POST" and path.rstrip("/").endswith("/payments"):
+            payment_id = f"fake-{next(self._ids)}"
+            return {
+                "id": payment_id,
+                "status": "pending",
+                "confirmation": {"type": "redirect", "confirmation_url": f"{self.base_url}/pay/{payment_id}"},
+            }, 200
+        if method == "GET" and "/payments/" in path:
+            return {"id": path.rsplit("/", 1)[-1], "status": "pending"}, 200
+        return {"type": "error", "code": "not_found"}, 404
+
+
+def import_bot(workdir, telegram_url, env=None):
+    """Импорт machata_bot в рабочей папке workdir с фейковым Bot API"""
+    os.environ.setdefault("API_TOKEN", LOADTEST_TOKEN)
+    os.environ.setdefault("YOOKASSA_SHOP_ID", "100500")
+    os.environ.setdefault("YOOKASSA_SECRET_KEY", "test_loadtest")
+    for key, value in (env or {}).items():
+        os.environ[key] = value
+    os.chdir(workdir)
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    from telebot import apihelper
+    apihelper.API_URL = telegram_url.rstrip("/") + "/bot{0}/{1}"
+
+    import machata_bot
+    return machata_bot
+
+
+SERVICES = ("repet", "studio", "full")
+STATUSES = ("paid", "paid", "paid", "awaiting_payment", "cancelled")
+
+
+def generate_bookings(count, seed=1, users=None, days_back=365, days_ahead=30):
+    """Синтетическая история броней в формате machata_bookings.json"""
+    rng = random.Random(seed)
+    users = users or max(10, count // 5)
+    today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+    bookings = []
+    for i in range(count):
+        day = today + timedelta(days=rng.randint(-days_back, days_ahead))
+        start = rng.randint(9, 19)
+        hours = list(range(start, min(22, start + rng.randint(1, 4))))
+        price = 700 * len(hours)
+        status = rng.choice(STATUSES)
+        created = day - timedelta(days=rng.randint(0, 14), minutes=rng.randint(0, 1440))
+        booking = {
+            "id": 100_000_000 + i,
+            "user_id": 1_000 + rng.randrange(users),
+            "service": rng.choice(SERVICES),
+            "date": day.strftime("%Y-%m-%d"),
+            "times": hours,
+            "duration": len(hours),
+            "name": f"Клиент {i}",
+            "email": f"client{i}@example.com",
+            "phone": f"+7 999 {i % 10_000_000:07d}",
+            "comment": "-",
+            "price": price,
+            "status": status,
+            "created_at": created.isoformat(),
+        }
+        if status == "paid":
+            booking["paid_at"] = (created + timedelta(minutes=5)).isoformat()
+            booking["yookassa_payment_id"] = f"pay-{i}"
+        bookings.append(booking)
+    return bookings
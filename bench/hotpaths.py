@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+"""Микробенчмарки горячих функций бота на синтетической истории броней.
+
+Каждая функция прогоняется на историях из 1k/10k/100k броней (файловый
+бэкенд). Результаты можно сохранить как baseline и сравнивать с ним
+следующие прогоны: при замедлении медианы больше порога команда
+завершается с кодом 1.
+
+Примеры:
+    python bench/hotpaths.py --save main
+    python bench/hotpaths.py --compare main --threshold 25
+    python bench/hotpaths.py --sizes 1000,10000 --filter keyboard
+"""
+import argparse
+import collections
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _support import FakeTelegramServer, generate_bookings, import_bot
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".benchmarks")
+DEFAULT_SIZES = (1_000, 10_000, 100_000)
+
+
+def measure(func, min_time=0.2, min_rounds=3, max_rounds=1000):
+    """Время одного вызова: прогоняем до min_time секунд, но не меньше min_rounds раз"""
+    func()  # прогрев (кэш конфига, импорт и т.п.)
+    timings = []
+    deadline = time.perf_counter() + min_time
+    while len(timings) < max_rounds and (len(timings) < min_rounds or time.perf_counter() < deadline):
+        started = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started)
+    return {
+        "rounds": len(timings),
+        "min": min(timings),
+        "median": statistics.median(timings),
+        "mean": statistics.fmean(timings),
+    }
+
+
+def build_cases(mb, bookings):
+    """Набор (имя, функция) для одной истории"""
+    future = [b for b in bookings if b['status'] != 'cancelled' and b['date'] >= time.strftime("%Y-%m-%d")]
+    sample = future[0] if future else bookings[0]
+    date_str, service = sample['date'], sample['service']
+    # Клиент с самой длинной историей — худший случай для «Моих бронирований»
+    chat_id = collections.Counter(b['user_id'] for b in bookings).most_common(1)[0][0]
+    mb.user_states[chat_id] = {'step': 'time', 'service': service, 'date': date_str, 'selected_times': [10, 11, 12]}
+    config = mb.load_config()
+    models = mb.load_booking_models()
+    sample_model = mb.booking_model.Booking.from_dict(sample)
+
+    return [
+        ("get_booked_slots", lambda: mb.get_booked_slots(date_str, service)),
+        ("times_keyboard", lambda: mb.times_keyboard(chat_id, date_str, service)),
+        ("dates_keyboard", lambda: mb.dates_keyboard(0)),
+        ("bookings_keyboard", lambda: mb.bookings_keyboard(models, chat_id)),
+        ("load_booking_models", mb.load_booking_models),
+        ("format_admin_booking", lambda: mb.format_admin_booking(sample_model)),
+        ("get_booking", lambda: mb.get_booking(sample['id'])),
+        ("get_available_dates", lambda: mb.get_available_dates(30)),
+        ("calculate_price", lambda: mb.calculate_price(chat_id, service, 3, config)),
+    ]
+
+
+def run(sizes, name_filter, min_time):
+    telegram = FakeTelegramServer().start()
+    workdir = tempfile.mkdtemp(prefix="machata-bench-")
+    mb = import_bot(workdir, telegram.base_url, {"DATABASE_URL": ""})
+    results = {}
+    try:
+        for size in sizes:
+            bookings = generate_bookings(size)
+            with open(mb.BOOKINGS_FILE, 'w', encoding='utf-8') as f:
+                json.dump(bookings, f, ensure_ascii=False)
+            for name, func in build_cases(mb, bookings):
+                if name_filter and name_filter not in name:
+                    continue
+                key = f"{name}[{size}]"
+                results[key] = measure(func, min_time=min_time)
+                print(f"{key:<34}{results[key]['median'] * 1e6:>14.1f} µs  ({results[key]['rounds']} раундов)")
+    finally:
+        telegram.stop()
+    return results
+
+
+def compare(results, baseline, threshold):
+    """Сравнение медиан с baseline; возвращает список регрессий"""
+    regressions = []
+    print(f"\n{'бенчмарк':<34}{'baseline µs':>14}{'сейчас µs':>14}{'Δ %':>9}")
+    for key, current in results.items():
+        base = baseline.get(key)
+        if not base:
+            print(f"{key:<34}{'—':>14}{current['median'] * 1e6:>14.1f}{'new':>9}")
+            continue
+        delta = (current['median'] - base['median']) / base['median'] * 100
+        mark = " ❌" if delta > threshold else ""
+        print(f"{key:<34}{base['median'] * 1e6:>14.1f}{current['median'] * 1e6:>14.1f}{delta:>+9.1f}{mark}")
+        if delta > threshold:
+            regressions.append((key, delta))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default=",".join(str(s) for s in DEFAULT_SIZES),
+                        help="размеры истории через запятую")
+    parser.add_argument("--filter", default="", help="запускать только бенчмарки, содержащие подстроку")
+    parser.add_argument("--min-time", type=float, default=0.2, help="минимальное время на бенчмарк, с")
+    parser.add_argument("--save", metavar="NAME", help="сохранить результат как baseline NAME")
+    parser.add_argument("--compare", metavar="NAME", help="сравнить с baseline NAME")
+    parser.add_argument("--threshold", type=float, default=20.0,
+                        help="допустимое замедление медианы в процентах")
+    args = parser.parse_args()
+
+    os.environ.setdefault("LOG_LEVEL", "ERROR")
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    results = run(sizes, args.filter, args.min_time)
+
+    if args.save:
+        os.makedirs(BASELINE_DIR, exist_ok=True)
+        path = os.path.join(BASELINE_DIR, f"{args.save}.json")
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump({"created": time.strftime("%Y-%m-%dT%H:%M:%S"), "results": results}, f, indent=2)
+        print(f"\nBaseline сохранён: {path}")
+
+    if args.compare:
+        path = os.path.join(BASELINE_DIR, f"{args.compare}.json")
+        with open(path, 'r', encoding='utf-8') as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            print(f"\n❌ Регрессии (> {args.threshold}%): " + ", ".join(f"{k} {d:+.1f}%" for k, d in regressions))
+            sys.exit(1)
+        print("\n✅ Регрессий нет")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""Нагрузочный тест: синтетические апдейты Telegram через Flask webhook().
+
+Каждый виртуальный пользователь проходит полную воронку бронирования:
+меню → service_ → date_ → timeAdd_ → confirm_times → имя → email →
+телефон → комментарий → complete_booking. Telegram Bot API и ЮKassa
+заменены локальными фейковыми серверами.
+
+Примеры:
+    python bench/loadtest.py --users 2000 --workers 64
+    DATABASE_SSLMODE=disable python bench/loadtest.py --backend all --database-url postgresql://localhost/machata_bench
+    python bench/loadtest.py --backend postgres --database-url ... --json
+
+Бэкенды: json (файлы во временной папке) и postgres (DATABASE_URL).
+"""
+import argparse
+import collections
+import itertools
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _support import FakeTelegramServer, FakeYooKassaServer, import_bot, percentile
+
+BACKENDS = ("json", "postgres")
+
+
+class VirtualUser:
+    """Скрипт апдейтов одного пользователя; шаги идут строго по очереди"""
+    __slots__ = ("chat_id", "steps", "position")
+
+    def __init__(self, chat_id, steps):
+        self.chat_id = chat_id
+        self.steps = steps
+        self.position = 0
+
+
+def build_funnel(bot_module, chat_id, rng):
+    """Шаги воронки бронирования для одного пользователя"""
+    service = rng.choice(("repet", "studio", "full"))
+    menu = "🎸 Репетиция" if service == "repet" else "🎙 Запись трека"
+    dates = bot_module.get_available_dates(30)
+    date = rng.choice(dates).strftime("%Y-%m-%d")
+    config = bot_module.load_config()
+    start_hour, end_hour = config['work_hours']['start'], config['work_hours']['end']
+    first = rng.randrange(start_hour, end_hour - 2)
+    hours = range(first, first + rng.randint(1, 3))
+
+    steps = [("text", menu), ("callback", f"service_{service}"), ("callback", f"date_{date}")]
+    steps += [("callback", f"timeAdd_{h}") for h in hours]
+    steps += [
+        ("callback", "confirm_times"),
+        ("text", f"Band {chat_id}"),
+        ("text", f"user{chat_id}@example.com"),
+        ("text", f"+7 999 {chat_id % 10000000:07d}"),
+        ("text", "⏭️ Пропустить" if rng.random() < 0.5 else "Рок, 2 гитары"),
+    ]
+    return steps
+
+
+def make_update(update_id, chat_id, kind, payload):
+    user = {"id": chat_id, "is_bot": False, "first_name": f"VU{chat_id}"}
+    message = {
+        "message_id": update_id,
+        "date": int(time.time()),
+        "chat": {"id": chat_id, "type": "private"},
+        "from": user,
+    }
+    if kind == "text":
+        message["text"] = payload
+        return {"update_id": update_id, "message": message}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(chat_id),
+            "data": payload,
+            "message": message,
+        },
+    }
+
+
+def run_backend(args):
+    """Прогон одного бэкенда в текущем процессе"""
+    telegram = FakeTelegramServer(latency=args.telegram_latency / 1000).start()
+    yookassa = FakeYooKassaServer(latency=args.yookassa_latency / 1000).start()
+    workdir = tempfile.mkdtemp(prefix=f"machata-load-{args.backend}-")
+    env = {"YOOKASSA_API_URL": yookassa.base_url, "DATABASE_URL": ""}
+    if args.backend == "postgres":
+        if not args.database_url:
+            raise SystemExit("Для бэкенда postgres нужен --database-url или DATABASE_URL")
+        env["DATABASE_URL"] = args.database_url
+    bot_module = import_bot(workdir, telegram.base_url, env)
+    if args.backend == "postgres":
+        try:
+            bot_module.database.init_database()
+        except bot_module.database.DatabaseInitError as e:
+            raise SystemExit(f"PostgreSQL не готов: {e}")
+        if not bot_module.database.is_enabled():
+            raise SystemExit("PostgreSQL недоступен — проверь DATABASE_URL")
+
+    # Обработчики выполняются прямо в потоке запроса, чтобы задержка
+    # включала всю обработку апдейта, а не только постановку в очередь
+    bot_module.bot.threaded = not args.inline
+    app = bot_module.app
+    webhook_path = f"/{bot_module.API_TOKEN}/"
+
+    rng = random.Random(args.seed)
+    first_chat = 10_000_000
+    users = collections.deque(
+        VirtualUser(chat_id, build_funnel(bot_module, chat_id, rng))
+        for chat_id in range(first_chat, first_chat + args.users)
+    )
+    total_updates = sum(len(u.steps) for u in users)
+    update_ids = itertools.count(1)
+    users_lock = threading.Lock()
+    latencies = []
+    errors = collections.Counter()
+
+    def worker():
+        client = app.test_client()
+        local_latencies = []
+        while True:
+            with users_lock:
+                if not users:
+                    break
+                user = users.popleft()
+            kind, payload = user.steps[user.position]
+            body = make_update(next(update_ids), user.chat_id, kind, payload)
+            started = time.perf_counter()
+            try:
+                response = client.post(webhook_path, json=body)
+                status = response.status_code
+            except Exception as e:
+                status = type(e).__name__
+            local_latencies.append(time.perf_counter() - started)
+            if status != 200:
+                errors[str(status)] += 1
+            user.position += 1
+            if user.position < len(user.steps):
+                with users_lock:
+                    users.append(user)
+        with users_lock:
+            latencies.extend(local_latencies)
+
+    run_started_iso = datetime.now().isoformat()
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker, name=f"vu-worker-{i}") for i in range(args.workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    if not args.inline:
+        # Ждём, пока пул telebot разберёт очередь
+        pool = bot_module.bot.worker_pool
+        while pool and not pool.tasks.empty():
+            time.sleep(0.01)
+    elapsed = time.perf_counter() - started
+
+    bookings = bot_module.load_bookings()
+    # В PostgreSQL могут остаться брони прошлых прогонов — считаем только свои
+    funnel_bookings = [
+        b for b in bookings
+        if b.get('user_id', 0) >= first_chat and str(b.get('created_at', '')) >= run_started_iso
+    ]
+    latencies.sort()
+    result = {
+        "backend": args.backend,
+        "users": args.users,
+        "workers": args.workers,
+        "updates": total_updates,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total_updates / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "max_ms": round(latencies[-1] * 1000, 2) if latencies else 0.0,
+        "errors": dict(errors),
+        "bookings_created": len(funnel_bookings),
+        "telegram_requests": telegram.requests,
+        "yookassa_requests": yookassa.requests,
+    }
+    telegram.stop()
+    yookassa.stop()
+    return result
+
+
+def print_report(results):
+    header = f"{'backend':<10}{'updates':>9}{'upd/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'bookings':>10}{'errors':>8}"
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print(f"{r['backend']:<10} ошибка: {r['error']}")
+            continue
+        print(
+            f"{r['backend']:<10}{r['updates']:>9}{r['updates_per_s']:>10}{r['p50_ms']:>10}"
+            f"{r['p95_ms']:>10}{r['p99_ms']:>10}{r['bookings_created']:>10}{sum(r['errors'].values()):>8}"
+        )
+        if r["bookings_created"] != r["users"]:
+            print(f"{'':<10}⚠️ ожидалось броней: {r['users']}, создано: {r['bookings_created']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=BACKENDS + ("all",), default="json")
+    parser.add_argument("--users", type=int, default=1000, help="число виртуальных пользователей")
+    parser.add_argument("--workers", type=int, default=32, help="число параллельных клиентов webhook")
+    parser.add_argument("--database-url", default=os.environ.get("DATABASE_URL", ""))
+    parser.add_argument("--telegram-latency", type=float, default=0.0, help="задержка фейкового Bot API, мс")
+    parser.add_argument("--yookassa-latency", type=float, default=0.0, help="задержка фейковой ЮKassa, мс")
+    parser.add_argument("--pool", dest="inline", action="store_false",
+                        help="обрабатывать апдейты пулом потоков telebot (по умолчанию — в потоке запроса)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    if args.backend != "all":
+        os.environ.setdefault("LOG_LEVEL", "ERROR")
+        result = run_backend(args)
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False))
+        else:
+            print_report([result])
+        return
+
+    # Каждый бэкенд — в отдельном процессе: состояние модуля бота глобальное
+    results = []
+    for backend in BACKENDS:
+        if backend == "postgres" and not args.database_url:
+            results.append({"backend": backend, "error": "пропущен: не задан --database-url"})
+            continue
+        cmd = [sys.executable, os.path.abspath(__file__), "--backend", backend, "--json",
+               "--users", str(args.users), "--workers", str(args.workers),
+               "--telegram-latency", str(args.telegram_latency),
+               "--yookassa-latency", str(args.yookassa_latency), "--seed", str(args.seed)]
+        if args.database_url:
+            cmd += ["--database-url", args.database_url]
+        if not args.inline:
+            cmd.append("--pool")
+        env = dict(os.environ, LOG_LEVEL="ERROR")
+        proc = subprocess.run(cmd, capture_output=True, text=True, env=env)
+        lines = [line for line in proc.stdout.splitlines() if line.startswith("{\"backend\"")]
+        if proc.returncode != 0 or not lines:
+            results.append({"backend": backend, "error": (proc.stderr or proc.stdout).strip()[-300:]})
+        else:
+            results.append(json.loads(lines[-1]))
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
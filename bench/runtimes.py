@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+"""Сравнение режимов webhook-сервера: threaded (Flask) и asyncio (aiohttp).
+
+Виртуальные пользователи одновременно проходят воронку бронирования через
+настоящий HTTP: --concurrency пользователей держат по одному запросу «в
+полёте». Ответ webhook приходит после обработки апдейта, так что задержка
+включает весь обработчик. Фейковые Bot API и ЮKassa работают в отдельном
+процессе и не искажают число потоков бота.
+
+Для клиента и режима asyncio нужен aiohttp.
+
+Примеры:
+    python bench/runtimes.py --users 500 --concurrency 200 --telegram-latency 50
+    python bench/runtimes.py --runtime asyncio --users 2000 --concurrency 1000 --json
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from _support import FakeTelegramServer, FakeYooKassaServer, import_bot, percentile
+from loadtest import build_funnel, make_update
+
+RUNTIMES = ("threaded", "asyncio")
+
+
+def _serve_fakes(conn, telegram_latency, yookassa_latency):
+    telegram = FakeTelegramServer(latency=telegram_latency).start()
+    yookassa = FakeYooKassaServer(latency=yookassa_latency).start()
+    conn.send((telegram.base_url, yookassa.base_url))
+    conn.recv()  # ждём команды на остановку
+
+
+def start_fakes(args):
+    """Фейковые Bot API и ЮKassa в дочернем процессе; возвращает (url, url, stop)"""
+    parent, child = multiprocessing.Pipe()
+    proc = multiprocessing.Process(
+        target=_serve_fakes,
+        args=(child, args.telegram_latency / 1000, args.yookassa_latency / 1000),
+        daemon=True,
+    )
+    proc.start()
+    telegram_url, yookassa_url = parent.recv()
+
+    def stop():
+        parent.send("stop")
+        proc.join(timeout=5)
+    return telegram_url, yookassa_url, stop
+
+
+def start_threaded(mb):
+    """Flask в многопоточном werkzeug-сервере; обработчик — в потоке запроса"""
+    from werkzeug.serving import make_server
+    mb.bot.threaded = False
+    server = make_server("127.0.0.1", 0, mb.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server.shutdown
+
+
+def start_asyncio(mb, args):
+    """aiohttp-приложение async_runtime на своём event loop в отдельном потоке"""
+    import async_runtime
+    from aiohttp import web
+
+    runtime = async_runtime.create_runtime(mb, workers=args.workers, wait_handlers=True)
+    loop = asyncio.new_event_loop()
+    runner = web.AppRunner(runtime.make_app(), access_log=None)
+    loop.run_until_complete(runner.setup())
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    loop.run_until_complete(site.start())
+    port = site._server.sockets[0].getsockname()[1]
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+
+    def stop():
+        asyncio.run_coroutine_threadsafe(runner.cleanup(), loop).result(timeout=30)
+        loop.call_soon_threadsafe(loop.stop)
+    return f"http://127.0.0.1:{port}", stop
+
+
+async def drive(base_url, path, users, concurrency):
+    """Клиенты-пользователи: каждый шлёт свои шаги по очереди; возвращает задержки"""
+    import aiohttp
+
+    latencies = []
+    errors = {}
+    update_ids = itertools.count(1)
+    queue = asyncio.Queue()
+    for user in users:
+        queue.put_nowait(user)
+
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency)) as session:
+        async def client():
+            while not queue.empty():
+                chat_id, steps = queue.get_nowait()
+                for kind, payload in steps:
+                    body = make_update(next(update_ids), chat_id, kind, payload)
+                    started = time.perf_counter()
+                    try:
+                        async with session.post(base_url + path, json=body) as resp:
+                            await resp.read()
+                            status = resp.status
+                    except Exception as e:
+                        status = type(e).__name__
+                    latencies.append(time.perf_counter() - started)
+                    if status != 200:
+                        errors[str(status)] = errors.get(str(status), 0) + 1
+
+        await asyncio.gather(*(client() for _ in range(concurrency)))
+    return latencies, errors
+
+
+def run_runtime(args):
+    """Прогон одного режима в текущем процессе"""
+    telegram_url, yookassa_url, stop_fakes = start_fakes(args)
+    workdir = tempfile.mkdtemp(prefix=f"machata-runtime-{args.runtime}-")
+    mb = import_bot(workdir, telegram_url, {"YOOKASSA_API_URL": yookassa_url, "DATABASE_URL": ""})
+
+    rng = random.Random(args.seed)
+    first_chat = 10_000_000
+    users = [(chat_id, build_funnel(mb, chat_id, rng)) for chat_id in range(first_chat, first_chat + args.users)]
+    total_updates = sum(len(steps) for _, steps in users)
+
+    if args.runtime == "asyncio":
+        base_url, stop_server = start_asyncio(mb, args)
+    else:
+        base_url, stop_server = start_threaded(mb)
+
+    peak_threads = threading.active_count()
+    sampling = threading.Event()
+
+    def sample_threads():
+        nonlocal peak_threads
+        while not sampling.wait(0.05):
+            peak_threads = max(peak_threads, threading.active_count())
+    threading.Thread(target=sample_threads, daemon=True).start()
+
+    started = time.perf_counter()
+    latencies, errors = asyncio.run(drive(base_url, f"/{mb.API_TOKEN}/", users, args.concurrency))
+    elapsed = time.perf_counter() - started
+    sampling.set()
+
+    stop_server()
+    stop_fakes()
+
+    latencies.sort()
+    bookings = [b for b in mb.load_bookings() if b.get('user_id', 0) >= first_chat]
+    return {
+        "runtime": args.runtime,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "updates": total_updates,
+        "elapsed_s": round(elapsed, 3),
+        "updates_per_s": round(total_updates / elapsed, 1) if elapsed else 0.0,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "peak_threads": peak_threads,
+        "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "errors": errors,
+        "bookings_created": len(bookings),
+    }
+
+
+def print_report(results):
+    header = (f"{'runtime':<10}{'updates':>9}{'upd/s':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}"
+              f"{'threads':>9}{'RSS MB':>9}{'bookings':>10}{'errors':>8}")
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print(f"{r['runtime']:<10} ошибка: {r['error']}")
+            continue
+        print(
+            f"{r['runtime']:<10}{r['updates']:>9}{r['updates_per_s']:>10}{r['p50_ms']:>10}{r['p95_ms']:>10}"
+            f"{r['p99_ms']:>10}{r['peak_threads']:>9}{r['max_rss_mb']:>9}{r['bookings_created']:>10}"
+            f"{sum(r['errors'].values()):>8}"
+        )
+        if r["bookings_created"] != r["users"]:
+            print(f"{'':<10}⚠️ ожидалось броней: {r['users']}, создано: {r['bookings_created']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runtime", choices=RUNTIMES + ("all",), default="all")
+    parser.add_argument("--users", type=int, default=500, help="число виртуальных пользователей")
+    parser.add_argument("--concurrency", type=int, default=200, help="одновременных клиентов")
+    parser.add_argument("--workers", type=int, default=32, help="потоков обработчиков в режиме asyncio")
+    parser.add_argument("--telegram-latency", type=float, default=20.0, help="задержка фейкового Bot API, мс")
+    parser.add_argument("--yookassa-latency", type=float, default=100.0, help="задержка фейковой ЮKassa, мс")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--json", action="store_true", help="вывести результат в JSON")
+    args = parser.parse_args()
+
+    if args.runtime != "all":
+        os.environ.setdefault("LOG_LEVEL", "ERROR")
+        result = run_runtime(args)
+        if args.json:
+            print(json.dumps(result, ensure_ascii=False))
+        else:
+            print_report([result])
+        return
+
+    # Каждый режим — в отдельном процессе: состояние модуля бота глобальное
+    results = []
+    for runtime in RUNTIMES:
+        cmd = [sys.executable, os.path.abspath(__file__), "--runtime", runtime, "--json",
+               "--users", str(args.users), "--concurrency", str(args.concurrency),
+               "--workers", str(args.workers),
+               "--telegram-latency", str(args.telegram_latency),
+               "--yookassa-latency", str(args.yookassa_latency), "--seed", str(args.seed)]
+        proc = subprocess.run(cmd, capture_output=True, text=True, env=dict(os.environ, LOG_LEVEL="ERROR"))
+        lines = [line for line in proc.stdout.splitlines() if line.startswith("{\"runtime\"")]
+        if proc.returncode != 0 or not lines:
+            results.append({"runtime": runtime, "error": (proc.stderr or proc.stdout).strip()[-300:]})
+        else:
+            results.append(json.loads(lines[-1]))
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False))
+    else:
+        print_report(results)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""Ограниченный LRU-кэш записей по ключу с версионной инвалидацией.
+
+Кэш читает запись из хранилища при промахе (read-through) и держит не
+больше maxsize записей, вытесняя давно не читанные. Любая инвалидация
+увеличивает версию кэша: загрузка, начатая до изменения, свою запись уже
+не положит, и устаревшая бронь не вернётся в кэш после отмены или оплаты.
+ttl — страховка от изменений в обход бота (manage.py, другой экземпляр).
+"""
+import collections
+import threading
+import time
+
+
+class VersionedLRU:
+    """LRU key → значение; None из loader не кэшируется"""
+
+    def __init__(self, maxsize=1024, ttl=None, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = collections.OrderedDict()  # key -> (загружено в, значение)
+        self._version = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, loader):
+        """(значение, было ли попадание); при промахе вызывает loader(key)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                loaded_at, value = entry
+                if self.ttl is None or self._clock() - loaded_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    return value, True
+                del self._entries[key]
+            version = self._version
+
+        # Загрузка — без блокировки: медленное хранилище не держит другие чтения
+        value = loader(key)
+        if value is not None:
+            with self._lock:
+                if self._version == version:
+                    self._entries[key] = (self._clock(), value)
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.maxsize:
+                        self._entries.popitem(last=False)
+        return value, False
+
+    def invalidate(self, *keys):
+        """Удаление записей keys; без аргументов — всех записей"""
+        with self._lock:
+            self._version += 1
+            if not keys:
+                self._entries.clear()
+                return
+            for key in keys:
+                self._entries.pop(key, None)
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""Компактная типизированная запись брони.
+
+В JSON-файле и в БД бронь — словарь: дата строкой YYYY-MM-DD, часы
+списком. Booking держит те же данные в __slots__: дату — порядковым
+номером дня (date.toordinal), часы — битовой маской (бит h — час h),
+а начало и конец считает один раз при создании.
+
+Преобразование словарь → Booking → словарь без потерь: часы брони —
+множество, и бот всегда пишет их отсортированным списком; поля, которых
+нет в модели (notified_24h и т. п.), сохраняются в extra, а отсутствовавшие
+в словаре поля не появляются в нём при обратном преобразовании.
+"""
+import functools
+from datetime import date, datetime, timedelta
+
+# Порядок полей — как BOOKING_COLUMNS в database.py
+FIELDS = (
+    "id", "user_id", "service", "date", "times", "duration", "name", "email", "phone",
+    "comment", "price", "status", "created_at", "paid_at", "yookassa_payment_id", "payment_url",
+)
+
+_STORED = tuple(f for f in FIELDS if f != "times")
+_FIELD_SET = frozenset(FIELDS)
+
+
+@functools.lru_cache(maxsize=4096)
+def date_ordinal(value):
+    """Порядковый номер дня для YYYY-MM-DD; None — если дата не разбирается.
+
+    Дат в работе немного (сотни), поэтому разбор кэшируется.
+    """
+    try:
+        return datetime.strptime(value, "%Y-%m-%d").toordinal()
+    except (TypeError, ValueError):
+        return None
+
+
+def hours_mask(times):
+    """Битовая маска часов: бит h — час h"""
+    mask = 0
+    for hour in times or ():
+        mask |= 1 << (hour if hour.__class__ is int else int(hour))
+    return mask
+
+
+def mask_hours(mask):
+    """Часы из маски по возрастанию"""
+    hours = []
+    hour = 0
+    while mask:
+        if mask & 1:
+            hours.append(hour)
+        mask >>= 1
+        hour += 1
+    return hours
+
+
+class Booking:
+    """Бронь; объекты из общих кэшей — только для чтения"""
+
+    __slots__ = _STORED + ("ordinal", "hours", "hours_count", "start", "end", "extra", "absent")
+
+    @classmethod
+    def from_dict(cls, data):
+        booking = cls.__new__(cls)
+        get = data.get
+        # Поля присваиваются явно: так в разы быстрее, чем setattr в цикле.
+        # Отсутствующее поле читается как None
+        booking.id = get("id")
+        booking.user_id = get("user_id")
+        booking.service = get("service")
+        booking.date = get("date")
+        booking.duration = get("duration")
+        booking.name = get("name")
+        booking.email = get("email")
+        booking.phone = get("phone")
+        booking.comment = get("comment")
+        booking.price = get("price")
+        booking.status = get("status")
+        booking.created_at = get("created_at")
+        booking.paid_at = get("paid_at")
+        booking.yookassa_payment_id = get("yookassa_payment_id")
+        booking.payment_url = get("payment_url")
+        times = get("times")
+        hours = hours_mask(times) if times else 0
+        booking.hours = hours
+        if hours:
+            booking.hours_count = bin(hours).count("1")
+            booking.start = (hours & -hours).bit_length() - 1
+            booking.end = hours.bit_length()
+        else:
+            booking.hours_count = 0
+            booking.start = booking.end = None
+        day = booking.date
+        booking.ordinal = date_ordinal(day) if day.__class__ is str else None
+        # Обычная бронь содержит ровно FIELDS; иначе запоминаем лишние и недостающие поля
+        booking.extra = booking.absent = None
+        if len(data) != len(FIELDS) or not _FIELD_SET.issuperset(data):
+            booking.extra = {k: v for k, v in data.items() if k not in _FIELD_SET} or None
+            booking.absent = _FIELD_SET.difference(data) or None
+        return booking
+
+    def to_dict(self):
+        absent = self.absent or ()
+        data = {}
+        for field in FIELDS:
+            if field not in absent:
+                data[field] = self.times if field == "times" else getattr(self, field)
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def get(self, field, default=None):
+        """Доступ как у словаря, для кода, который принимает и dict, и Booking"""
+        if field in _FIELD_SET:
+            if self.absent and field in self.absent:
+                return default
+            return self.times if field == "times" else getattr(self, field)
+        return (self.extra or {}).get(field, default)
+
+    def __repr__(self):
+        return f"Booking(id={self.get('id')!r}, date={self.get('date')!r}, times={self.times!r}, status={self.get('status')!r})"
+
+    @property
+    def times(self):
+        return mask_hours(self.hours)
+
+    @property
+    def day(self):
+        return date.fromordinal(self.ordinal) if self.ordinal else None
+
+    def starts_at(self):
+        """Начало брони (datetime) или None без даты и часов"""
+        if not self.ordinal or self.start is None:
+            return None
+        return datetime.fromordinal(self.ordinal) + timedelta(hours=self.start)
+
+    def date_label(self, fmt="%d.%m.%Y"):
+        day = self.day
+        return day.strftime(fmt) if day else (self.get("date") or "")
+
+    def time_range(self, sep="–"):
+        """«10:00–12:00 (2ч)»; пустая строка без часов"""
+        if self.start is None:
+            return ""
+        return f"{self.start:02d}:00{sep}{self.end:02d}:00 ({self.hours_count}ч)"
+
+
+def as_booking(booking):
+    """Booking из словаря или сам Booking"""
+    return booking if isinstance(booking, Booking) else Booking.from_dict(booking)
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""Автоматический выключатель (circuit breaker) для внешних API.
+
+Выключатель смотрит на окно последних вызовов: если доля ошибок или
+медленных вызовов превышает порог, он «размыкается», и следующие вызовы
+сразу получают отказ, не занимая поток на таймаут. Через open_seconds
+выключатель пропускает один пробный вызов (half-open): успех замыкает
+его, неудача снова размыкает.
+"""
+import collections
+import threading
+import time
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+# Значение gauge для каждого состояния
+STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+class CircuitBreaker:
+    """Выключатель по доле ошибок и медленных вызовов в скользящем окне.
+
+    window — сколько последних вызовов учитывать, min_calls — минимум
+    вызовов в окне для решения, slow_seconds — порог «медленного» вызова.
+    """
+
+    def __init__(self, name, window=20, min_calls=5, failure_rate=0.5,
+                 slow_seconds=3.0, slow_rate=0.5, open_seconds=30.0, clock=time.monotonic):
+        self.name = name
+        self.window = window
+        self.min_calls = min_calls
+        self.failure_rate = failure_rate
+        self.slow_seconds = slow_seconds
+        self.slow_rate = slow_rate
+        self.open_seconds = open_seconds
+        self._clock = clock
+        self._calls = collections.deque(maxlen=window)  # (ошибка, медленный)
+        self._state = CLOSED
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+        self.opened_total = 0
+        self.rejected_total = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._current_state()
+
+    def _current_state(self):
+        # Вызывается под self._lock
+        if self._state == OPEN and self._clock() - self._opened_at >= self.open_seconds:
+            self._state = HALF_OPEN
+            self._probe_in_flight = False
+        return self._state
+
+    def allow(self):
+        """Можно ли сейчас делать вызов; в half-open пропускается один пробный"""
+        with self._lock:
+            state = self._current_state()
+            if state == CLOSED:
+                return True
+            if state == HALF_OPEN and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            self.rejected_total += 1
+            return False
+
+    def record(self, ok, duration=0.0):
+        """Итог вызова; возвращает новое состояние, если оно сменилось, иначе None"""
+        slow = duration >= self.slow_seconds
+        with self._lock:
+            state = self._current_state()
+            if state == HALF_OPEN:
+                self._probe_in_flight = False
+                if ok and not slow:
+                    self._state = CLOSED
+                    self._calls.clear()
+                    return CLOSED
+                self._trip()
+                return OPEN
+            if state == OPEN:
+                return None
+            self._calls.append((not ok, slow))
+            if len(self._calls) >= self.min_calls:
+                failures = sum(1 for failed, _ in self._calls if failed)
+                slows = sum(1 for _, is_slow in self._calls if is_slow)
+                if (failures / len(self._calls) >= self.failure_rate
+                        or slows / len(self._calls) >= self.slow_rate):
+                    self._trip()
+                    return OPEN
+            return None
+
+    def _trip(self):
+        # Вызывается под self._lock
+        self._state = OPEN
+        self._opened_at = self._clock()
+        self._calls.clear()
+        self.opened_total += 1
+
+    def retry_after(self):
+        """Сколько секунд до пробного вызова (0 — можно пробовать)"""
+        with self._lock:
+            if self._current_state() != OPEN:
+                return 0.0
+            return max(0.0, self.open_seconds - (self._clock() - self._opened_at))
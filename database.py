@@ -1,36 +1,117 @@
 # -*- coding: utf-8 -*-
+import io
+import csv
+import functools
+import json
 import os
-import sys
-import subprocess
+import threading
+import time
+from datetime import date as _date, datetime
+
+import metrics
+import structured_log
 
 def _log(msg):
     # Локальный логгер, чтобы не зависеть от machata_bot.py
-    print(msg, flush=True)
-
-# Пытаемся импортировать psycopg2
-try:
-    import psycopg2
-    import psycopg2.extras
-    _log("[DB] ✅ psycopg2 успешно импортирован")
-except ImportError as e:
-    _log(f"[DB] ❌ Ошибка импорта psycopg2: {e}")
-    _log("[DB] 💡 Попытка установить psycopg2-binary...")
-    try:
-        # Пытаемся установить psycopg2-binary если его нет
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "psycopg2-binary==2.9.9", "--quiet"], 
-                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
-        import psycopg2
-        import psycopg2.extras
-        _log("[DB] ✅ psycopg2-binary успешно установлен и импортирован")
-    except Exception as install_error:
-        _log(f"[DB] ❌ Не удалось установить psycopg2-binary: {install_error}")
-        _log("[DB] 💡 Проверьте, что psycopg2-binary есть в requirements.txt")
-        psycopg2 = None
-except Exception as e:  # pragma: no cover - optional dependency for local runs
-    _log(f"[DB] ❌ Неожиданная ошибка при импорте psycopg2: {e}")
-    psycopg2 = None
-    # Локальный логгер, чтобы не зависеть от machata_bot.py
-    print(msg, flush=True)
+    structured_log.info(msg, source="db")
+
+# Драйвер PostgreSQL импортируется лениво — при первом обращении к БД,
+# а не при импорте модуля. Во время работы ничего не доустанавливается:
+# psycopg2-binary должен быть в requirements.txt.
+psycopg2 = None
+_driver_checked = False
+_driver_lock = threading.Lock()
+
+
+def _load_driver():
+    """psycopg2 или None, если драйвер не установлен"""
+    global psycopg2, _driver_checked
+    if _driver_checked:
+        return psycopg2
+    with _driver_lock:
+        if not _driver_checked:
+            try:
+                import psycopg2 as driver
+                import psycopg2.extras  # noqa: F401 — RealDictCursor, Json
+                psycopg2 = driver
+                _log("[DB] ✅ psycopg2 успешно импортирован")
+            except ImportError as e:
+                _log(f"[DB] ❌ psycopg2 недоступен: {e}")
+                _log("[DB] 💡 Проверьте, что psycopg2-binary есть в requirements.txt")
+            _driver_checked = True
+    return psycopg2
+
+
+DB_QUERY_SECONDS = metrics.histogram(
+    "machata_db_query_duration_seconds",
+    "Время выполнения функций database.py",
+    ("function",),
+)
+DB_ERRORS = metrics.counter(
+    "machata_db_errors_total",
+    "Ошибки функций database.py",
+    ("function",),
+)
+
+
+def _instrumented(func=None, *, retry=True):
+    """Учитывает количество, время и ошибки вызовов функции БД.
+
+    Вызов, упавший из-за обрыва соединения (сервер или прокси закрыл
+    простаивавшее соединение пула), повторяется один раз на новом
+    соединении. retry=False — для функций, которые читают переданный
+    итератор: повторить их нельзя.
+    """
+    if func is None:
+        return functools.partial(_instrumented, retry=retry)
+    timed = metrics.timed(DB_QUERY_SECONDS, func.__name__, errors=DB_ERRORS)
+    if not retry:
+        return timed(func)
+
+    @functools.wraps(func)
+    def call(*args, **kwargs):
+        try:
+            return func(*args, **kwargs)
+        except Exception as e:
+            if not _is_disconnect(e):
+                raise
+            _log(f"[DB] ⚠️ {func.__name__}: соединение оборвано ({e}), повтор на новом соединении")
+            _drop_idle_connections("disconnect")
+            return func(*args, **kwargs)
+
+    return timed(call)
+
+
+def _is_disconnect(error):
+    """Ошибка уровня соединения: без SQLSTATE, класс 08 (connection exception) или 57P (завершение сервера)"""
+    if psycopg2 is None or not isinstance(error, (psycopg2.OperationalError, psycopg2.InterfaceError)):
+        return False
+    code = getattr(error, "pgcode", None)
+    return code is None or code.startswith(("08", "57P"))
+
+
+BOOKING_COLUMNS = (
+    "id", "user_id", "service", "date", "times", "duration", "name", "email", "phone",
+    "comment", "price", "status", "created_at", "paid_at", "yookassa_payment_id", "payment_url",
+)
+
+
+# Типы колонок броней (после миграции typed_booking_columns) — для PREPARE
+BOOKING_TYPES = {
+    "id": "bigint", "user_id": "bigint", "service": "text", "date": "date", "times": "smallint[]",
+    "duration": "integer", "name": "text", "email": "text", "phone": "text", "comment": "text",
+    "price": "integer", "status": "text", "created_at": "timestamp", "paid_at": "timestamp",
+    "yookassa_payment_id": "text", "payment_url": "text",
+}
+
+# Флаги брони, которые бот ставит после отправки напоминаний
+BOOKING_FLAGS = ("notified_24h", "notified_30m")
+
+
+VIP_COLUMNS = ("user_id", "name", "discount", "custom_price_repet", "tier")
+
+
+VIP_TIER_COLUMNS = ("name", "discount", "prices")
 
 
 def get_database_url():
@@ -46,7 +127,8 @@ def is_enabled():
     
     db_url = get_database_url()
     has_url = bool(db_url)
-    has_psycopg2 = psycopg2 is not None
+    # Без DATABASE_URL драйвер даже не импортируем
+    has_psycopg2 = has_url and _load_driver() is not None
     result = has_url and has_psycopg2
     _is_enabled_cache = result
     
@@ -57,12 +139,155 @@ def is_enabled():
     return result
 
 
+class DatabaseInitError(RuntimeError):
+    """БД задана, но не готова к работе (нет соединения, миграция не прошла)"""
+
+
+# ====== ПУЛ СОЕДИНЕНИЙ ==========================================================
+# conn.close() возвращает соединение в пул: функции ниже по-прежнему берут
+# соединение на вызов и закрывают его, но TCP/SSL-рукопожатие и подготовка
+# запросов (см. _execute) делаются один раз на соединение.
+
+# Сколько простаивающих соединений держать; лишние закрываются по-настоящему
+DB_POOL_SIZE = int(os.environ.get("DB_POOL_SIZE", "8"))
+# Соединение, простоявшее дольше DB_POOL_MAX_IDLE секунд, закрывается; дольше
+# DB_POOL_CHECK_AFTER — проверяется SELECT 1 перед выдачей (его мог закрыть
+# сервер или прокси)
+DB_POOL_MAX_IDLE = float(os.environ.get("DB_POOL_MAX_IDLE", "300"))
+DB_POOL_CHECK_AFTER = float(os.environ.get("DB_POOL_CHECK_AFTER", "30"))
+
+_pool = []  # простаивающие соединения, LIFO
+_pool_lock = threading.Lock()
+_pool_pid = os.getpid()
+_connection_class = None
+
+DB_CONNECTIONS_OPENED = metrics.counter(
+    "machata_db_connections_opened_total",
+    "Новые соединения с PostgreSQL (не из пула)",
+)
+DB_CONNECTIONS_DROPPED = metrics.counter(
+    "machata_db_connections_dropped_total",
+    "Соединения пула, закрытые как устаревшие: idle — долгий простой, dead — не прошли проверку, disconnect — обрыв во время запроса",
+    ("reason",),
+)
+DB_POOL_IDLE = metrics.gauge(
+    "machata_db_pool_idle_connections",
+    "Простаивающие соединения в пуле",
+    lambda: len(_pool),
+)
+
+
+def _pooled_connection_class():
+    """Класс соединения, которое при close() возвращается в пул"""
+    global _connection_class
+    if _connection_class is None:
+        class PooledConnection(psycopg2.extensions.connection):
+            def __init__(self, *args, **kwargs):
+                super().__init__(*args, **kwargs)
+                self.prepared = set()  # имена подготовленных на этом соединении запросов
+                self.discard = False  # не возвращать в пул (например, после ошибки EXECUTE)
+                self.released = False
+                self.idle_since = time.monotonic()
+
+            def close(self):
+                _release(self)
+
+        _connection_class = PooledConnection
+    return _connection_class
+
+
+def _close(conn):
+    try:
+        psycopg2.extensions.connection.close(conn)
+    except Exception:
+        pass
+
+
+def _release(conn):
+    # Повторный close() того же соединения игнорируется: иначе оно попало
+    # бы в пул дважды и досталось двум потокам
+    if conn.released:
+        return
+    conn.released = True
+    if not conn.closed and not conn.discard:
+        try:
+            if conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                conn.rollback()
+            if conn.autocommit:
+                conn.autocommit = False
+            with _pool_lock:
+                if len(_pool) < DB_POOL_SIZE and _pool_pid == os.getpid():
+                    conn.idle_since = time.monotonic()
+                    _pool.append(conn)
+                    return
+        except Exception:
+            pass
+    _close(conn)
+
+
+def _alive(conn):
+    """Проверка соединения перед выдачей из пула"""
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT 1")
+        cur.close()
+        conn.rollback()
+        return True
+    except Exception:
+        return False
+
+
+def _drop_idle_connections(reason):
+    """Закрытие всех простаивающих соединений: после обрыва одного остальные, скорее всего, тоже мертвы"""
+    with _pool_lock:
+        idle = _pool[:]
+        _pool.clear()
+    for conn in idle:
+        DB_CONNECTIONS_DROPPED.inc(reason)
+        _close(conn)
+
+
 def _get_connection():
+    global _pool_pid
     db_url = get_database_url()
-    if not db_url or psycopg2 is None:
+    if not db_url or _load_driver() is None:
         return None
+    while True:
+        with _pool_lock:
+            if _pool_pid != os.getpid():
+                # После fork соединения родителя не трогаем — они его
+                _pool.clear()
+                _pool_pid = os.getpid()
+            if not _pool:
+                break
+            conn = _pool.pop()
+        if conn.closed:
+            continue
+        # Проверка — вне блокировки пула: SELECT 1 не держит другие потоки
+        idle = time.monotonic() - conn.idle_since
+        if idle > DB_POOL_MAX_IDLE:
+            DB_CONNECTIONS_DROPPED.inc("idle")
+            _close(conn)
+            continue
+        if idle > DB_POOL_CHECK_AFTER and not _alive(conn):
+            DB_CONNECTIONS_DROPPED.inc("dead")
+            _close(conn)
+            continue
+        conn.released = False
+        return conn
     try:
-        conn = psycopg2.connect(db_url, sslmode="require")
+        # Для локального PostgreSQL без SSL (нагрузочные тесты): DATABASE_SSLMODE=disable.
+        # TCP keepalive — чтобы простаивающее соединение не закрыл NAT или прокси
+        conn = psycopg2.connect(
+            db_url,
+            sslmode=os.environ.get("DATABASE_SSLMODE", "require"),
+            keepalives=1,
+            keepalives_idle=30,
+            keepalives_interval=10,
+            keepalives_count=3,
+            connection_factory=_pooled_connection_class(),
+        )
+        DB_CONNECTIONS_OPENED.inc()
         _log("[DB] ✅ Подключение к БД установлено")
         return conn
     except Exception as e:
@@ -70,14 +295,101 @@ def _get_connection():
         return None
 
 
+# ====== ПОДГОТОВЛЕННЫЕ ЗАПРОСЫ =================================================
+# Горячие запросы регистрируются один раз и выполняются по имени: на каждом
+# соединении пула запрос проходит PREPARE при первом использовании, дальше
+# сервер не разбирает и не планирует его заново (после пяти выполнений
+# PostgreSQL переходит на общий план). DB_PREPARED_STATEMENTS=0 отключает
+# PREPARE — например, за PgBouncer в режиме transaction.
+
+PREPARED_STATEMENTS = os.environ.get("DB_PREPARED_STATEMENTS", "1") != "0"
+
+DB_STATEMENT_SECONDS = metrics.histogram(
+    "machata_db_statement_duration_seconds",
+    "Время выполнения зарегистрированных запросов",
+    ("statement",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+DB_STATEMENT_PREPARES = metrics.counter(
+    "machata_db_statement_prepares_total",
+    "PREPARE зарегистрированных запросов (раз на соединение)",
+    ("statement",),
+)
+DB_STATEMENT_ERRORS = metrics.counter(
+    "machata_db_statement_errors_total",
+    "Ошибки зарегистрированных запросов",
+    ("statement",),
+)
+
+
+class _Statement:
+    """Запрос реестра: текст для psycopg2, PREPARE и EXECUTE по имени"""
+
+    __slots__ = ("name", "params", "text_sql", "prepare_sql", "execute_sql")
+
+    def __init__(self, name, sql, params):
+        self.name = name
+        self.params = tuple(p for p, _ in params)
+        self.text_sql = sql
+        prepared = sql
+        for i, (param, _) in enumerate(params, start=1):
+            prepared = prepared.replace(f"%({param})s", f"${i}")
+        types = ", ".join(t for _, t in params)
+        self.prepare_sql = f"PREPARE {name} ({types}) AS {prepared}"
+        # Явные приведения: параметры приходят литералами psycopg2
+        casts = ", ".join(f"%s::{t}" for _, t in params)
+        self.execute_sql = f"EXECUTE {name} ({casts})"
+
+
+_STATEMENTS = {}
+
+
+def _statement(name, sql, params):
+    """Регистрация запроса: sql с %(param)s, params — [(param, тип PostgreSQL)]"""
+    _STATEMENTS[name] = _Statement(name, sql, params)
+    return name
+
+
+def _execute(cur, name, values):
+    """Выполнение зарегистрированного запроса; values — словарь параметров"""
+    stmt = _STATEMENTS[name]
+    conn = cur.connection
+    started = time.perf_counter()
+    try:
+        if not PREPARED_STATEMENTS or not hasattr(conn, "prepared"):
+            cur.execute(stmt.text_sql, values)
+        else:
+            if name not in conn.prepared:
+                cur.execute(stmt.prepare_sql)
+                conn.prepared.add(name)
+                DB_STATEMENT_PREPARES.inc(name)
+            try:
+                cur.execute(stmt.execute_sql, [values.get(p) for p in stmt.params])
+            except Exception:
+                # Например, «cached plan must not change result type» после
+                # миграции: соединение с устаревшими планами в пул не вернётся
+                conn.discard = True
+                raise
+    except Exception:
+        DB_STATEMENT_ERRORS.inc(name)
+        raise
+    finally:
+        DB_STATEMENT_SECONDS.observe(time.perf_counter() - started, name)
+
+
 def init_database():
-    """Инициализация PostgreSQL, если DATABASE_URL задан."""
+    """Инициализация PostgreSQL, если DATABASE_URL задан.
+
+    Если БД задана, но подключиться или применить миграции не удалось,
+    бросает DatabaseInitError: на JSON файлы при заданной БД не переходим —
+    другие экземпляры пишут в PostgreSQL, и брони разошлись бы по двум хранилищам.
+    """
     _log("[DB] Начинаю инициализацию базы данных...")
     db_url = get_database_url()
     if not db_url:
         _log("[DB] ❌ DATABASE_URL не задан — используются JSON файлы")
         return
-    if psycopg2 is None:
+    if _load_driver() is None:
         _log("[DB] ❌ psycopg2 не установлен — используются JSON файлы")
         _log("[DB] 💡 Установите: pip install psycopg2-binary")
         return
@@ -88,12 +400,13 @@ def init_database():
     try:
         conn = _get_connection()
         if conn is None:
-            _log("[DB] ❌ Не удалось подключиться к БД — используются JSON файлы")
-            return
+            raise DatabaseInitError("не удалось подключиться к БД")
 
         conn.autocommit = True
         cur = conn.cursor()
 
+        # Таблицы создаются в исходном виде (версия 0 схемы): типы колонок
+        # и индексы броней дальше меняются только миграциями (см. MIGRATIONS)
         cur.execute(
             """
             CREATE TABLE IF NOT EXISTS bookings (
@@ -127,143 +440,1175 @@ def init_database():
             )
             """
         )
+        cur.execute("ALTER TABLE vip_users ADD COLUMN IF NOT EXISTS tier TEXT")
+
+        # Уровни VIP: скидка и индивидуальные цены за час по услугам
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS vip_tiers (
+                name TEXT PRIMARY KEY,
+                discount INTEGER,
+                prices JSONB
+            )
+            """
+        )
+
+        # Поиск клиента админом: нормализованный телефон (как normalize_phone
+        # в machata_bot.py), имя, email и user_id
+        cur.execute(
+            """
+            CREATE OR REPLACE FUNCTION booking_phone_norm(phone TEXT) RETURNS TEXT
+            LANGUAGE sql IMMUTABLE AS $$
+                SELECT CASE
+                    WHEN length(d) = 11 AND left(d, 1) = '8' THEN '7' || substr(d, 2)
+                    WHEN length(d) = 10 AND left(d, 1) <> '7' THEN '7' || d
+                    ELSE d
+                END
+                FROM (SELECT regexp_replace(COALESCE(phone, ''), '\\D', '', 'g') AS d) digits
+            $$
+            """
+        )
+        cur.execute(
+            """
+            ALTER TABLE bookings ADD COLUMN IF NOT EXISTS phone_norm TEXT
+                GENERATED ALWAYS AS (booking_phone_norm(phone)) STORED
+            """
+        )
+
+        # Холодное хранилище: прошедшие и отменённые брони
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bookings_archive (
+                id BIGINT PRIMARY KEY,
+                user_id BIGINT,
+                service TEXT,
+                date TEXT,
+                times JSONB,
+                duration INTEGER,
+                name TEXT,
+                email TEXT,
+                phone TEXT,
+                comment TEXT,
+                price INTEGER,
+                status TEXT,
+                created_at TEXT,
+                paid_at TEXT,
+                yookassa_payment_id TEXT,
+                payment_url TEXT,
+                archived_at TEXT
+            )
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS bookings_archive_date_idx ON bookings_archive (date)")
+        # Поиск клиента идёт и по архиву — те же колонка и индексы, что у броней
+        cur.execute(
+            """
+            ALTER TABLE bookings_archive ADD COLUMN IF NOT EXISTS phone_norm TEXT
+                GENERATED ALWAYS AS (booking_phone_norm(phone)) STORED
+            """
+        )
+        cur.execute("CREATE INDEX IF NOT EXISTS bookings_archive_user_id_idx ON bookings_archive (user_id)")
+        _init_search_indexes(cur)
+
+        # Дневные агрегаты для статистики (пересчитываются по изменённым датам)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS booking_daily_stats (
+                date TEXT,
+                service TEXT,
+                status TEXT,
+                bookings INTEGER,
+                hours INTEGER,
+                revenue BIGINT,
+                PRIMARY KEY (date, service, status)
+            )
+            """
+        )
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS booking_hourly_stats (
+                date TEXT,
+                hour SMALLINT,
+                hours INTEGER,
+                PRIMARY KEY (date, hour)
+            )
+            """
+        )
+
+        # Контактные данные клиента из последней брони — для автозаполнения
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS customer_profiles (
+                user_id BIGINT PRIMARY KEY,
+                name TEXT,
+                email TEXT,
+                phone TEXT,
+                updated_at TEXT
+            )
+            """
+        )
+
+        # Служебное состояние бота (например, обработанные update_id)
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS bot_state (
+                key TEXT PRIMARY KEY,
+                value JSONB,
+                updated_at TEXT
+            )
+            """
+        )
 
         cur.close()
-        conn.close()
         _log("[DB] ✅ Таблицы проверены/созданы успешно")
+        try:
+            migrate(conn)
+        finally:
+            conn.close()
         _log("[DB] ✅ Инициализация БД завершена")
+    except DatabaseInitError:
+        raise
     except Exception as e:
-        _log(f"[DB] ❌ Ошибка инициализации БД: {e}")
         import traceback
         _log(f"[DB] Трассировка: {traceback.format_exc()}")
+        # Без применённых миграций колонки остаются TEXT/JSONB, а запросы
+        # рассчитаны на DATE/SMALLINT[]/TIMESTAMP — с такой схемой не работаем
+        raise DatabaseInitError(f"ошибка инициализации БД: {e}") from e
 
 
-def get_all_bookings():
+# Есть ли pg_trgm: с ним поиск по подстроке, без него — по префиксу
+_trgm_available = None
+
+# Таблицы, по которым ищет search_bookings
+_SEARCH_TABLES = ("bookings", "bookings_archive")
+
+
+def _init_search_indexes(cur):
+    """Индексы поиска: триграммные при наличии pg_trgm, иначе префиксные"""
+    global _trgm_available
+    try:
+        cur.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+        _trgm_available = True
+    except Exception as e:
+        # На управляемых БД расширение может быть недоступно без прав суперпользователя
+        _log(f"[DB] ⚠️ pg_trgm недоступен ({e}) — поиск только по началу строки")
+        _trgm_available = False
+
+    for table in _SEARCH_TABLES:
+        if _trgm_available:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_phone_norm_trgm_idx ON {table} USING gin (phone_norm gin_trgm_ops)")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_name_trgm_idx ON {table} USING gin (lower(name) gin_trgm_ops)")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_email_trgm_idx ON {table} USING gin (lower(email) gin_trgm_ops)")
+        else:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_phone_norm_idx ON {table} (phone_norm text_pattern_ops)")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_name_prefix_idx ON {table} (lower(name) text_pattern_ops)")
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {table}_email_prefix_idx ON {table} (lower(email) text_pattern_ops)")
+
+
+# ====== МИГРАЦИИ СХЕМЫ =========================================================
+# Каждая миграция применяется один раз и записывается в schema_migrations
+# вместе с длительностью. Миграции пишутся так, чтобы бот продолжал работать:
+# ожидание блокировки ограничено lock_timeout (занятая таблица — миграция
+# откатывается и повторяется при следующем запуске), индексы строятся
+# CONCURRENTLY, новые колонки с константным DEFAULT не переписывают таблицу.
+
+MIGRATION_LOCK_TIMEOUT = os.environ.get("DB_MIGRATION_LOCK_TIMEOUT", "5s")
+
+MIGRATION_SECONDS = metrics.gauge(
+    "machata_db_migration_duration_seconds",
+    "Длительность применённых миграций схемы",
+    lambda: {str(version): ms / 1000 for version, _, ms in _applied_migrations},
+    ("version",),
+)
+
+# Применённые в этом процессе миграции: (версия, имя, мс)
+_applied_migrations = []
+
+
+def _migrate_typed_columns(cur):
+    """date → DATE, created_at/paid_at → TIMESTAMP, times → SMALLINT[].
+
+    Бот пишет время локальным без зоны (datetime.now().isoformat()), поэтому
+    колонки — timestamp without time zone: с TIMESTAMPTZ строка читалась бы
+    в TimeZone сессии сервера и возвращалась сдвинутой на разницу зон.
+
+    Таблицы маленькие (тысячи строк), ALTER ... TYPE переписывает их за
+    миллисекунды; дольше lock_timeout блокировку не ждём.
+    """
+    # В USING нельзя подзапрос — разбор JSONB вынесен в функцию
+    cur.execute(
+        """
+        CREATE OR REPLACE FUNCTION booking_hours(times JSONB) RETURNS SMALLINT[]
+        LANGUAGE sql IMMUTABLE AS $$
+            SELECT COALESCE(array_agg(DISTINCT value::smallint ORDER BY value::smallint), '{}')
+            FROM jsonb_array_elements_text(COALESCE(times, '[]'::jsonb))
+        $$
+        """
+    )
+    # start_hour зависит от times — пересоздаётся ниже поверх массива
+    cur.execute("DROP INDEX IF EXISTS bookings_listing_idx")
+    cur.execute("ALTER TABLE bookings DROP COLUMN IF EXISTS start_hour")
+    typed = """
+        ALTER COLUMN date TYPE DATE USING NULLIF(date, '')::date,
+        ALTER COLUMN times TYPE SMALLINT[] USING booking_hours(times),
+        ALTER COLUMN created_at TYPE TIMESTAMP USING NULLIF(created_at, '')::timestamp,
+        ALTER COLUMN paid_at TYPE TIMESTAMP USING NULLIF(paid_at, '')::timestamp
+    """
+    cur.execute(f"ALTER TABLE bookings {typed}")
+    cur.execute(
+        f"""
+        ALTER TABLE bookings_archive {typed},
+            ALTER COLUMN archived_at TYPE TIMESTAMP USING NULLIF(archived_at, '')::timestamp
+        """
+    )
+    for table in ("booking_daily_stats", "booking_hourly_stats"):
+        cur.execute(f"ALTER TABLE {table} ALTER COLUMN date TYPE DATE USING date::date")
+    cur.execute("DROP FUNCTION booking_hours(JSONB)")
+    cur.execute("DROP FUNCTION IF EXISTS booking_start_hour(JSONB)")
+
+    # Ключ постраничных админ-списков: (date, start_hour, id).
+    # start_hour — вычисляемая колонка, приложение её не пишет.
+    cur.execute(
+        """
+        CREATE OR REPLACE FUNCTION booking_start_hour(times SMALLINT[]) RETURNS INTEGER
+        LANGUAGE sql IMMUTABLE AS $$
+            SELECT COALESCE(min(hour), 0)::int FROM unnest(times) AS hour
+        $$
+        """
+    )
+    cur.execute(
+        """
+        ALTER TABLE bookings ADD COLUMN start_hour INTEGER
+            GENERATED ALWAYS AS (booking_start_hour(times)) STORED
+        """
+    )
+    cur.execute("CREATE INDEX bookings_listing_idx ON bookings (date, start_hour, id)")
+
+
+def _migrate_notification_flags(cur):
+    """Флаги отправленных напоминаний — раньше в БД они не сохранялись"""
+    cur.execute(
+        """
+        ALTER TABLE bookings
+            ADD COLUMN IF NOT EXISTS notified_24h BOOLEAN NOT NULL DEFAULT false,
+            ADD COLUMN IF NOT EXISTS notified_30m BOOLEAN NOT NULL DEFAULT false
+        """
+    )
+
+
+# Вторичные индексы броней: занятость по дате и услуге, брони клиента
+# по статусу, поиск по платежу ЮKassa, полный список по created_at
+_BOOKING_INDEXES = (
+    ("bookings_date_service_idx", "(date, service)"),
+    ("bookings_user_status_idx", "(user_id, status)"),
+    ("bookings_payment_id_idx", "(yookassa_payment_id) WHERE yookassa_payment_id IS NOT NULL"),
+    ("bookings_created_at_idx", "(created_at)"),
+)
+
+
+def _create_index_concurrently(cur, name, definition):
+    # Прерванный CREATE INDEX CONCURRENTLY оставляет невалидный индекс — его пересоздаём
+    cur.execute(
+        "SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s",
+        (name,),
+    )
+    row = cur.fetchone()
+    if row and row[0]:
+        return
+    if row:
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name}")
+    cur.execute(f"CREATE INDEX CONCURRENTLY {name} ON bookings {definition}")
+
+
+def _migrate_booking_indexes(cur):
+    """Индексы без блокировки записи (CONCURRENTLY, вне транзакции)"""
+    for name, definition in _BOOKING_INDEXES:
+        _create_index_concurrently(cur, name, definition)
+    # Покрыт индексом (user_id, status)
+    cur.execute("DROP INDEX CONCURRENTLY IF EXISTS bookings_user_id_idx")
+
+
+# Колонки времени броней, которые ранняя версия миграции typed_booking_columns
+# делала TIMESTAMPTZ
+_NAIVE_TIMESTAMP_COLUMNS = (
+    ("bookings", "created_at"), ("bookings", "paid_at"),
+    ("bookings_archive", "created_at"), ("bookings_archive", "paid_at"), ("bookings_archive", "archived_at"),
+)
+
+
+def _migrate_naive_timestamps(cur):
+    """TIMESTAMPTZ → TIMESTAMP для баз, где typed_booking_columns уже применена.
+
+    Приведение timestamptz → timestamp идёт в TimeZone сессии — той же зоне
+    сервера, в которой строки бота были прочитаны при записи, так что
+    возвращается исходное локальное время.
+    """
+    for table, column in _NAIVE_TIMESTAMP_COLUMNS:
+        cur.execute(
+            "SELECT data_type FROM information_schema.columns WHERE table_name = %s AND column_name = %s",
+            (table, column),
+        )
+        row = cur.fetchone()
+        if row and row[0] == "timestamp with time zone":
+            cur.execute(f"ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMP")
+
+
+# (версия, имя, функция, в одной транзакции ли). Порядок и номера не меняются:
+# новая миграция — новая строка в конце.
+MIGRATIONS = (
+    (1, "typed_booking_columns", _migrate_typed_columns, True),
+    (2, "booking_notification_flags", _migrate_notification_flags, True),
+    (3, "booking_indexes", _migrate_booking_indexes, False),
+    (4, "naive_booking_timestamps", _migrate_naive_timestamps, True),
+)
+
+
+def migrate(conn):
+    """Применение недостающих миграций; возвращает [(версия, имя, мс)].
+
+    Запуски нескольких экземпляров бота сериализуются advisory-локом.
+    Ошибка миграции прерывает цепочку: следующие зависят от предыдущих.
+    """
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute(
+        """
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            duration_ms INTEGER
+        )
+        """
+    )
+    cur.execute("SELECT pg_advisory_lock(hashtext('schema_migrations'))")
+    applied = []
+    try:
+        cur.execute("SELECT version FROM schema_migrations")
+        done = {row[0] for row in cur.fetchall()}
+        for version, name, func, transactional in MIGRATIONS:
+            if version in done:
+                continue
+            _log(f"[DB] ⏳ Миграция {version} ({name})...")
+            started = time.perf_counter()
+            cur.execute("SET lock_timeout = %s", (MIGRATION_LOCK_TIMEOUT,))
+            try:
+                conn.autocommit = not transactional
+                func(cur)
+                elapsed_ms = round((time.perf_counter() - started) * 1000)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name, duration_ms) VALUES (%s, %s, %s)",
+                    (version, name, elapsed_ms),
+                )
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                elapsed_ms = round((time.perf_counter() - started) * 1000)
+                _log(f"[DB] ❌ Миграция {version} ({name}) не применена за {elapsed_ms} мс: {e}")
+                raise
+            finally:
+                conn.autocommit = True
+                cur.execute("RESET lock_timeout")
+            _log(f"[DB] ✅ Миграция {version} ({name}) применена за {elapsed_ms} мс")
+            applied.append((version, name, elapsed_ms))
+            _applied_migrations.append((version, name, elapsed_ms))
+        if not applied:
+            _log(f"[DB] ✅ Схема актуальна (версия {max(v for v, *_ in MIGRATIONS)})")
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(hashtext('schema_migrations'))")
+        cur.close()
+    return applied
+
+
+@_instrumented
+def get_migrations():
+    """Применённые миграции: [{version, name, applied_at, duration_ms}]"""
     conn = _get_connection()
     if conn is None:
         return []
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("SELECT * FROM bookings ORDER BY created_at ASC")
-        rows = cur.fetchall()
+        cur.execute("SELECT version, name, applied_at, duration_ms FROM schema_migrations ORDER BY version")
+        rows = [_plain_row(row) for row in cur.fetchall()]
         cur.close()
         conn.close()
-        return [dict(row) for row in rows]
+        return rows
     except Exception:
         conn.close()
         raise
 
 
-def get_booking_by_id(booking_id):
+def _plain_value(value):
+    # DATE → YYYY-MM-DD, TIMESTAMP → ISO без зоны: в таком виде даты пишет бот
+    # (datetime.now().isoformat()) и хранят JSON-файлы. TIMESTAMPTZ остался
+    # только у служебных колонок (schema_migrations.applied_at)
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone().replace(tzinfo=None)
+        return value.isoformat()
+    if isinstance(value, _date):
+        return value.isoformat()
+    return value
+
+
+def _plain_row(row):
+    """Строка БД в формате бота: даты и время — строками"""
+    return {key: _plain_value(value) for key, value in row.items()}
+
+
+def _like_escape(value):
+    return value.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+
+@_instrumented
+def search_bookings(user_id=None, phone=None, text=None, limit=20):
+    """Поиск броней одним запросом по user_id, нормализованному телефону и имени/email.
+
+    phone — цифры в нормализованном виде, text — строка в нижнем регистре.
+    Условия объединяются через OR: планировщик собирает BitmapOr по индексам.
+    Ищем и в горячих бронях, и в архиве (у архивных archived = True).
+    """
     conn = _get_connection()
     if conn is None:
-        return None
+        return []
+    global _trgm_available
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("SELECT * FROM bookings WHERE id = %s", (booking_id,))
-        row = cur.fetchone()
+        if _trgm_available is None:
+            cur.execute("SELECT EXISTS (SELECT 1 FROM pg_extension WHERE extname = 'pg_trgm')")
+            _trgm_available = bool(cur.fetchone()["exists"])
+        wrap = (lambda v: f"%{_like_escape(v)}%") if _trgm_available else (lambda v: f"{_like_escape(v)}%")
+
+        conditions = []
+        params = {"limit": limit}
+        if user_id is not None:
+            conditions.append("user_id = %(user_id)s")
+            params["user_id"] = user_id
+        if phone:
+            conditions.append("phone_norm LIKE %(phone)s")
+            params["phone"] = wrap(phone)
+        if text:
+            conditions.append("lower(name) LIKE %(text)s OR lower(email) LIKE %(text)s")
+            params["text"] = wrap(text)
+        if not conditions:
+            cur.close()
+            conn.close()
+            return []
+
+        columns = ", ".join(BOOKING_COLUMNS)
+        where = " OR ".join(f"({c})" for c in conditions)
+        # Бронь, попавшая в архив и ещё не удалённая из горячей таблицы, — одна
+        cur.execute(
+            f"""
+            SELECT * FROM (
+                SELECT {columns}, false AS archived FROM bookings
+                WHERE {where}
+                UNION ALL
+                SELECT {columns}, true AS archived FROM bookings_archive a
+                WHERE ({where}) AND NOT EXISTS (SELECT 1 FROM bookings b WHERE b.id = a.id)
+            ) found
+            ORDER BY date DESC, id DESC
+            LIMIT %(limit)s
+            """,
+            params,
+        )
+        rows = [_plain_row(row) for row in cur.fetchall()]
         cur.close()
         conn.close()
-        return dict(row) if row else None
+        return rows
     except Exception:
         conn.close()
         raise
 
 
-def add_booking(booking):
+@_instrumented
+def get_all_bookings():
     conn = _get_connection()
     if conn is None:
-        return
+        return []
     try:
-        cur = conn.cursor()
-        cur.execute(
-            """
-            INSERT INTO bookings (
-                id, user_id, service, date, times, duration, name, email, phone,
-                comment, price, status, created_at, paid_at, yookassa_payment_id, payment_url
-            )
-            VALUES (%(id)s, %(user_id)s, %(service)s, %(date)s, %(times)s, %(duration)s,
-                    %(name)s, %(email)s, %(phone)s, %(comment)s, %(price)s, %(status)s,
-                    %(created_at)s, %(paid_at)s, %(yookassa_payment_id)s, %(payment_url)s)
-            ON CONFLICT (id) DO UPDATE SET
-                user_id = EXCLUDED.user_id,
-                service = EXCLUDED.service,
-                date = EXCLUDED.date,
-                times = EXCLUDED.times,
-                duration = EXCLUDED.duration,
-                name = EXCLUDED.name,
-                email = EXCLUDED.email,
-                phone = EXCLUDED.phone,
-                comment = EXCLUDED.comment,
-                price = EXCLUDED.price,
-                status = EXCLUDED.status,
-                created_at = EXCLUDED.created_at,
-                paid_at = EXCLUDED.paid_at,
-                yookassa_payment_id = EXCLUDED.yookassa_payment_id,
-                payment_url = EXCLUDED.payment_url
-            """,
-            {
-                **booking,
-                "times": psycopg2.extras.Json(booking.get("times", [])),
-            },
-        )
-        conn.commit()
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("SELECT * FROM bookings ORDER BY created_at ASC")
+        rows = cur.fetchall()
         cur.close()
         conn.close()
+        return [_plain_row(row) for row in rows]
     except Exception:
         conn.close()
         raise
 
 
-def save_bookings(bookings):
-    for booking in bookings:
-        add_booking(booking)
+_BOOKING_BY_ID = _statement(
+    "booking_by_id",
+    f"SELECT {', '.join(BOOKING_COLUMNS + BOOKING_FLAGS)} FROM bookings WHERE id = %(id)s",
+    [("id", "bigint")],
+)
 
 
-def cancel_booking(booking_id):
+@_instrumented
+def get_booking_by_id(booking_id):
     conn = _get_connection()
     if conn is None:
         return None
     try:
         cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute(
-            "UPDATE bookings SET status = 'cancelled' WHERE id = %s RETURNING *",
-            (booking_id,),
-        )
+        _execute(cur, _BOOKING_BY_ID, {"id": booking_id})
         row = cur.fetchone()
-        conn.commit()
         cur.close()
         conn.close()
-        return dict(row) if row else None
+        return _plain_row(row) if row else None
     except Exception:
         conn.close()
         raise
 
 
-def get_all_vip_users():
+_BOOKING_UPSERT = _statement(
+    "booking_upsert",
+    """
+    INSERT INTO bookings (
+        id, user_id, service, date, times, duration, name, email, phone,
+        comment, price, status, created_at, paid_at, yookassa_payment_id, payment_url
+    )
+    VALUES (%(id)s, %(user_id)s, %(service)s, %(date)s, %(times)s, %(duration)s,
+            %(name)s, %(email)s, %(phone)s, %(comment)s, %(price)s, %(status)s,
+            %(created_at)s, %(paid_at)s, %(yookassa_payment_id)s, %(payment_url)s)
+    ON CONFLICT (id) DO UPDATE SET
+        user_id = EXCLUDED.user_id,
+        service = EXCLUDED.service,
+        date = EXCLUDED.date,
+        times = EXCLUDED.times,
+        duration = EXCLUDED.duration,
+        name = EXCLUDED.name,
+        email = EXCLUDED.email,
+        phone = EXCLUDED.phone,
+        comment = EXCLUDED.comment,
+        price = EXCLUDED.price,
+        status = EXCLUDED.status,
+        created_at = EXCLUDED.created_at,
+        paid_at = EXCLUDED.paid_at,
+        yookassa_payment_id = EXCLUDED.yookassa_payment_id,
+        payment_url = EXCLUDED.payment_url
+    """,
+    [(col, BOOKING_TYPES[col]) for col in BOOKING_COLUMNS],
+)
+
+
+@_instrumented
+def add_booking(booking):
     conn = _get_connection()
     if conn is None:
-        return {}
+        return
     try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("SELECT * FROM vip_users")
-        rows = cur.fetchall()
+        cur = conn.cursor()
+        values = {col: booking.get(col) for col in BOOKING_COLUMNS}
+        values["times"] = list(booking.get("times") or [])
+        _execute(cur, _BOOKING_UPSERT, values)
+        conn.commit()
         cur.close()
         conn.close()
-        return {int(row["user_id"]): dict(row) for row in rows}
     except Exception:
         conn.close()
         raise
 
 
-def get_vip_user(user_id):
+# Занятость: отменённые брони часы не держат, неоплаченные — только созданные
+# после hold_since (пока клиент платит), а ещё без ссылки на оплату (ЮKassa
+# не ответила, ссылка отложена) — после link_wait_since.
+# date = ANY(...) AND service идёт по bookings_date_service_idx.
+_OCCUPIED = _statement(
+    "booked_slots",
+    """
+    SELECT date, times FROM bookings
+    WHERE date = ANY(%(dates)s::date[]) AND service = %(service)s
+      AND status <> 'cancelled'
+      AND (status <> 'awaiting_payment' OR created_at > %(hold_since)s
+           OR (payment_url IS NULL AND created_at > %(link_wait_since)s))
+    """,
+    [("dates", "date[]"), ("service", "text"), ("hold_since", "timestamp"), ("link_wait_since", "timestamp")],
+)
+
+
+def _occupied(cur, dates, service, hold_since, link_wait_since):
+    _execute(cur, _OCCUPIED, {
+        "dates": list(dates), "service": service,
+        "hold_since": hold_since, "link_wait_since": link_wait_since,
+    })
+    occupied = {date: set() for date in dates}
+    for day, times in cur.fetchall():
+        occupied[day.isoformat()].update(times or [])
+    return occupied
+
+
+@_instrumented
+def get_booked_slots(dates, service, hold_since=None, link_wait_since=None):
+    """Занятые часы по нескольким датам одним запросом: {date: set(часов)}.
+
+    hold_since — с какого created_at неоплаченная бронь держит часы,
+    link_wait_since — то же для брони, ещё ждущей ссылку (None — не держит).
+    """
     conn = _get_connection()
     if conn is None:
-        return None
+        return {date: set() for date in dates}
     try:
-        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
-        cur.execute("SELECT * FROM vip_users WHERE user_id = %s", (user_id,))
-        row = cur.fetchone()
+        cur = conn.cursor()
+        occupied = _occupied(cur, dates, service, hold_since, link_wait_since)
+        cur.close()
+        conn.close()
+        return occupied
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def add_bookings_atomic(bookings, hold_since=None, link_wait_since=None):
+    """Серия броней одной услуги одной транзакцией — все или ни одной.
+
+    Серии одной услуги сериализуются advisory-локом, занятость перепроверяется
+    внутри транзакции, неоплаченные брони держат часы как в get_booked_slots. Возвращает конфликты {date: занятые часы}; если они есть,
+    ничего не записывается.
+    """
+    conn = _get_connection()
+    if conn is None:
+        return {}
+    service = bookings[0]["service"]
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (f"bookings:{service}",))
+        occupied = _occupied(cur, [b["date"] for b in bookings], service, hold_since, link_wait_since)
+        conflicts = {}
+        for b in bookings:
+            busy = occupied[b["date"]] & set(b.get("times") or [])
+            if busy:
+                conflicts[b["date"]] = sorted(busy)
+        if conflicts:
+            conn.rollback()
+        else:
+            psycopg2.extras.execute_values(
+                cur,
+                f"INSERT INTO bookings ({', '.join(BOOKING_COLUMNS)}) VALUES %s",
+                [_row_values("bookings", b) for b in bookings],
+            )
+            conn.commit()
+        cur.close()
+        conn.close()
+        return conflicts
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def save_bookings(bookings):
+    # Одно соединение и пакетный upsert вместо соединения на каждую бронь
+    upsert_bookings(bookings)
+
+
+# ====== ПАКЕТНЫЕ ОПЕРАЦИИ ======================================================
+# Используются manage.py (импорт/экспорт) и save_bookings.
+
+_TABLES = {
+    "bookings": (BOOKING_COLUMNS, "id"),
+    "vip_users": (VIP_COLUMNS, "user_id"),
+    "vip_tiers": (VIP_TIER_COLUMNS, "name"),
+}
+
+_JSON_COLUMNS = {"prices"}
+_ARRAY_COLUMNS = {"times"}
+
+
+def _row_values(table, record):
+    """Значения записи в порядке колонок таблицы; prices -> JSONB, times -> SMALLINT[]"""
+    columns = _TABLES[table][0]
+    return tuple(
+        psycopg2.extras.Json(record.get(col) or {}) if col in _JSON_COLUMNS
+        else list(record.get(col) or []) if col in _ARRAY_COLUMNS
+        else record.get(col)
+        for col in columns
+    )
+
+
+def _copy_value(column, value):
+    # Значение для COPY в формате csv
+    if value is None:
+        return "\\N"
+    if column in _JSON_COLUMNS:
+        return json.dumps(value)
+    if column in _ARRAY_COLUMNS:
+        return "{" + ",".join(str(int(v)) for v in value) + "}"
+    return value
+
+
+def _upsert_sql(table, source):
+    columns, key = _TABLES[table]
+    updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in columns if c != key)
+    return f"INSERT INTO {table} ({', '.join(columns)}) {source} ON CONFLICT ({key}) DO UPDATE SET {updates}"
+
+
+def _upsert_rows(table, records, page_size):
+    conn = _get_connection()
+    if conn is None:
+        return 0
+    key = _TABLES[table][1]
+    # Повторы ключа в одном INSERT ... ON CONFLICT недопустимы — побеждает последняя запись
+    rows = list({record[key]: _row_values(table, record) for record in records}.values())
+    try:
+        cur = conn.cursor()
+        psycopg2.extras.execute_values(cur, _upsert_sql(table, "VALUES %s"), rows, page_size=page_size)
+        conn.commit()
+        cur.close()
+        conn.close()
+        return len(rows)
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented(retry=False)
+def upsert_bookings(bookings, page_size=1000):
+    """Пакетный upsert броней (execute_values); возвращает число строк"""
+    return _upsert_rows("bookings", bookings, page_size)
+
+
+@_instrumented(retry=False)
+def upsert_vip_users(vip_users, page_size=1000):
+    """Пакетный upsert VIP; vip_users — список словарей с user_id"""
+    return _upsert_rows("vip_users", vip_users, page_size)
+
+
+def _copy_upsert(table, batches):
+    """COPY пачек во временную таблицу и один INSERT ... ON CONFLICT в целевую.
+
+    Всё в одной транзакции. Возвращает (скопировано, записано, расхождений):
+    расхождения — строки staging, которые после слияния не совпали с таблицей.
+    """
+    conn = _get_connection()
+    if conn is None:
+        return 0, 0, 0
+    columns, key = _TABLES[table]
+    column_list = ", ".join(columns)
+    stage = f"{table}_import_stage"
+    copied = 0
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            f"CREATE TEMP TABLE {stage} (LIKE {table} INCLUDING DEFAULTS, import_seq BIGSERIAL) ON COMMIT DROP"
+        )
+        copy_sql = f"COPY {stage} ({column_list}) FROM STDIN WITH (FORMAT csv, NULL '\\N')"
+        for batch in batches:
+            buf = io.StringIO()
+            writer = csv.writer(buf)
+            for record in batch:
+                writer.writerow(_copy_value(col, record.get(col)) for col in columns)
+            buf.seek(0)
+            cur.copy_expert(copy_sql, buf)
+            copied += len(batch)
+
+        # Повторы ключа во входных данных: берём последнюю запись
+        cur.execute(
+            _upsert_sql(
+                table,
+                f"SELECT DISTINCT ON ({key}) {column_list} FROM {stage} ORDER BY {key}, import_seq DESC",
+            )
+        )
+        written = cur.rowcount
+        compared = [c for c in columns if c != key]
+        cur.execute(
+            f"""
+            SELECT count(*) FROM (
+                SELECT DISTINCT ON ({key}) * FROM {stage} ORDER BY {key}, import_seq DESC
+            ) s
+            LEFT JOIN {table} t ON t.{key} = s.{key}
+            WHERE t.{key} IS NULL
+               OR ({", ".join("s." + c for c in compared)}) IS DISTINCT FROM ({", ".join("t." + c for c in compared)})
+            """
+        )
+        mismatched = cur.fetchone()[0]
+        conn.commit()
+        cur.close()
+        conn.close()
+        return copied, written, mismatched
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+
+
+@_instrumented(retry=False)
+def copy_bookings(batches):
+    """Массовая загрузка броней через COPY; batches — итератор списков словарей"""
+    return _copy_upsert("bookings", batches)
+
+
+@_instrumented(retry=False)
+def copy_vip_users(batches):
+    """Массовая загрузка VIP через COPY"""
+    return _copy_upsert("vip_users", batches)
+
+
+def iter_rows(table, batch_size=2000, order_by=None):
+    """Потоковое чтение таблицы серверным курсором, по batch_size строк за раз"""
+    conn = _get_connection()
+    if conn is None:
+        return
+    try:
+        # Именованный курсор — строки не грузятся в память клиента целиком
+        cur = conn.cursor(name=f"iter_{table}", cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.itersize = batch_size
+        cur.execute(f"SELECT * FROM {table} ORDER BY {order_by or _TABLES[table][1]}")
+        for row in cur:
+            yield _plain_row(row)
+        cur.close()
+    finally:
+        conn.close()
+
+
+@_instrumented
+def count_rows(table):
+    conn = _get_connection()
+    if conn is None:
+        return 0
+    try:
+        cur = conn.cursor()
+        cur.execute(f"SELECT count(*) FROM {table}")
+        count = cur.fetchone()[0]
+        cur.close()
+        conn.close()
+        return count
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def get_bookings_page(statuses, date_from=None, date_to=None, cursor=None, backward=False, limit=5):
+    """Страница броней по индексу (date, start_hour, id).
+
+    cursor — ключ (date, start_hour, id), от которого листаем; backward — назад.
+    Возвращает (брони в прямом порядке, есть ли ещё в направлении листания).
+    """
+    conn = _get_connection()
+    if conn is None:
+        return [], False
+    op, order = ("<", "DESC") if backward else (">", "ASC")
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            f"""
+            SELECT * FROM bookings
+            WHERE status = ANY(%(statuses)s)
+              AND (%(date_from)s::date IS NULL OR date >= %(date_from)s)
+              AND (%(date_to)s::date IS NULL OR date <= %(date_to)s)
+              AND (%(cursor_date)s::date IS NULL OR (date, start_hour, id) {op} (%(cursor_date)s, %(cursor_hour)s, %(cursor_id)s))
+            ORDER BY date {order}, start_hour {order}, id {order}
+            LIMIT %(limit)s
+            """,
+            {
+                "statuses": list(statuses),
+                "date_from": date_from,
+                "date_to": date_to,
+                "cursor_date": cursor[0] if cursor else None,
+                "cursor_hour": cursor[1] if cursor else None,
+                "cursor_id": cursor[2] if cursor else None,
+                # Лишняя строка показывает, есть ли следующая страница
+                "limit": limit + 1,
+            },
+        )
+        rows = [_plain_row(row) for row in cur.fetchall()]
+        cur.close()
+        conn.close()
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if backward:
+            rows.reverse()
+        return rows, has_more
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def cancel_booking(booking_id):
+    conn = _get_connection()
+    if conn is None:
+        return None
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            "UPDATE bookings SET status = 'cancelled' WHERE id = %s RETURNING *",
+            (booking_id,),
+        )
+        row = cur.fetchone()
+        conn.commit()
+        cur.close()
+        conn.close()
+        return _plain_row(row) if row else None
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def set_booking_payment(booking_ids, payment_id, payment_url):
+    """Платёж и ссылка на оплату для броней серии одним UPDATE; число обновлённых строк"""
+    conn = _get_connection()
+    if conn is None:
+        return 0
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "UPDATE bookings SET yookassa_payment_id = %s, payment_url = %s WHERE id = ANY(%s)",
+            (payment_id, payment_url, list(booking_ids)),
+        )
+        updated = cur.rowcount
+        conn.commit()
+        cur.close()
+        conn.close()
+        return updated
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def set_booking_flag(booking_id, flag, value=True):
+    """Флаг напоминания одним UPDATE; True, если бронь найдена"""
+    if flag not in BOOKING_FLAGS:
+        raise ValueError(f"неизвестный флаг брони: {flag}")
+    conn = _get_connection()
+    if conn is None:
+        return False
+    try:
+        cur = conn.cursor()
+        cur.execute(f"UPDATE bookings SET {flag} = %s WHERE id = %s", (bool(value), booking_id))
+        updated = cur.rowcount > 0
+        conn.commit()
+        cur.close()
+        conn.close()
+        return updated
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def archive_bookings(before_date, cancelled_before):
+    """Перенос броней с датой раньше before_date и отменённых до cancelled_before в архив"""
+    conn = _get_connection()
+    if conn is None:
+        return 0
+    columns = ", ".join(BOOKING_COLUMNS)
+    try:
+        cur = conn.cursor()
+        # DELETE ... RETURNING и INSERT в одной транзакции: бронь не теряется и не дублируется.
+        # Если ID уже есть в архиве, архивная копия заменяется удаляемой строкой
+        updates = ", ".join(f"{c} = EXCLUDED.{c}" for c in BOOKING_COLUMNS[1:] + ("archived_at",))
+        cur.execute(
+            f"""
+            WITH moved AS (
+                DELETE FROM bookings
+                WHERE date < %(before_date)s
+                   OR (status = 'cancelled' AND created_at < %(cancelled_before)s)
+                RETURNING {columns}
+            )
+            INSERT INTO bookings_archive ({columns}, archived_at)
+            SELECT {columns}, %(archived_at)s FROM moved
+            ON CONFLICT (id) DO UPDATE SET {updates}
+            """,
+            {
+                "before_date": before_date,
+                "cancelled_before": cancelled_before,
+                "archived_at": datetime.now().isoformat(),
+            },
+        )
+        moved = cur.rowcount
+        conn.commit()
+        cur.close()
+        conn.close()
+        return moved
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def get_archived_bookings(date_from=None, date_to=None):
+    """Брони из архива за период [date_from, date_to] (границы включительно)"""
+    conn = _get_connection()
+    if conn is None:
+        return []
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute(
+            f"""
+            SELECT {", ".join(BOOKING_COLUMNS)} FROM bookings_archive
+            WHERE (%(date_from)s::date IS NULL OR date >= %(date_from)s)
+              AND (%(date_to)s::date IS NULL OR date <= %(date_to)s)
+            ORDER BY date ASC, id ASC
+            """,
+            {"date_from": date_from, "date_to": date_to},
+        )
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+        return [_plain_row(row) for row in rows]
+    except Exception:
+        conn.close()
+        raise
+
+
+# Брони из горячей таблицы и архива без дублей — источник для агрегатов
+_HISTORY_SQL = """
+    SELECT date, service, status, times, price FROM bookings
+    WHERE (%(dates)s::date[] IS NULL OR date = ANY(%(dates)s::date[]))
+    UNION ALL
+    SELECT date, service, status, times, price FROM bookings_archive a
+    WHERE (%(dates)s::date[] IS NULL OR date = ANY(%(dates)s::date[]))
+      AND NOT EXISTS (SELECT 1 FROM bookings b WHERE b.id = a.id)
+"""
+
+
+@_instrumented
+def refresh_booking_stats(dates=None):
+    """Пересчёт агрегатов за даты dates (None — за всё время) в одной транзакции"""
+    conn = _get_connection()
+    if conn is None:
+        return
+    params = {"dates": list(dates) if dates is not None else None}
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            "DELETE FROM booking_daily_stats WHERE %(dates)s::date[] IS NULL OR date = ANY(%(dates)s::date[])",
+            params,
+        )
+        cur.execute(
+            f"""
+            INSERT INTO booking_daily_stats (date, service, status, bookings, hours, revenue)
+            SELECT date, COALESCE(service, ''), COALESCE(status, ''), count(*),
+                   COALESCE(sum(cardinality(times)), 0),
+                   COALESCE(sum(price), 0)
+            FROM ({_HISTORY_SQL}) h
+            GROUP BY 1, 2, 3
+            """,
+            params,
+        )
+        cur.execute(
+            "DELETE FROM booking_hourly_stats WHERE %(dates)s::date[] IS NULL OR date = ANY(%(dates)s::date[])",
+            params,
+        )
+        cur.execute(
+            f"""
+            INSERT INTO booking_hourly_stats (date, hour, hours)
+            SELECT h.date, t.hour, count(*)
+            FROM ({_HISTORY_SQL}) h, unnest(h.times) AS t(hour)
+            WHERE h.status = 'paid'
+            GROUP BY 1, 2
+            """,
+            params,
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception:
+        conn.rollback()
+        conn.close()
+        raise
+
+
+@_instrumented
+def get_booking_stats(date_from, date_to):
+    """Агрегаты за период: (дневные строки, почасовые строки)"""
+    conn = _get_connection()
+    if conn is None:
+        return [], []
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        params = {"date_from": date_from, "date_to": date_to}
+        cur.execute(
+            """
+            SELECT date, service, status, bookings, hours, revenue FROM booking_daily_stats
+            WHERE date BETWEEN %(date_from)s AND %(date_to)s
+            """,
+            params,
+        )
+        daily = [_plain_row(row) for row in cur.fetchall()]
+        cur.execute(
+            "SELECT date, hour, hours FROM booking_hourly_stats WHERE date BETWEEN %(date_from)s AND %(date_to)s",
+            params,
+        )
+        hourly = [_plain_row(row) for row in cur.fetchall()]
+        cur.close()
+        conn.close()
+        return daily, hourly
+    except Exception:
+        conn.close()
+        raise
+
+
+def iter_booking_history(date_from=None, date_to=None, batch_size=2000):
+    """Брони из bookings и bookings_archive за период серверным курсором, по дате"""
+    conn = _get_connection()
+    if conn is None:
+        return
+    columns = ", ".join(BOOKING_COLUMNS)
+    try:
+        # Именованный курсор: клиент держит в памяти не больше batch_size строк
+        cur = conn.cursor(name="iter_booking_history", cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.itersize = batch_size
+        cur.execute(
+            f"""
+            SELECT {columns} FROM (
+                SELECT {columns} FROM bookings
+                UNION ALL
+                SELECT {columns} FROM bookings_archive a
+                WHERE NOT EXISTS (SELECT 1 FROM bookings b WHERE b.id = a.id)
+            ) history
+            WHERE (%(date_from)s::date IS NULL OR date >= %(date_from)s)
+              AND (%(date_to)s::date IS NULL OR date <= %(date_to)s)
+            ORDER BY date ASC, id ASC
+            """,
+            {"date_from": date_from, "date_to": date_to},
+        )
+        for row in cur:
+            yield _plain_row(row)
+        cur.close()
+    finally:
+        conn.close()
+
+
+@_instrumented
+def get_all_vip_users():
+    conn = _get_connection()
+    if conn is None:
+        return {}
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("SELECT * FROM vip_users")
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+        return {int(row["user_id"]): dict(row) for row in rows}
+    except Exception:
+        conn.close()
+        raise
+
+
+_VIP_BY_USER_ID = _statement(
+    "vip_by_user_id",
+    f"SELECT {', '.join(VIP_COLUMNS)} FROM vip_users WHERE user_id = %(user_id)s",
+    [("user_id", "bigint")],
+)
+
+
+@_instrumented
+def get_vip_user(user_id):
+    conn = _get_connection()
+    if conn is None:
+        return None
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        _execute(cur, _VIP_BY_USER_ID, {"user_id": user_id})
+        row = cur.fetchone()
         cur.close()
         conn.close()
         return dict(row) if row else None
@@ -272,6 +1617,7 @@ def get_vip_user(user_id):
         raise
 
 
+@_instrumented
 def save_vip_users(vip_users):
     if not is_enabled():
         _log("[DB] save_vip_users: БД не включена, пропускаю")
@@ -282,6 +1628,7 @@ def save_vip_users(vip_users):
     _log(f"[DB] ✅ {len(vip_users)} VIP пользователей сохранено в БД")
 
 
+@_instrumented
 def upsert_vip_user(user_id, data):
     conn = _get_connection()
     if conn is None:
@@ -290,18 +1637,20 @@ def upsert_vip_user(user_id, data):
         cur = conn.cursor()
         cur.execute(
             """
-            INSERT INTO vip_users (user_id, name, discount, custom_price_repet)
-            VALUES (%s, %s, %s, %s)
+            INSERT INTO vip_users (user_id, name, discount, custom_price_repet, tier)
+            VALUES (%s, %s, %s, %s, %s)
             ON CONFLICT (user_id) DO UPDATE SET
                 name = EXCLUDED.name,
                 discount = EXCLUDED.discount,
-                custom_price_repet = EXCLUDED.custom_price_repet
+                custom_price_repet = EXCLUDED.custom_price_repet,
+                tier = EXCLUDED.tier
             """,
             (
                 int(user_id),
                 data.get("name"),
                 data.get("discount"),
                 data.get("custom_price_repet"),
+                data.get("tier"),
             ),
         )
         conn.commit()
@@ -312,6 +1661,7 @@ def upsert_vip_user(user_id, data):
         raise
 
 
+@_instrumented
 def remove_vip_user(user_id):
     conn = _get_connection()
     if conn is None:
@@ -327,5 +1677,123 @@ def remove_vip_user(user_id):
         raise
 
 
+@_instrumented
+def get_vip_tiers():
+    """Уровни VIP: {name: {'discount', 'prices'}}"""
+    conn = _get_connection()
+    if conn is None:
+        return {}
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("SELECT * FROM vip_tiers")
+        rows = cur.fetchall()
+        cur.close()
+        conn.close()
+        return {row["name"]: {"discount": row["discount"], "prices": row["prices"] or {}} for row in rows}
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def upsert_vip_tiers(tiers, page_size=1000):
+    """Пакетный upsert уровней; tiers — список словарей с name"""
+    return _upsert_rows("vip_tiers", tiers, page_size)
+
+
+@_instrumented
+def get_customer_profile(user_id):
+    conn = _get_connection()
+    if conn is None:
+        return None
+    try:
+        cur = conn.cursor(cursor_factory=psycopg2.extras.RealDictCursor)
+        cur.execute("SELECT * FROM customer_profiles WHERE user_id = %s", (user_id,))
+        row = cur.fetchone()
+        cur.close()
+        conn.close()
+        return dict(row) if row else None
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def upsert_customer_profile(user_id, profile):
+    conn = _get_connection()
+    if conn is None:
+        return
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO customer_profiles (user_id, name, email, phone, updated_at)
+            VALUES (%s, %s, %s, %s, %s)
+            ON CONFLICT (user_id) DO UPDATE SET
+                name = EXCLUDED.name,
+                email = EXCLUDED.email,
+                phone = EXCLUDED.phone,
+                updated_at = EXCLUDED.updated_at
+            """,
+            (
+                int(user_id),
+                profile.get("name"),
+                profile.get("email"),
+                profile.get("phone"),
+                profile.get("updated_at"),
+            ),
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception:
+        conn.close()
+        raise
+
+
 def is_vip_user(user_id):
     return get_vip_user(user_id) is not None
+
+
+@_instrumented
+def get_state(key):
+    """Значение из bot_state или None"""
+    conn = _get_connection()
+    if conn is None:
+        return None
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT value FROM bot_state WHERE key = %s", (key,))
+        row = cur.fetchone()
+        cur.close()
+        conn.close()
+        return row[0] if row else None
+    except Exception:
+        conn.close()
+        raise
+
+
+@_instrumented
+def set_state(key, value):
+    """Запись значения в bot_state (upsert)"""
+    conn = _get_connection()
+    if conn is None:
+        return
+    try:
+        cur = conn.cursor()
+        cur.execute(
+            """
+            INSERT INTO bot_state (key, value, updated_at)
+            VALUES (%s, %s, %s)
+            ON CONFLICT (key) DO UPDATE SET
+                value = EXCLUDED.value,
+                updated_at = EXCLUDED.updated_at
+            """,
+            (key, psycopg2.extras.Json(value), datetime.now().isoformat()),
+        )
+        conn.commit()
+        cur.close()
+        conn.close()
+    except Exception:
+        conn.close()
+        raise
@@ -1,36 +1,44 @@
+import time
+# Отсчёт для отчёта о времени запуска — до самых тяжёлых импортов
+_BOOT_STARTED = time.perf_counter()
+
 import telebot
 from telebot import types
 import json
+import html
 import os
 from datetime import datetime, timedelta
 import sys
-import traceback
 import re
 import requests
 import uuid
 import base64
-import time
+import contextlib
+import atexit
+import collections
+import concurrent.futures
+import bisect
+import shutil
+import tempfile
 import threading
+import gzip
 from flask import Flask, request
 from urllib.parse import quote_plus
-
-# Проверка и установка psycopg2-binary если нужно
-try:
-    import psycopg2
-except ImportError:
-    print("[STARTUP] ⚠️ psycopg2 не найден, пытаюсь установить...", flush=True)
-    import subprocess
-    try:
-        subprocess.check_call([sys.executable, "-m", "pip", "install", "psycopg2-binary==2.9.9", "--quiet", "--no-cache-dir"],
-                            stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, timeout=60)
-        print("[STARTUP] ✅ psycopg2-binary установлен", flush=True)
-        import psycopg2
-    except Exception as e:
-        print(f"[STARTUP] ❌ Не удалось установить psycopg2-binary: {e}", flush=True)
-        print("[STARTUP] 💡 Будет использоваться файловое хранилище", flush=True)
+from telebot import apihelper
+from telebot.handler_backends import BaseMiddleware, CancelUpdate
 
 # Импорт модуля для работы с PostgreSQL
 import database
+import admission
+import analytics
+import async_runtime
+import booking_cache
+import booking_model
+import circuit_breaker
+import metrics
+import reports
+import structured_log
+import vip_rules
 
 # ====== КОНФИГУРАЦИЯ ======================================================
 
@@ -40,6 +48,19 @@ CURRENCY = "RUB"
 # Конфигурация ЮKassa API
 YOOKASSA_SHOP_ID = os.environ.get("YOOKASSA_SHOP_ID", "")
 YOOKASSA_SECRET_KEY = os.environ.get("YOOKASSA_SECRET_KEY", "")
+# Базовый URL API ЮKassa (переопределяется для нагрузочных тестов с фейковым сервером)
+YOOKASSA_API_URL = os.environ.get("YOOKASSA_API_URL", "https://api.yookassa.ru/v3").rstrip("/")
+# HTTP-транспорт запросов к ЮKassa: requests.request(method, url, **kwargs).
+# В режиме BOT_RUNTIME=asyncio его подменяет общая aiohttp-сессия (async_runtime.py)
+yookassa_http = requests.request
+# Таймаут запросов к ЮKassa и выключатель: при сбоях API запросы сразу
+# получают отказ, а не держат поток обработчика до таймаута
+YOOKASSA_TIMEOUT = float(os.environ.get("YOOKASSA_TIMEOUT", "10"))
+YOOKASSA_BREAKER = circuit_breaker.CircuitBreaker(
+    "yookassa",
+    slow_seconds=float(os.environ.get("YOOKASSA_SLOW_SECONDS", "3")),
+    open_seconds=float(os.environ.get("YOOKASSA_BREAKER_OPEN_SECONDS", "30")),
+)
 
 # Информация о студии
 STUDIO_NAME = "MACHATA studio"
@@ -59,9 +80,49 @@ ADMIN_CHAT_ID = int(os.environ.get("ADMIN_CHAT_ID", "0"))
 
 # Файл для хранения VIP пользователей
 VIP_USERS_FILE = 'vip_users.json'
+# Уровни VIP (скидка и цены за час по услугам) — файловый бэкенд
+VIP_TIERS_FILE = 'vip_tiers.json'
+# Предел размера CSV для импорта VIP через бота
+VIP_IMPORT_MAX_BYTES = 1024 * 1024
+
+# Архив прошедших и отменённых броней (файловый бэкенд): по gzip-файлу JSONL на месяц
+ARCHIVE_DIR = 'machata_archive'
+# Отменённые брони уходят в архив не сразу: за это время ещё может прийти вебхук оплаты
+ARCHIVE_CANCELLED_AFTER_DAYS = 1
+ARCHIVE_INTERVAL = 6 * 3600  # 6 часов
+
+# Сохранённые контактные данные клиентов (файловый бэкенд)
+PROFILES_FILE = 'machata_profiles.json'
+
+# Агрегаты для статистики (файловый бэкенд) и период их пересчёта
+STATS_FILE = 'machata_stats.json'
+STATS_REFRESH_INTERVAL = 10  # секунды
+
+# Постраничные админ-списки броней
+ADMIN_PAGE_SIZE = 5
+ADMIN_PAGE_CACHE_TTL = 15  # секунды
+ACTIVE_STATUSES = ('paid', 'pending', 'awaiting_payment')
+
+# Обработанные update_id: защита от повторной доставки апдейтов после рестарта
+PROCESSED_UPDATES_FILE = 'machata_processed_updates.json'
+PROCESSED_UPDATES_LIMIT = 5000
+PROCESSED_UPDATES_FLUSH_INTERVAL = 1  # секунды
+
+# Брони, для которых ЮKassa не выдала ссылку: бронь держится, ссылка придёт позже
+PENDING_PAYMENTS_FILE = 'machata_pending_payments.json'
+PENDING_PAYMENTS_RETRY_INTERVAL = 15  # секунды
+PENDING_PAYMENTS_MAX_AGE = 2 * 3600  # после этого бронь снимается
+
+# Сколько неоплаченная бронь держит свои часы: пока клиент платит, их не займёт другой
+PAYMENT_HOLD_MINUTES = int(os.environ.get("PAYMENT_HOLD_MINUTES", "30"))
+
+# Потоки, создающие платежи ЮKassa вне обработчиков апдейтов
+PAYMENT_WORKERS = int(os.environ.get("PAYMENT_WORKERS", "8"))
 
 # VIP пользователи (загружаются из файла)
 VIP_USERS = {}
+# Уровни VIP: {name: {'discount': %, 'prices': {услуга: ₽/ч}}}
+VIP_TIERS = {}
 
 # Конфигурация по умолчанию
 DEFAULT_CONFIG = {
@@ -75,7 +136,7 @@ DEFAULT_CONFIG = {
 }
 
 # Инициализация бота
-bot = telebot.TeleBot(API_TOKEN, threaded=True, parse_mode='HTML')
+bot = telebot.TeleBot(API_TOKEN, threaded=True, parse_mode='HTML', use_class_middlewares=True)
 user_states = {}
 
 # Кэш для конфигурации
@@ -83,21 +144,206 @@ _config_cache = None
 _config_cache_time = None
 CACHE_TTL = 300  # 5 минут
 
+# Сериализует read-modify-write файла броней между потоками обработчиков
+_bookings_file_lock = threading.RLock()
+# Разобранные брони файлового режима: ((mtime_ns, размер), кортеж Booking)
+_booking_models = (None, ())
+# Брони по ID для деталей, проверки оплаты и отмены (см. get_booking)
+BOOKING_CACHE_SIZE = int(os.environ.get("BOOKING_CACHE_SIZE", "1024"))
+BOOKING_CACHE_TTL = float(os.environ.get("BOOKING_CACHE_TTL", "300"))
+_booking_cache = booking_cache.VersionedLRU(BOOKING_CACHE_SIZE, ttl=BOOKING_CACHE_TTL)
+
+# Контроль допуска callback-кнопок (см. AdmissionMiddleware): на чат — ведро
+# из ADMISSION_BURST нажатий, пополняемое по ADMISSION_RATE в секунду;
+# тяжёлых обработчиков одновременно — не больше MAX_CONCURRENT_CALLBACKS
+ADMISSION_RATE = float(os.environ.get("ADMISSION_RATE", "2"))
+ADMISSION_BURST = float(os.environ.get("ADMISSION_BURST", "8"))
+MAX_CONCURRENT_CALLBACKS = int(os.environ.get("MAX_CONCURRENT_CALLBACKS", "16"))
+# Кнопки, каждое нажатие которых читает все брони или идёт в ЮKassa, и их цена в токенах
+HEAVY_CALLBACK_COSTS = {'timeAdd': 1, 'dates_page': 1, 'check_payment': 3}
+_callback_buckets = admission.TokenBuckets(ADMISSION_RATE, ADMISSION_BURST)
+_callback_slots = admission.ConcurrencyLimiter(MAX_CONCURRENT_CALLBACKS)
+
 # ====== ЛОГИРОВАНИЕ ======================================================
 
-def log_info(msg):
+# Запись, форматирование и flush выполняются фоновым потоком structured_log.
+# Для дорогих сообщений передавай аргументы отдельно: log_debug("x=%s", x) —
+# при выключенном уровне строка даже не форматируется.
+
+def log_debug(msg, *args, sample_every=1, **fields):
+    """Отладочное логирование (sample_every=N — писать каждую N-ю запись)"""
+    structured_log.debug(msg, *args, sample_every=sample_every, **fields)
+
+def log_info(msg, *args, **fields):
     """Информационное логирование"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] ℹ️ INFO: {msg}")
-    sys.stdout.flush()
+    structured_log.info(msg, *args, **fields)
 
-def log_error(msg, exc=None):
+def log_error(msg, exc=None, **fields):
     """Логирование ошибок"""
-    timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    print(f"[{timestamp}] ❌ ERROR: {msg}", file=sys.stderr)
-    if exc:
-        print(traceback.format_exc(), file=sys.stderr)
-    sys.stderr.flush()
+    structured_log.error(msg, exc=exc is not None, **fields)
+
+# ====== МЕТРИКИ ==========================================================
+
+HANDLER_SECONDS = metrics.histogram(
+    "machata_handler_duration_seconds",
+    "Время работы обработчиков (callback по префиксу, сообщения по шагу)",
+    ("kind", "handler"),
+)
+HANDLER_ERRORS = metrics.counter(
+    "machata_handler_errors_total",
+    "Исключения в обработчиках",
+    ("kind", "handler"),
+)
+TELEGRAM_API_SECONDS = metrics.histogram(
+    "machata_telegram_api_duration_seconds",
+    "Время запросов к Telegram Bot API",
+    ("method",),
+)
+TELEGRAM_API_ERRORS = metrics.counter(
+    "machata_telegram_api_errors_total",
+    "Ошибки запросов к Telegram Bot API",
+    ("method",),
+)
+YOOKASSA_SECONDS = metrics.histogram(
+    "machata_yookassa_request_duration_seconds",
+    "Время запросов к API ЮKassa",
+    ("operation",),
+)
+YOOKASSA_ERRORS = metrics.counter(
+    "machata_yookassa_errors_total",
+    "Неуспешные запросы к API ЮKassa",
+    ("operation",),
+)
+YOOKASSA_REJECTED = metrics.counter(
+    "machata_yookassa_rejected_total",
+    "Запросы к ЮKassa, отклонённые разомкнутым выключателем",
+    ("operation",),
+)
+metrics.gauge(
+    "machata_circuit_breaker_state",
+    "Состояние выключателя: 0 — замкнут, 1 — пробный вызов, 2 — разомкнут",
+    lambda: {YOOKASSA_BREAKER.name: circuit_breaker.STATE_VALUES[YOOKASSA_BREAKER.state]},
+    ("breaker",),
+)
+BOOKING_CACHE_REQUESTS = metrics.counter(
+    "machata_booking_cache_requests_total",
+    "Чтения брони по ID: попадания и промахи кэша",
+    ("result",),
+)
+ADMISSION_SHED = metrics.counter(
+    "machata_admission_shed_total",
+    "Нажатия кнопок, отклонённые контролем допуска",
+    ("reason", "handler"),
+)
+metrics.gauge("machata_admission_in_flight", "Тяжёлые callback-обработчики в работе", lambda: _callback_slots.in_flight)
+metrics.gauge("machata_admission_tracked_chats", "Чаты с ведром токенов", lambda: len(_callback_buckets))
+metrics.gauge("machata_booking_cache_entries", "Брони в кэше по ID", lambda: len(_booking_cache))
+metrics.gauge("machata_pending_payment_links", "Брони, ждущие ссылку на оплату", lambda: len(_pending_payments))
+metrics.gauge("machata_user_states", "Количество активных диалогов в user_states", lambda: len(user_states))
+metrics.gauge(
+    "machata_queue_depth",
+    "Глубина очередей задач",
+    lambda: {
+        'log_writer': structured_log.queue_size(),
+        **({'telebot_workers': bot.worker_pool.tasks.qsize()} if bot.threaded and bot.worker_pool else {}),
+        'payments': _payment_executor._work_queue.qsize(),
+    },
+    ("queue",),
+)
+
+# Команды, которые попадают в метки как есть; остальные схлопываются в 'command'
+_KNOWN_COMMANDS = {'start', 'admin', 'setadmin'}
+# Всё, начиная с первой цифры (ID брони, час, дата, страница), из метки отбрасывается
+_CALLBACK_SUFFIX_RE = re.compile(r'[_-]?\d.*$')
+
+
+def handler_label(update):
+    """Метка обработчика с ограниченной кардинальностью"""
+    if isinstance(update, types.CallbackQuery):
+        return 'callback', _CALLBACK_SUFFIX_RE.sub('', update.data or '') or 'empty'
+    text = update.text or ''
+    if text.startswith('/'):
+        command = text[1:].split()[0].split('@')[0] if len(text) > 1 else ''
+        return 'message', f"/{command}" if command in _KNOWN_COMMANDS else 'command'
+    state = user_states.get(update.chat.id) or {}
+    return 'message', state.get('step') or state.get('admin_step') or 'text'
+
+
+class MetricsMiddleware(BaseMiddleware):
+    """Замер времени работы каждого обработчика"""
+
+    def __init__(self):
+        self.update_types = ['message', 'callback_query']
+
+    def pre_process(self, update, data):
+        # Метку считаем до обработчика: он может сменить шаг в user_states
+        data['metrics_label'] = handler_label(update)
+        data['metrics_started'] = time.perf_counter()
+
+    def post_process(self, update, data, exception):
+        label = data.get('metrics_label')
+        if label is None:
+            return
+        HANDLER_SECONDS.observe(time.perf_counter() - data['metrics_started'], *label)
+        if exception is not None:
+            HANDLER_ERRORS.inc(*label)
+            log_error(f"Ошибка в обработчике {label[0]}:{label[1]}: {exception}")
+
+
+class AdmissionMiddleware(BaseMiddleware):
+    """Сброс нагрузки от частых нажатий кнопок.
+
+    Стоит первым: отклонённое нажатие получает короткий ответ и не доходит
+    ни до обработчика, ни до остальных middleware.
+    """
+
+    def __init__(self):
+        self.update_types = ['callback_query']
+
+    def pre_process(self, call, data):
+        handler = handler_label(call)[1]
+        cost = HEAVY_CALLBACK_COSTS.get(handler)
+        reason = None
+        if not is_admin(call.from_user.id) and not _callback_buckets.allow(call.from_user.id, cost or 1):
+            reason = 'rate'
+        elif cost is not None:
+            if _callback_slots.try_acquire():
+                data['admission_slot'] = True
+            else:
+                reason = 'concurrency'
+        if reason is None:
+            return None
+        ADMISSION_SHED.inc(reason, handler)
+        try:
+            bot.answer_callback_query(call.id, "⏳ Слишком часто, подожди пару секунд")
+        except Exception as e:
+            log_error(f"Не удалось ответить на отклонённое нажатие: {e}")
+        return CancelUpdate()
+
+    def post_process(self, call, data, exception):
+        if data.pop('admission_slot', False):
+            _callback_slots.release()
+
+
+bot.setup_middleware(AdmissionMiddleware())
+bot.setup_middleware(MetricsMiddleware())
+
+_telegram_make_request = apihelper._make_request
+
+
+def _timed_make_request(token, method_name, method='get', params=None, files=None):
+    """Обёртка над запросами telebot к Bot API для замера задержек"""
+    started = time.perf_counter()
+    try:
+        return _telegram_make_request(token, method_name, method, params=params, files=files)
+    except Exception:
+        TELEGRAM_API_ERRORS.inc(method_name)
+        raise
+    finally:
+        TELEGRAM_API_SECONDS.observe(time.perf_counter() - started, method_name)
+
+
+apihelper._make_request = _timed_make_request
 
 # ====== РАБОТА С ФАЙЛАМИ =================================================
 
@@ -109,7 +355,7 @@ def load_config():
     if _config_cache and _config_cache_time and (now - _config_cache_time).seconds < CACHE_TTL:
         # Проверяем и исправляем цену репетиции в кэше
         if _config_cache.get('prices', {}).get('repet') != 700:
-            log_info("Обнаружена неправильная цена репетиции в кэше, исправляем")
+            log_debug("Обнаружена неправильная цена репетиции в кэше, исправляем")
             if 'prices' not in _config_cache:
                 _config_cache['prices'] = {}
             _config_cache['prices']['repet'] = 700
@@ -126,11 +372,12 @@ def load_config():
                 _config_cache = data
                 _config_cache_time = now
                 # Логируем загруженные цены для отладки
-                log_info(f"Конфиг загружен: repet={data.get('prices', {}).get('repet', 'N/A')}, studio={data.get('prices', {}).get('studio', 'N/A')}, full={data.get('prices', {}).get('full', 'N/A')}")
+                log_debug("Конфиг загружен: repet=%s, studio=%s, full=%s",
+                          data['prices'].get('repet', 'N/A'), data['prices'].get('studio', 'N/A'), data['prices'].get('full', 'N/A'))
                 return data
         _config_cache = DEFAULT_CONFIG
         _config_cache_time = now
-        log_info(f"Используется DEFAULT_CONFIG: repet={DEFAULT_CONFIG.get('prices', {}).get('repet', 'N/A')}")
+        log_debug("Используется DEFAULT_CONFIG: repet=%s", DEFAULT_CONFIG['prices'].get('repet', 'N/A'))
         return DEFAULT_CONFIG
     except Exception as e:
         log_error(f"load_config: {str(e)}", e)
@@ -155,48 +402,500 @@ def load_bookings():
         return []
 
 
+def load_booking_models():
+    """Брони как booking_model.Booking (только для чтения).
+
+    В файловом режиме разобранный список держится до изменения файла,
+    и повторные просмотры не разбирают даты и часы заново.
+    """
+    global _booking_models
+    if database.is_enabled():
+        return [booking_model.Booking.from_dict(b) for b in load_bookings()]
+    try:
+        st = os.stat(BOOKINGS_FILE)
+    except OSError:
+        return ()
+    key = (st.st_mtime_ns, st.st_size)
+    cached_key, models = _booking_models
+    if cached_key == key:
+        return models
+    models = tuple(booking_model.Booking.from_dict(b) for b in load_bookings())
+    _booking_models = (key, models)
+    return models
+
+
 def save_bookings(bookings):
     """Сохранение броней"""
+    global _booking_models
+    invalidate_booking_pages()
+    _booking_models = (None, ())
     if database.is_enabled():
         try:
             database.save_bookings(bookings)
+            invalidate_booking_cache()
             return
         except Exception as e:
             log_error(f"save_bookings (db): {str(e)}", e)
 
     try:
-        with open(BOOKINGS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(bookings, f, ensure_ascii=False, indent=2)
+        # Пишем во временный файл и атомарно подменяем: читатель никогда
+        # не увидит наполовину записанный JSON
+        tmp_path = f"{BOOKINGS_FILE}.{threading.get_ident()}.tmp"
+        with _bookings_file_lock:
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(bookings, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, BOOKINGS_FILE)
     except Exception as e:
         log_error(f"save_bookings: {str(e)}", e)
+    invalidate_booking_cache()
 
 
 def add_booking(booking):
     """Добавление брони"""
+    invalidate_booking_pages()
+    mark_stats_dirty(booking.get('date'))
     if database.is_enabled():
         database.add_booking(booking)
+        invalidate_booking_cache(booking.get('id'))
         log_info(f"Бронь добавлена (db): ID={booking.get('id')}")
         return
 
-    bookings = load_bookings()
-    bookings.append(booking)
-    save_bookings(bookings)
+    with _bookings_file_lock:
+        bookings = load_bookings()
+        bookings.append(booking)
+        save_bookings(bookings)
     log_info(f"Бронь добавлена: ID={booking.get('id')}")
 
 
+def set_booking_flag(booking_id, flag, value=True):
+    """Пометка брони (notified_24h и т. п.)"""
+    if database.is_enabled():
+        try:
+            database.set_booking_flag(booking_id, flag, value)
+        except Exception as e:
+            log_error(f"set_booking_flag (db): {str(e)}", e)
+        invalidate_booking_cache(booking_id)
+        return
+
+    with _bookings_file_lock:
+        bookings = load_bookings()
+        for b in bookings:
+            if b.get('id') == booking_id:
+                b[flag] = value
+                save_bookings(bookings)
+                break
+
+
 def cancel_booking_by_id(booking_id):
     """Отмена брони по ID"""
+    invalidate_booking_pages()
     if database.is_enabled():
-        return database.cancel_booking(booking_id)
+        cancelled = database.cancel_booking(booking_id)
+        invalidate_booking_cache(booking_id)
+        if cancelled:
+            mark_stats_dirty(cancelled.get('date'))
+        return cancelled
 
-    bookings = load_bookings()
-    for b in bookings:
-        if b.get('id') == booking_id:
-            b['status'] = 'cancelled'
-            save_bookings(bookings)
-            return b
+    with _bookings_file_lock:
+        bookings = load_bookings()
+        for b in bookings:
+            if b.get('id') == booking_id:
+                b['status'] = 'cancelled'
+                save_bookings(bookings)
+                mark_stats_dirty(b.get('date'))
+                return b
     return None
 
+# ====== БРОНЬ ПО ID ======================================================
+
+# Детали брони, проверка оплаты и отмена читают одну бронь по ID, а клиенты
+# много раз переходят между «Моими бронированиями» и деталями. Бронь берётся
+# из LRU-кэша; запись в хранилище сбрасывает её (invalidate_booking_cache)
+# уже после изменения, так что чтение во время записи не закэширует старое.
+
+def _load_booking(booking_id):
+    if database.is_enabled():
+        try:
+            return database.get_booking_by_id(booking_id)
+        except Exception as e:
+            log_error(f"get_booking (db): {str(e)}", e)
+    return next((b for b in load_bookings() if b.get('id') == booking_id), None)
+
+_last_booking_id = 0
+_booking_id_lock = threading.Lock()
+
+def allocate_booking_ids(count=1):
+    """Первый из count подряд идущих ID новых броней.
+
+    ID — время в миллисекундах, но строго возрастающее: две брони,
+    оформленные в одну миллисекунду, раньше получали один ID, и в БД
+    вторая затирала первую (add_booking — upsert по id).
+    """
+    global _last_booking_id
+    with _booking_id_lock:
+        first = max(int(time.time() * 1000) % 1000000000, _last_booking_id + 1)
+        _last_booking_id = first + count - 1
+    return first
+
+def get_booking(booking_id):
+    """Бронь по ID (копия словаря) или None"""
+    booking, hit = _booking_cache.get(booking_id, _load_booking)
+    BOOKING_CACHE_REQUESTS.inc('hit' if hit else 'miss')
+    return dict(booking) if booking is not None else None
+
+def invalidate_booking_cache(*booking_ids):
+    """Сброс брони booking_ids в кэше; без аргументов — всех"""
+    _booking_cache.invalidate(*booking_ids)
+
+# ====== СТРАНИЦЫ АДМИН-СПИСКОВ ===========================================
+
+# Короткий кэш страниц: повторные нажатия «вперёд/назад» не ходят в хранилище.
+# Любое изменение броней сбрасывает его целиком.
+_booking_pages_cache = {}
+_booking_pages_lock = threading.Lock()
+
+def invalidate_booking_pages():
+    with _booking_pages_lock:
+        _booking_pages_cache.clear()
+
+def booking_page_key(booking):
+    """Ключ сортировки и курсора админ-списков: (date, start_hour, id)"""
+    return (booking.get('date', ''), min(booking.get('times') or [0]), booking.get('id') or 0)
+
+def load_bookings_page(statuses, date_from=None, date_to=None, cursor=None, backward=False, limit=ADMIN_PAGE_SIZE):
+    """Страница броней по курсору: (брони, есть ли ещё в направлении листания)"""
+    cache_key = (tuple(statuses), date_from, date_to, cursor, backward, limit)
+    now = time.monotonic()
+    with _booking_pages_lock:
+        cached = _booking_pages_cache.get(cache_key)
+    if cached and cached[0] > now:
+        return cached[1]
+    
+    if database.is_enabled():
+        try:
+            page = database.get_bookings_page(statuses, date_from, date_to, cursor, backward, limit)
+        except Exception as e:
+            log_error(f"load_bookings_page (db): {str(e)}", e)
+            page = ([], False)
+    else:
+        # Файловый бэкенд: весь файл всё равно читается, но сортируется только отфильтрованное
+        selected = sorted(
+            (b for b in load_bookings()
+             if b.get('status') in statuses
+             and (not date_from or b.get('date', '') >= date_from)
+             and (not date_to or b.get('date', '') <= date_to)),
+            key=booking_page_key,
+        )
+        keys = [booking_page_key(b) for b in selected]
+        if backward:
+            end = bisect.bisect_left(keys, cursor) if cursor else len(keys)
+            start = max(0, end - limit)
+            page = (selected[start:end], start > 0)
+        else:
+            start = bisect.bisect_right(keys, cursor) if cursor else 0
+            page = (selected[start:start + limit], start + limit < len(selected))
+    
+    with _booking_pages_lock:
+        _booking_pages_cache[cache_key] = (now + ADMIN_PAGE_CACHE_TTL, page)
+    return page
+
+# ====== АРХИВ БРОНЕЙ =====================================================
+
+def _archive_path(month):
+    return os.path.join(ARCHIVE_DIR, f"bookings-{month}.jsonl.gz")
+
+
+def archive_old_bookings(now=None):
+    """Перенос прошедших и давно отменённых броней в холодное хранилище"""
+    now = now or datetime.now()
+    before_date = now.strftime("%Y-%m-%d")
+    cancelled_before = (now - timedelta(days=ARCHIVE_CANCELLED_AFTER_DAYS)).isoformat()
+    
+    if database.is_enabled():
+        invalidate_booking_pages()
+        moved = database.archive_bookings(before_date, cancelled_before)
+        invalidate_booking_cache()
+        if moved:
+            log_info(f"Архивировано броней (db): {moved}")
+        return moved
+    
+    with _bookings_file_lock:
+        hot, cold = [], []
+        for b in load_bookings():
+            is_past = b.get('date', '') < before_date
+            is_stale_cancel = b.get('status') == 'cancelled' and str(b.get('created_at', '')) < cancelled_before
+            (cold if is_past or is_stale_cancel else hot).append(b)
+        if not cold:
+            return 0
+        
+        by_month = {}
+        for b in cold:
+            by_month.setdefault(b.get('date', '')[:7] or 'unknown', []).append(b)
+        os.makedirs(ARCHIVE_DIR, exist_ok=True)
+        archived_at = now.isoformat()
+        # Сначала дописываем архив, потом укорачиваем горячий файл: при сбое
+        # между шагами бронь окажется в обоих местах, а не потеряется
+        for month, items in by_month.items():
+            with gzip.open(_archive_path(month), 'at', encoding='utf-8') as f:
+                for b in items:
+                    f.write(json.dumps({**b, 'archived_at': archived_at}, ensure_ascii=False) + "\n")
+        save_bookings(hot)
+    log_info(f"Архивировано броней: {len(cold)} (в работе осталось {len(hot)})")
+    return len(cold)
+
+
+def load_archived_bookings(date_from=None, date_to=None):
+    """Брони из архива за период (даты YYYY-MM-DD, включительно)"""
+    if database.is_enabled():
+        try:
+            return database.get_archived_bookings(date_from, date_to)
+        except Exception as e:
+            log_error(f"load_archived_bookings (db): {str(e)}", e)
+            return []
+    
+    if not os.path.isdir(ARCHIVE_DIR):
+        return []
+    result = []
+    for filename in sorted(os.listdir(ARCHIVE_DIR)):
+        if not (filename.startswith('bookings-') and filename.endswith('.jsonl.gz')):
+            continue
+        month = filename[len('bookings-'):-len('.jsonl.gz')]
+        # Месячные файлы вне периода не читаем вовсе
+        if (date_from and month < date_from[:7]) or (date_to and month > date_to[:7]):
+            continue
+        try:
+            with gzip.open(os.path.join(ARCHIVE_DIR, filename), 'rt', encoding='utf-8') as f:
+                for line in f:
+                    if not line.strip():
+                        continue
+                    b = json.loads(line)
+                    date = b.get('date', '')
+                    if (date_from and date < date_from) or (date_to and date > date_to):
+                        continue
+                    result.append(b)
+        except Exception as e:
+            log_error(f"load_archived_bookings: {filename}: {str(e)}", e)
+    return result
+
+
+def load_booking_history(date_from=None, date_to=None):
+    """Горячие и архивные брони за период — для отчётов администратора"""
+    merged = {}
+    for b in load_archived_bookings(date_from, date_to):
+        merged[b.get('id')] = b
+    for b in load_bookings():
+        date = b.get('date', '')
+        if (date_from and date < date_from) or (date_to and date > date_to):
+            continue
+        merged[b.get('id')] = b  # горячая копия актуальнее архивной
+    return sorted(merged.values(), key=lambda b: (b.get('date', ''), b.get('id') or 0))
+
+def iter_booking_history(date_from=None, date_to=None):
+    """Брони за период для выгрузки: из БД — потоком, из файлов — через load_booking_history"""
+    if database.is_enabled():
+        try:
+            yield from database.iter_booking_history(date_from, date_to)
+            return
+        except Exception as e:
+            log_error(f"iter_booking_history (db): {str(e)}", e)
+            raise
+    yield from load_booking_history(date_from, date_to)
+
+# ====== ПРОФИЛИ КЛИЕНТОВ =================================================
+
+# chat_id -> профиль или None (клиент без профиля — чтобы не спрашивать БД повторно)
+_profiles_cache = {}
+_profiles_lock = threading.Lock()
+_profiles_file_loaded = False
+
+def _load_profiles_file():
+    """Файловый бэкенд: все профили читаются один раз"""
+    global _profiles_file_loaded
+    if _profiles_file_loaded:
+        return
+    try:
+        if os.path.exists(PROFILES_FILE):
+            with open(PROFILES_FILE, 'r', encoding='utf-8') as f:
+                _profiles_cache.update({int(k): v for k, v in json.load(f).items()})
+    except Exception as e:
+        log_error(f"load_profiles: {str(e)}", e)
+    _profiles_file_loaded = True
+
+def get_customer_profile(chat_id):
+    """Имя, email и телефон из последней брони клиента или None"""
+    with _profiles_lock:
+        if chat_id in _profiles_cache:
+            return _profiles_cache[chat_id]
+        if not database.is_enabled():
+            _load_profiles_file()
+            return _profiles_cache.get(chat_id)
+    
+    try:
+        profile = database.get_customer_profile(chat_id)
+    except Exception as e:
+        log_error(f"get_customer_profile (db): {str(e)}", e)
+        return None
+    with _profiles_lock:
+        _profiles_cache[chat_id] = profile
+    return profile
+
+def save_customer_profile(chat_id, name, email, phone):
+    """Запоминает контактные данные из оплаченной брони (см. mark_bookings_paid)"""
+    current = get_customer_profile(chat_id)
+    if current and (current.get('name'), current.get('email'), current.get('phone')) == (name, email, phone):
+        return  # ничего не изменилось — лишняя запись не нужна
+    profile = {'name': name, 'email': email, 'phone': phone, 'updated_at': datetime.now().isoformat()}
+    
+    if database.is_enabled():
+        try:
+            database.upsert_customer_profile(chat_id, profile)
+            with _profiles_lock:
+                _profiles_cache[chat_id] = profile
+            return
+        except Exception as e:
+            log_error(f"save_customer_profile (db): {str(e)}", e)
+    
+    try:
+        with _profiles_lock:
+            _load_profiles_file()
+            _profiles_cache[chat_id] = profile
+            data = {str(k): v for k, v in _profiles_cache.items() if v}
+            tmp_path = f"{PROFILES_FILE}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, PROFILES_FILE)
+    except Exception as e:
+        log_error(f"save_customer_profile: {str(e)}", e)
+
+# ====== ПОИСК КЛИЕНТА ====================================================
+
+SEARCH_RESULTS_LIMIT = 15
+
+def search_bookings(query, limit=SEARCH_RESULTS_LIMIT):
+    """Поиск броней по телефону, имени, email или Telegram ID"""
+    query = query.strip()
+    digits = normalize_phone(query)
+    # «+7 (999) 123-45-67», «9991234567», «666267758» — цифровой запрос
+    numeric = bool(digits) and not any(c.isalpha() for c in query)
+    user_id = int(digits) if numeric and query.lstrip('+').isdigit() else None
+    phone = digits if numeric and len(digits) >= 3 else None
+    text = query.lower() if not numeric and len(query) >= 2 else None
+    
+    if database.is_enabled():
+        try:
+            return database.search_bookings(user_id=user_id, phone=phone, text=text, limit=limit)
+        except Exception as e:
+            log_error(f"search_bookings (db): {str(e)}", e)
+            return []
+    
+    # Файловый бэкенд: индексов нет, линейный проход по горячим броням и архиву
+    def matches(b):
+        return (user_id is not None and b.get('user_id') == user_id) \
+            or (phone and phone in normalize_phone(b.get('phone'))) \
+            or (text and (text in (b.get('name') or '').lower() or text in (b.get('email') or '').lower()))
+    
+    found = [b for b in load_bookings() if matches(b)]
+    hot_ids = {b.get('id') for b in found}
+    found += [dict(b, archived=True) for b in load_archived_bookings()
+              if matches(b) and b.get('id') not in hot_ids]
+    found.sort(key=lambda b: (b.get('date', ''), b.get('id') or 0), reverse=True)
+    return found[:limit]
+
+# ====== СТАТИСТИКА =======================================================
+
+# Даты, брони которых поменяли состояние с прошлого пересчёта агрегатов
+_stats_dirty_dates = set()
+_stats_lock = threading.Lock()
+
+def mark_stats_dirty(*dates):
+    """Отметка дат для пересчёта агрегатов (создание, отмена, оплата брони)"""
+    with _stats_lock:
+        _stats_dirty_dates.update(d for d in dates if d)
+
+def _load_stats_file():
+    if os.path.exists(STATS_FILE):
+        with open(STATS_FILE, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return {'daily': {}, 'hourly': {}}
+
+def refresh_stats(dates=None):
+    """Пересчёт агрегатов за даты (None — за всё время)"""
+    started = time.perf_counter()
+    if database.is_enabled():
+        database.refresh_booking_stats(dates)
+    else:
+        with _stats_lock:
+            stats = _load_stats_file() if dates is not None else {'daily': {}, 'hourly': {}}
+            if dates is None:
+                history = load_booking_history()
+            else:
+                history = [b for b in load_booking_history(min(dates), max(dates)) if b.get('date') in dates]
+            daily, hourly = analytics.rollup(history)
+            for date in (dates if dates is not None else []):
+                stats['daily'].pop(date, None)
+                stats['hourly'].pop(date, None)
+            for (date, service, status), row in daily.items():
+                stats['daily'].setdefault(date, []).append([service, status, row['bookings'], row['hours'], row['revenue']])
+            for (date, hour), hours in hourly.items():
+                stats['hourly'].setdefault(date, {})[str(hour)] = hours
+            tmp_path = f"{STATS_FILE}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(stats, f, ensure_ascii=False)
+            os.replace(tmp_path, STATS_FILE)
+    log_debug("Агрегаты пересчитаны за %s дат за %.1f мс",
+              len(dates) if dates is not None else "все", (time.perf_counter() - started) * 1000)
+
+def flush_stats():
+    """Пересчёт агрегатов по накопившимся датам"""
+    with _stats_lock:
+        dates = set(_stats_dirty_dates)
+        _stats_dirty_dates.clear()
+    if dates:
+        try:
+            refresh_stats(dates)
+        except Exception:
+            mark_stats_dirty(*dates)
+            raise
+
+def ensure_stats():
+    """Первичное заполнение агрегатов, если их ещё нет"""
+    if database.is_enabled():
+        if database.count_rows('booking_daily_stats') == 0:
+            refresh_stats()
+    elif not os.path.exists(STATS_FILE):
+        refresh_stats()
+
+def stats_worker():
+    """Фоновый пересчёт агрегатов по изменённым датам"""
+    while True:
+        time.sleep(STATS_REFRESH_INTERVAL)
+        try:
+            flush_stats()
+        except Exception as e:
+            log_error(f"Ошибка в stats_worker: {str(e)}", e)
+
+def load_stats_summary(days):
+    """Сводка за последние days дней (включая сегодня) из агрегатов"""
+    flush_stats()
+    now = datetime.now()
+    today = now.strftime("%Y-%m-%d")
+    date_from = (now - timedelta(days=days - 1)).strftime("%Y-%m-%d")
+    if database.is_enabled():
+        daily, hourly = database.get_booking_stats(date_from, today)
+    else:
+        stats = _load_stats_file()
+        daily = [
+            {'date': date, 'service': row[0], 'status': row[1], 'bookings': row[2], 'hours': row[3], 'revenue': row[4]}
+            for date, rows in stats['daily'].items() if date_from <= date <= today
+            for row in rows
+        ]
+        hourly = [
+            {'date': date, 'hour': int(hour), 'hours': hours}
+            for date, hours_by_hour in stats['hourly'].items() if date_from <= date <= today
+            for hour, hours in hours_by_hour.items()
+        ]
+    return analytics.summarize(daily, hourly, date_from, today, load_config(), today)
+
 # ====== VIP ФУНКЦИИ ======================================================
 
 def load_vip_users():
@@ -205,6 +904,7 @@ def load_vip_users():
     if database.is_enabled():
         try:
             VIP_USERS = database.get_all_vip_users()
+            invalidate_vip_index()
             log_info(f"✅ VIP пользователи загружены из БД: {len(VIP_USERS)}")
             return
         except Exception as e:
@@ -217,6 +917,7 @@ def load_vip_users():
                 data = json.load(f)
                 # Преобразуем ключи в int (JSON сохраняет их как строки)
                 VIP_USERS = {int(k): v for k, v in data.items()}
+                invalidate_vip_index()
                 log_info(f"VIP пользователи загружены: {len(VIP_USERS)}")
         else:
             VIP_USERS = {}
@@ -224,10 +925,12 @@ def load_vip_users():
     except Exception as e:
         log_error(f"load_vip_users: {str(e)}", e)
         VIP_USERS = {}
+        invalidate_vip_index()
 
 
 def save_vip_users():
     """Сохранение VIP пользователей"""
+    invalidate_vip_index()
     if database.is_enabled():
         try:
             database.save_vip_users(VIP_USERS)
@@ -246,24 +949,163 @@ def save_vip_users():
         log_error(f"save_vip_users: {str(e)}", e)
 
 
+def save_vip_user(user_id):
+    """Сохранение одного VIP (или его удаления) без перезаписи остальных"""
+    if database.is_enabled():
+        invalidate_vip_index()
+        try:
+            if user_id in VIP_USERS:
+                database.upsert_vip_user(user_id, VIP_USERS[user_id])
+            else:
+                database.remove_vip_user(user_id)
+            return
+        except Exception as e:
+            log_error(f"❌ Ошибка сохранения VIP {user_id} в БД: {str(e)}", e)
+            log_info("🔄 Пробую сохранить в файл как fallback...")
+    # В JSON-файле отдельную запись не обновить — пишем файл целиком
+    save_vip_users()
+
+
+def load_vip_tiers():
+    """Загрузка уровней VIP"""
+    global VIP_TIERS
+    if database.is_enabled():
+        try:
+            VIP_TIERS = database.get_vip_tiers()
+            invalidate_vip_index()
+            log_info(f"✅ Уровни VIP загружены из БД: {len(VIP_TIERS)}")
+            return
+        except Exception as e:
+            log_error(f"❌ Ошибка загрузки уровней VIP из БД: {str(e)}", e)
+
+    try:
+        if os.path.exists(VIP_TIERS_FILE):
+            with open(VIP_TIERS_FILE, 'r', encoding='utf-8') as f:
+                VIP_TIERS = json.load(f)
+        else:
+            VIP_TIERS = {}
+    except Exception as e:
+        log_error(f"load_vip_tiers: {str(e)}", e)
+        VIP_TIERS = {}
+    invalidate_vip_index()
+
+
+def import_vip_records(kind, records):
+    """Массовый импорт VIP или уровней одной пачкой (в БД — одной транзакцией)"""
+    global VIP_TIERS
+    if kind == 'tiers':
+        tiers = {r['name']: {'discount': r['discount'], 'prices': r['prices']} for r in records}
+        if database.is_enabled():
+            database.upsert_vip_tiers(records)
+        else:
+            with open(VIP_TIERS_FILE, 'w', encoding='utf-8') as f:
+                json.dump({**VIP_TIERS, **tiers}, f, ensure_ascii=False, indent=2)
+        VIP_TIERS = {**VIP_TIERS, **tiers}
+        invalidate_vip_index()
+        log_info(f"Импортировано уровней VIP: {len(records)}")
+        return len(tiers)
+
+    if database.is_enabled():
+        database.upsert_vip_users(records)
+        for r in records:
+            VIP_USERS[r['user_id']] = {k: v for k, v in r.items() if k != 'user_id'}
+        invalidate_vip_index()
+    else:
+        for r in records:
+            VIP_USERS[r['user_id']] = {k: v for k, v in r.items() if k != 'user_id'}
+        save_vip_users()
+    log_info(f"Импортировано VIP: {len(records)}")
+    return len({r['user_id'] for r in records})
+
+
+# Скомпилированные правила цен VIP: (версия VIP, {user_id: VipRule})
+_vip_rules = (None, {})
+
+def vip_rule(chat_id):
+    """Правило цены VIP или None; таблица пересобирается только после изменений"""
+    global _vip_rules
+    version, rules = _vip_rules
+    if version != _vip_version:
+        with _vip_lock:
+            if _vip_rules[0] != _vip_version:
+                _vip_rules = (_vip_version, vip_rules.compile_rules(VIP_USERS, VIP_TIERS))
+            rules = _vip_rules[1]
+    return rules.get(chat_id)
+
+
 def get_user_discount(chat_id):
-    """Получение VIP скидки"""
-    return VIP_USERS.get(chat_id, {}).get('discount', 0)
+    """Получение VIP скидки (своей или уровня)"""
+    rule = vip_rule(chat_id)
+    return rule.discount if rule else 0
 
 
 def get_user_custom_price_repet(chat_id):
     """Получение индивидуальной цены на репетицию для VIP пользователя"""
-    if chat_id in VIP_USERS:
-        custom_price = VIP_USERS[chat_id].get('custom_price_repet')
-        if custom_price is not None:
-            return custom_price
-    return None
+    rule = vip_rule(chat_id)
+    return rule.prices.get('repet') if rule else None
 
 
 def is_vip_user(chat_id):
     """Проверка VIP статуса"""
     return chat_id in VIP_USERS
 
+# ====== ЦЕНЫ =============================================================
+
+def calculate_price(chat_id, service, duration, config=None):
+    """Расчёт стоимости брони с учётом VIP и скидок за длительность"""
+    if config is None:
+        config = load_config()
+    prices = config.get('prices', {})
+    pricing = {
+        'base_price': 0,
+        'price': 0,
+        'custom_price': None,
+        'vip_discount': 0,
+        'volume_discount': 0,
+    }
+    
+    # Индивидуальная цена VIP за час (своя или уровня) заменяет все скидки
+    rule = vip_rule(chat_id)
+    custom_price = rule.prices.get(service) if rule else None
+    if custom_price is not None:
+        pricing['custom_price'] = custom_price
+        pricing['base_price'] = pricing['price'] = custom_price * duration
+        return pricing
+    
+    if service == 'repet':
+        base_price = 700 * duration  # 700 рублей за час репетиции
+    elif service == 'full':
+        base_price = prices.get('full', 1500)
+    elif service == 'studio':
+        base_price = prices.get('studio', 800) * duration
+    else:
+        base_price = prices.get(service, 700) * duration
+    pricing['base_price'] = base_price
+    
+    vip_discount = rule.discount if rule else 0
+    if vip_discount > 0:
+        pricing['vip_discount'] = vip_discount
+        pricing['price'] = int(base_price * (1 - vip_discount / 100))
+    elif duration >= 5:
+        pricing['volume_discount'] = 15
+        pricing['price'] = int(base_price * 0.85)
+    elif duration >= 3:
+        pricing['volume_discount'] = 10
+        pricing['price'] = int(base_price * 0.9)
+    else:
+        pricing['price'] = base_price
+    return pricing
+
+def format_discount(pricing, vip_price_label):
+    """Подпись к цене: индивидуальная цена VIP, VIP-скидка или скидка за часы"""
+    if pricing['custom_price'] is not None:
+        return f" ({vip_price_label}: {pricing['custom_price']}₽/ч)"
+    if pricing['vip_discount']:
+        return f" (VIP -{pricing['vip_discount']}%)"
+    if pricing['volume_discount']:
+        return f" (-{pricing['volume_discount']}%)"
+    return ""
+
 # ====== РАБОТА С ДАТАМИ ===================================================
 
 def get_available_dates(days=30):
@@ -283,21 +1125,129 @@ def get_available_dates(days=30):
 
 def get_booked_slots(date_str, service):
     """Получение занятых часов"""
+    return sorted(get_booked_slots_by_date([date_str], service).get(date_str, ()))
+
+def payment_hold_cutoffs(now=None):
+    """created_at, начиная с которого неоплаченная бронь ещё держит часы:
+    (со ссылкой на оплату, без ссылки). Бронь без ссылки держится, пока
+    ссылка отложена (PENDING_PAYMENTS_MAX_AGE), — потом её снимает retry_pending_payments"""
+    now = now or datetime.now()
+    return (
+        (now - timedelta(minutes=PAYMENT_HOLD_MINUTES)).isoformat(),
+        (now - timedelta(seconds=PENDING_PAYMENTS_MAX_AGE)).isoformat(),
+    )
+
+def holds_slot(booking, cutoffs):
+    """Держит ли бронь свои часы: отменённая — нет, неоплаченная — пока не истекло удержание"""
+    status = booking.get('status')
+    if status == 'cancelled':
+        return False
+    if status == 'awaiting_payment':
+        hold_since, link_wait_since = cutoffs
+        created_at = booking.get('created_at') or ''
+        return created_at > (link_wait_since if not booking.get('payment_url') else hold_since)
+    return True
+
+def get_booked_slots_by_date(dates, service):
+    """Занятые часы по нескольким датам за один проход: {date: set(часов)}"""
+    cutoffs = payment_hold_cutoffs()
     try:
-        bookings = load_bookings()
-        booked = []
-        for booking in bookings:
-            if booking.get('status') in ['cancelled', 'awaiting_payment']:
+        if database.is_enabled():
+            try:
+                return database.get_booked_slots(dates, service, *cutoffs)
+            except Exception as e:
+                log_error(f"get_booked_slots_by_date (db): {str(e)}", e)
+        
+        booked = {date: set() for date in dates}
+        for booking in load_bookings():
+            if not holds_slot(booking, cutoffs):
                 continue
-            if booking.get('date') == date_str and booking.get('service') == service:
-                booked.extend(booking.get('times', []))
-        return sorted(set(booked))
+            if booking.get('date') in booked and booking.get('service') == service:
+                booked[booking['date']].update(booking.get('times', []))
+        return booked
     except Exception as e:
-        log_error(f"get_booked_slots: {str(e)}", e)
-        return []
+        log_error(f"get_booked_slots_by_date: {str(e)}", e)
+        return {date: set() for date in dates}
+
+# ====== ПОВТОРЯЮЩИЕСЯ БРОНИ ==============================================
+
+# Варианты «повторять каждую неделю»: кнопка на шаге времени перебирает их по кругу
+RECURRING_WEEKS = (1, 2, 4, 8)
+
+def recurring_dates(date_str, weeks):
+    """Даты серии: та же дата недели weeks недель подряд"""
+    start = datetime.strptime(date_str, "%Y-%m-%d")
+    return [(start + timedelta(weeks=i)).strftime("%Y-%m-%d") for i in range(weeks)]
+
+def find_slot_conflicts(dates, service, times):
+    """Даты серии, где часть выбранных часов занята: {date: [часы]}"""
+    booked = get_booked_slots_by_date(dates, service)
+    conflicts = {}
+    for date in dates:
+        busy = booked.get(date, set()) & set(times)
+        if busy:
+            conflicts[date] = sorted(busy)
+    return conflicts
+
+def add_bookings_atomic(bookings):
+    """Запись серии броней целиком или никак; возвращает конфликты {date: [часы]}"""
+    invalidate_booking_pages()
+    if database.is_enabled():
+        conflicts = database.add_bookings_atomic(bookings, *payment_hold_cutoffs())
+        invalidate_booking_cache(*(b['id'] for b in bookings))
+    else:
+        with _bookings_file_lock:
+            conflicts = find_slot_conflicts([b['date'] for b in bookings], bookings[0]['service'], bookings[0]['times'])
+            if not conflicts:
+                all_bookings = load_bookings()
+                all_bookings.extend(bookings)
+                save_bookings(all_bookings)
+    if not conflicts:
+        mark_stats_dirty(*(b['date'] for b in bookings))
+        log_info(f"Серия броней добавлена: ID={','.join(str(b['id']) for b in bookings)}")
+    return conflicts
+
+def mark_bookings_paid(booking_ids, payment_id=None):
+    """Перевод в 'paid' брони или всей серии с общим платежом.
+
+    Возвращает (найденные брони, брони, оплаченные этим вызовом).
+    """
+    ids = {str(i) for i in booking_ids}
+    with _bookings_file_lock:
+        bookings = load_bookings()
+        found, paid = [], []
+        for b in bookings:
+            if str(b.get('id')) not in ids and not (payment_id and b.get('yookassa_payment_id') == payment_id):
+                continue
+            found.append(b)
+            if b.get('status') != 'paid':
+                b['status'] = 'paid'
+                b['paid_at'] = datetime.now().isoformat()
+                if payment_id:
+                    b['yookassa_payment_id'] = payment_id
+                paid.append(b)
+        if paid:
+            save_bookings(bookings)
+            mark_stats_dirty(*(b.get('date') for b in paid))
+    # Профиль — из последней оплаченной брони; у серии контакты общие
+    for b in {b.get('user_id'): b for b in paid}.values():
+        save_customer_profile(b.get('user_id'), b.get('name'), b.get('email'), b.get('phone'))
+    return found, paid
 
 # ====== КЛАВИАТУРЫ ========================================================
 
+def normalize_phone(phone):
+    """Только цифры, российский номер приводится к виду 7XXXXXXXXXX.
+
+    Та же логика — в booking_phone_norm() в database.py (колонка phone_norm).
+    """
+    digits = ''.join(c for c in str(phone or '') if c.isdigit())
+    if digits.startswith('8') and len(digits) == 11:
+        return '7' + digits[1:]
+    if not digits.startswith('7') and len(digits) == 10:
+        return '7' + digits
+    return digits
+
 def is_admin(chat_id):
     """Проверка, является ли пользователь администратором"""
     return ADMIN_CHAT_ID > 0 and chat_id == ADMIN_CHAT_ID
@@ -400,39 +1350,15 @@ def times_keyboard(chat_id, date_str, service):
         kb.row(*buttons[i:i+3])
     
     if selected:
-        start, end = min(selected), max(selected) + 1
+        pricing = calculate_price(chat_id, service, len(selected), config)
+        price = pricing['price']
+        discount_text = format_discount(pricing, "VIP")
         
-        # Проверяем индивидуальную цену для VIP на репетицию
-        custom_price_repet = get_user_custom_price_repet(chat_id) if service == 'repet' else None
-        
-        if custom_price_repet is not None:
-            # Используем индивидуальную цену для VIP
-            base_price = custom_price_repet * len(selected)
-            price = base_price
-            discount_text = f" (VIP: {custom_price_repet}₽/ч)"
+        weeks = user_states.get(chat_id, {}).get('weeks', 1)
+        if weeks > 1:
+            kb.add(types.InlineKeyboardButton(f"🔁 Каждую неделю: {weeks} нед. ({price * weeks}₽)", callback_data="repeat_weeks"))
         else:
-            # Обычный расчет
-            if service == 'repet':
-                base_price = 700 * len(selected)  # 700 рублей за час репетиции
-            elif service == 'full':
-                base_price = config['prices'].get('full', 1500)
-            else:
-                base_price = config['prices'].get(service, 800) * len(selected)
-            
-            vip_discount = get_user_discount(chat_id)
-            if vip_discount > 0:
-                price = int(base_price * (1 - vip_discount / 100))
-                discount_text = f" (VIP -{vip_discount}%)"
-            elif len(selected) >= 5:
-                price = int(base_price * 0.85)
-                discount_text = " (-15%)"
-            elif len(selected) >= 3:
-                price = int(base_price * 0.9)
-                discount_text = " (-10%)"
-            else:
-                price = base_price
-                discount_text = ""
-        
+            kb.add(types.InlineKeyboardButton("🔁 Повторять каждую неделю", callback_data="repeat_weeks"))
         kb.row(
             types.InlineKeyboardButton("🔄 Очистить", callback_data="clear_times"),
             types.InlineKeyboardButton(f"✅ Далее {price}₽{discount_text}", callback_data="confirm_times")
@@ -452,21 +1378,18 @@ def bookings_keyboard(bookings, user_id):
     if not user_bookings:
         return None
     
+    service_emoji = {'repet': '🎸', 'studio': '🎧', 'full': '✨'}
     for booking in user_bookings:
+        booking = booking_model.as_booking(booking)
         bid = booking.get('id')
         date = booking.get('date', '')
-        if booking.get('times'):
-            start = min(booking['times'])
-            time_str = f"{start:02d}:00"
-        else:
-            time_str = ""
+        time_str = f"{booking.start:02d}:00" if booking.start is not None else ""
         
-        service_emoji = {'repet': '🎸', 'studio': '🎧', 'full': '✨'}
-        emoji = service_emoji.get(booking['service'], '📋')
+        emoji = service_emoji.get(booking.get('service'), '📋')
         status = booking.get('status', 'pending')
         status_icon = "💵" if status == 'paid' else "⏳"
         
-        text = f"{emoji} {date} {time_str} · {booking['price']}₽ {status_icon}"
+        text = f"{emoji} {date} {time_str} · {booking.get('price')}₽ {status_icon}"
         kb.add(types.InlineKeyboardButton(text, callback_data=f"booking_detail_{bid}"))
     
     return kb
@@ -479,7 +1402,7 @@ def format_welcome(chat_id):
     if is_vip_user(chat_id):
         vip_user = VIP_USERS.get(chat_id, {})
         vip_name = vip_user.get('name', '')
-        vip_discount = vip_user.get('discount', 0)
+        vip_discount = get_user_discount(chat_id)
         vip_badge = (
             f"\n\n👑 <b>VIP СТАТУС АКТИВЕН!</b>\n\n"
             f"🎁 <b>Привет, {vip_name}!</b>\n"
@@ -522,7 +1445,7 @@ def format_prices(chat_id):
     """Форматированные тарифы"""
     vip_info = ""
     if is_vip_user(chat_id):
-        vip_discount = VIP_USERS[chat_id]['discount']
+        vip_discount = get_user_discount(chat_id)
         vip_info = f"\n\n👑 <b>ТВОЙ VIP СТАТУС</b>\n\n💎 <b>Персональная скидка: {vip_discount}%</b> на все услуги!\n⭐ Приоритетное бронирование\n🎁 Эксклюзивные предложения\n\n"
     
     return f"""💰 <b>ТАРИФЫ {STUDIO_NAME}</b>     
@@ -711,6 +1634,18 @@ def admin_command(m):
         except:
             pass
 
+@bot.message_handler(commands=['find'])
+def find_command(m):
+    """Поиск клиента: /find <телефон | имя | email | ID>"""
+    chat_id = m.chat.id
+    if not is_admin(chat_id):
+        return
+    query = (m.text or '').split(maxsplit=1)[1:]
+    if not query:
+        bot.send_message(chat_id, "💡 Использование: <code>/find 79991234567</code> или <code>/find Иван</code>", parse_mode='HTML')
+        return
+    send_admin_search_results(chat_id, query[0])
+
 @bot.message_handler(commands=['setadmin'])
 def set_admin(m):
     """Временная установка администратора (до перезапуска)"""
@@ -818,7 +1753,7 @@ def cancel_booking(m):
 def my_bookings(m):
     """Просмотр броней"""
     chat_id = m.chat.id
-    bookings = load_bookings()
+    bookings = load_booking_models()
     user_bookings = [
         b for b in bookings
         if b.get('user_id') == chat_id and b.get('status') != 'cancelled'
@@ -848,7 +1783,7 @@ def location(m):
     """Показ локации"""
     try:
         chat_id = m.chat.id
-        log_info(f"Обработка кнопки 'Контакты' от пользователя {chat_id}")
+        log_debug("Обработка кнопки 'Контакты' от пользователя %s", chat_id)
         
         location_text = format_location()
         
@@ -858,9 +1793,8 @@ def location(m):
         kb.add(types.InlineKeyboardButton("🚗 Яндекс.Карты - На машине", url=f"https://yandex.ru/maps/?rtext=&rtt=auto&text={address_encoded}"))
         kb.add(types.InlineKeyboardButton("🚇 Яндекс.Карты - Общественный транспорт", url=f"https://yandex.ru/maps/?rtext=&rtt=mt&text={address_encoded}"))
         
-        log_info(f"Отправка контактов пользователю {chat_id}")
         bot.send_message(chat_id, location_text, reply_markup=kb, parse_mode='HTML')
-        log_info(f"Контакты успешно отправлены пользователю {chat_id}")
+        log_debug("Контакты успешно отправлены пользователю %s", chat_id)
     except Exception as e:
         log_error(f"Ошибка в функции location: {str(e)}", e)
         try:
@@ -893,22 +1827,237 @@ def admin_panel(m):
         bot.send_message(chat_id, "❌ <b>Доступ запрещён</b>", parse_mode='HTML')
         return
     
+    kb = admin_panel_keyboard()
+    
+    text = """👨‍💼 <b>АДМИН-ПАНЕЛЬ</b>
+
+<b>Выбери действие:</b>"""
+    bot.send_message(chat_id, text, reply_markup=kb, parse_mode='HTML')
+
+# ====== АДМИН ФУНКЦИИ ====================================================
+
+def admin_panel_keyboard():
+    """Клавиатура админ-панели"""
     kb = types.InlineKeyboardMarkup(row_width=1)
     kb.add(types.InlineKeyboardButton("📋 Все бронирования", callback_data="admin_all_bookings"))
     kb.add(types.InlineKeyboardButton("📅 Бронирования сегодня", callback_data="admin_today_bookings"))
     kb.add(types.InlineKeyboardButton("📅 Бронирования завтра", callback_data="admin_tomorrow_bookings"))
+    kb.add(types.InlineKeyboardButton("🔍 Поиск клиента", callback_data="admin_search"))
+    kb.add(types.InlineKeyboardButton("📊 Статистика", callback_data="admin_stats_30"))
+    kb.add(types.InlineKeyboardButton("🗂 История по месяцам", callback_data="admin_history"))
+    kb.add(types.InlineKeyboardButton("📤 Выгрузка в CSV / Excel", callback_data="admin_export"))
     kb.add(types.InlineKeyboardButton("➕ Добавить VIP клиента", callback_data="admin_add_vip"))
     kb.add(types.InlineKeyboardButton("➖ Удалить VIP клиента", callback_data="admin_remove_vip"))
     kb.add(types.InlineKeyboardButton("💰 Настроить цену на репетицию", callback_data="admin_set_price_repet"))
     kb.add(types.InlineKeyboardButton("📝 Список VIP клиентов", callback_data="admin_list_vip"))
+    kb.add(types.InlineKeyboardButton("📥 Импорт VIP и уровней из CSV", callback_data="admin_vip_import"))
     kb.add(types.InlineKeyboardButton("📱 Подсказка для клиента (ID)", callback_data="admin_vip_id_hint"))
+    return kb
+
+EXPORT_RANGES = (
+    ('month', "Текущий месяц"),
+    ('prev', "Прошлый месяц"),
+    ('next30', "Ближайшие 30 дней"),
+    ('last90', "Последние 90 дней"),
+    ('all', "За всё время"),
+)
+
+def export_date_range(code, now):
+    """Границы периода выгрузки (date_from, date_to) в формате YYYY-MM-DD; None — без границы"""
+    month_start = now.replace(day=1)
+    if code == 'month':
+        next_month = (month_start + timedelta(days=32)).replace(day=1)
+        return month_start.strftime("%Y-%m-%d"), (next_month - timedelta(days=1)).strftime("%Y-%m-%d")
+    if code == 'prev':
+        prev_end = month_start - timedelta(days=1)
+        return prev_end.replace(day=1).strftime("%Y-%m-%d"), prev_end.strftime("%Y-%m-%d")
+    if code == 'next30':
+        return now.strftime("%Y-%m-%d"), (now + timedelta(days=30)).strftime("%Y-%m-%d")
+    if code == 'last90':
+        return (now - timedelta(days=90)).strftime("%Y-%m-%d"), now.strftime("%Y-%m-%d")
+    return None, None
+
+def export_keyboard():
+    """Выбор периода и формата выгрузки"""
+    kb = types.InlineKeyboardMarkup(row_width=2)
+    for code, title in EXPORT_RANGES:
+        kb.row(
+            types.InlineKeyboardButton(f"📄 {title} — CSV", callback_data=f"admin_export_csv_{code}"),
+            types.InlineKeyboardButton("📊 XLSX", callback_data=f"admin_export_xlsx_{code}"),
+        )
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
+    return kb
+
+def send_bookings_export(chat_id, fmt, code):
+    """Выгрузка броней за период в файл и отправка документом"""
+    date_from, date_to = export_date_range(code, datetime.now())
+    period = f"{date_from or 'начало'}_{date_to or 'сегодня'}"
+    file_name = f"machata_bookings_{period}.{fmt}"
+    tmp_dir = tempfile.mkdtemp(prefix="machata-export-")
+    path = os.path.join(tmp_dir, file_name)
+    try:
+        started = time.perf_counter()
+        count = reports.WRITERS[fmt](iter_booking_history(date_from, date_to), path)
+        log_info(f"Выгрузка {file_name}: {count} броней за {(time.perf_counter() - started) * 1000:.0f} мс")
+        if count == 0:
+            bot.send_message(chat_id, "📭 <b>За выбранный период броней нет</b>", parse_mode='HTML')
+            return
+        with open(path, 'rb') as f:
+            bot.send_document(
+                chat_id, f,
+                visible_file_name=file_name,
+                caption=f"📤 Брони {date_from or '…'} — {date_to or '…'}: {count}",
+            )
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+# Вид списка: (заголовок, сдвиг дня от сегодня или None — все даты)
+ADMIN_LIST_VIEWS = {
+    'all': ("📋 ВСЕ АКТИВНЫЕ БРОНИРОВАНИЯ", None),
+    'today': ("📅 БРОНИРОВАНИЯ СЕГОДНЯ", 0),
+    'tomorrow': ("📅 БРОНИРОВАНИЯ ЗАВТРА", 1),
+}
+
+def admin_bookings_page(view, cursor=None, backward=False):
+    """Текст и клавиатура страницы админ-списка броней"""
+    title, day_offset = ADMIN_LIST_VIEWS[view]
+    date_from = date_to = None
+    if day_offset is not None:
+        date_from = date_to = (datetime.now() + timedelta(days=day_offset)).strftime("%Y-%m-%d")
     
-    text = """👨‍💼 <b>АДМИН-ПАНЕЛЬ</b>
+    bookings, has_more = load_bookings_page(ACTIVE_STATUSES, date_from, date_to, cursor, backward)
+    if not bookings and cursor:
+        # Страница опустела (брони отменены или ушли в архив) — начинаем сначала
+        return admin_bookings_page(view)
+    
+    kb = types.InlineKeyboardMarkup()
+    if not bookings:
+        kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
+        suffix = f" на {date_from}" if date_from else ""
+        return f"📭 <b>Нет активных бронирований{suffix}</b>", kb
+    
+    if backward:
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = cursor is not None, has_more
+    
+    text = f"<b>{title}</b>\n\n"
+    text += "\n\n".join(format_admin_booking(b) for b in bookings)
+    
+    nav = []
+    if has_prev:
+        date, hour, booking_id = booking_page_key(bookings[0])
+        nav.append(types.InlineKeyboardButton("◀️ Назад", callback_data=f"admin_page_{view}_p_{date}_{hour}_{booking_id}"))
+    if has_next:
+        date, hour, booking_id = booking_page_key(bookings[-1])
+        nav.append(types.InlineKeyboardButton("Вперёд ▶️", callback_data=f"admin_page_{view}_n_{date}_{hour}_{booking_id}"))
+    if nav:
+        kb.row(*nav)
+    kb.add(types.InlineKeyboardButton("🔙 В админ-панель", callback_data="admin_back"))
+    return text, kb
+
+def format_admin_search_results(query, bookings):
+    """Результаты поиска: по строке на бронь"""
+    names = {
+        'repet': '🎸',
+        'studio': '🎧',
+        'full': '✨',
+    }
+    status_icons = {
+        'paid': '✅',
+        'cancelled': '❌',
+    }
+    if not bookings:
+        return f"🔍 По запросу <b>{html.escape(query)}</b> ничего не найдено"
+    
+    text = f"🔍 <b>НАЙДЕНО ПО «{html.escape(query)}»: {len(bookings)}</b>\n\n"
+    for b in bookings:
+        model = booking_model.as_booking(b)
+        time_str = f"{model.start:02d}:00–{model.end:02d}:00" if model.start is not None else "—"
+        text += (
+            f"{status_icons.get(b.get('status'), '⏳')} <b>#{b.get('id')}</b> · {b.get('date', '')} {time_str} "
+            f"{names.get(b.get('service'), '')} · {b.get('price', 0)} ₽\n"
+            f"   👤 {html.escape(str(b.get('name') or '—'))} · ☎️ {html.escape(str(b.get('phone') or '—'))}"
+            f" · 🆔 <code>{b.get('user_id')}</code>{' · 🗄 архив' if b.get('archived') else ''}\n"
+        )
+    if len(bookings) >= SEARCH_RESULTS_LIMIT:
+        text += f"\n<i>Показаны последние {SEARCH_RESULTS_LIMIT} — уточни запрос</i>"
+    return text
 
-<b>Выбери действие:</b>"""
-    bot.send_message(chat_id, text, reply_markup=kb, parse_mode='HTML')
+def send_admin_search_results(chat_id, query):
+    started = time.perf_counter()
+    bookings = search_bookings(query)
+    log_info(f"Поиск клиента: {len(bookings)} результатов за {(time.perf_counter() - started) * 1000:.0f} мс")
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("🔍 Новый поиск", callback_data="admin_search"))
+    kb.add(types.InlineKeyboardButton("🔙 В админ-панель", callback_data="admin_back"))
+    bot.send_message(chat_id, format_admin_search_results(query, bookings), reply_markup=kb, parse_mode='HTML')
 
-# ====== АДМИН ФУНКЦИИ ====================================================
+STATS_PERIODS = (7, 30, 90)
+
+def format_admin_stats(summary, days):
+    """Сводка статистики для админ-панели"""
+    names = {
+        'repet': '🎸 Репетиция',
+        'studio': '🎧 Студия',
+        'full': '✨ Со звукорежем',
+    }
+    text = (
+        f"📊 <b>СТАТИСТИКА ЗА {days} ДН.</b>\n"
+        f"<i>{summary['date_from']} — {summary['date_to']}</i>\n\n"
+        f"💰 <b>Выручка:</b> {summary['revenue']} ₽\n"
+        f"✅ <b>Оплачено:</b> {summary['paid']} броней, {summary['paid_hours']} ч\n"
+        f"📈 <b>Загрузка:</b> {summary['utilization']:.0%} "
+        f"({summary['paid_hours']} из {summary['available_hours']} рабочих ч)\n"
+        f"❌ <b>Отмены:</b> {summary['cancel_rate']:.0%} · "
+        f"💸 <b>Брошенные оплаты:</b> {summary['abandon_rate']:.0%}\n"
+    )
+    if summary['services']:
+        text += "\n<b>По услугам:</b>\n"
+        for service, row in sorted(summary['services'].items(), key=lambda item: -item[1]['revenue']):
+            text += (
+                f"{names.get(service, service)}: {row['bookings']} · {row['hours']} ч · "
+                f"{row['revenue']} ₽ · {row['utilization']:.0%}\n"
+            )
+    if summary['heatmap']:
+        config = load_config()
+        lines = analytics.heatmap_lines(summary['heatmap'], config['work_hours']['start'], config['work_hours']['end'])
+        text += "\n<b>🔥 Оплаченные часы (день × час):</b>\n<pre>" + "\n".join(lines) + "</pre>"
+    return text
+
+def stats_keyboard(days):
+    kb = types.InlineKeyboardMarkup()
+    kb.row(*[
+        types.InlineKeyboardButton(f"{'• ' if period == days else ''}{period} дн.", callback_data=f"admin_stats_{period}")
+        for period in STATS_PERIODS
+    ])
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
+    return kb
+
+def format_admin_history(bookings, months):
+    """Сводка по месяцам: брони, оплаты, выручка"""
+    summary = {}
+    for b in bookings:
+        month = b.get('date', '')[:7]
+        row = summary.setdefault(month, {'total': 0, 'paid': 0, 'cancelled': 0, 'revenue': 0})
+        row['total'] += 1
+        if b.get('status') == 'paid':
+            row['paid'] += 1
+            row['revenue'] += b.get('price') or 0
+        elif b.get('status') == 'cancelled':
+            row['cancelled'] += 1
+    
+    text = f"🗂 <b>ИСТОРИЯ ЗА {months} МЕС.</b>\n\n"
+    if not summary:
+        return text + "📭 Броней нет"
+    for month in sorted(summary, reverse=True):
+        row = summary[month]
+        text += (
+            f"<b>{month}</b>\n"
+            f"   📋 Броней: {row['total']} · ✅ оплачено: {row['paid']} · ❌ отменено: {row['cancelled']}\n"
+            f"   💰 Выручка: {row['revenue']} ₽\n\n"
+        )
+    return text
 
 def format_admin_booking(booking):
     """Форматирование бронирования для администратора"""
@@ -918,14 +2067,9 @@ def format_admin_booking(booking):
         'full': '✨ Студия со звукорежем',
     }
     
+    booking = booking_model.as_booking(booking)
     date_str = booking.get('date', '')
-    times = booking.get('times', [])
-    if times:
-        start = min(times)
-        end = max(times) + 1
-        time_str = f"{start:02d}:00–{end:02d}:00 ({len(times)}ч)"
-    else:
-        time_str = "Время не указано"
+    time_str = booking.time_range() or "Время не указано"
     
     status = booking.get('status', 'pending')
     status_text = {
@@ -948,14 +2092,126 @@ def format_admin_booking(booking):
 📧 Email: {booking.get('email', 'N/A')}
 💬 Комментарий: {booking.get('comment', '-')}"""
 
-# ====== CALLBACK ОБРАБОТЧИКИ ============================================
+# ====== ЭКРАНЫ VIP =======================================================
 
-@bot.callback_query_handler(func=lambda c: c.data == "cancel")
-def cb_cancel(c):
-    chat_id = c.message.chat.id
-    user_states.pop(chat_id, None)
-    bot.edit_message_text("❌ <b>Отменено</b>", chat_id, c.message.message_id, parse_mode='HTML')
-    bot.send_message(chat_id, "🏠 <b>ГЛАВНОЕ МЕНЮ</b>\n\n<b>🎵 Выбери действие:</b>", reply_markup=main_menu_keyboard(chat_id), parse_mode='HTML')
+VIP_PAGE_SIZE = 10
+VIP_PAGE_CACHE_SIZE = 64
+
+# Экраны VIP: список (текст) и выбор клиента для удаления или цены (кнопки)
+VIP_SCREENS = {
+    'list': "📝 СПИСОК VIP КЛИЕНТОВ",
+    'remove': "➖ УДАЛЕНИЕ VIP КЛИЕНТА",
+    'price': "💰 НАСТРОЙКА ЦЕНЫ НА РЕПЕТИЦИЮ",
+}
+
+# Отсортированный по имени индекс VIP и кэш отрисованных страниц.
+# Версия растёт при каждом изменении VIP_USERS — индекс и кэш перестраиваются лениво.
+_vip_version = 0
+_vip_index = None  # (версия, [(имя в нижнем регистре, user_id), ...])
+_vip_pages_cache = collections.OrderedDict()
+_vip_lock = threading.Lock()
+
+def invalidate_vip_index():
+    global _vip_version
+    with _vip_lock:
+        _vip_version += 1
+        _vip_pages_cache.clear()
+
+def vip_index(query=''):
+    """user_id VIP по алфавиту; query — подстрока имени или начало ID"""
+    global _vip_index
+    with _vip_lock:
+        if _vip_index is None or _vip_index[0] != _vip_version:
+            _vip_index = (_vip_version, sorted(
+                ((str(v.get('name') or '').casefold(), uid) for uid, v in VIP_USERS.items()),
+            ))
+        entries = _vip_index[1]
+    query = query.strip().casefold()
+    if not query:
+        return [uid for _, uid in entries]
+    return [uid for name, uid in entries if query in name or str(uid).startswith(query)]
+
+def format_vip_line(user_id, vip_data):
+    name = html.escape(str(vip_data.get('name', 'Unknown')))
+    discount = vip_data.get('discount', 0)
+    custom_price = vip_data.get('custom_price_repet')
+    text = f"👤 <b>{name}</b>\n   ID: <code>{user_id}</code>\n"
+    if vip_data.get('tier'):
+        tier = VIP_TIERS.get(vip_data['tier'])
+        text += f"   🏷 Уровень: <b>{html.escape(vip_data['tier'])}</b>{'' if tier else ' (не найден)'}\n"
+    if custom_price is not None:
+        text += f"   💰 Репетиция: <b>{custom_price}₽/ч</b> (индивидуальная цена)\n"
+    elif discount and discount > 0:
+        text += f"   💎 Скидка: <b>{discount}%</b>\n"
+    elif not vip_data.get('tier'):
+        text += "   ⚙️ Настройки не заданы\n"
+    return text
+
+def vip_page(screen, page=0, query=''):
+    """Страница экрана VIP: (текст, клавиатура); готовые страницы берутся из кэша"""
+    key = (screen, page, query)
+    with _vip_lock:
+        cached = _vip_pages_cache.get(key)
+        if cached is not None:
+            _vip_pages_cache.move_to_end(key)
+            return cached
+        version = _vip_version
+    
+    ids = vip_index(query)
+    pages = max(1, (len(ids) + VIP_PAGE_SIZE - 1) // VIP_PAGE_SIZE)
+    page = min(max(page, 0), pages - 1)
+    chunk = ids[page * VIP_PAGE_SIZE:(page + 1) * VIP_PAGE_SIZE]
+    
+    text = f"<b>{VIP_SCREENS[screen]}</b>\n\n"
+    if query:
+        text += f"🔍 Поиск: <b>{html.escape(query)}</b> — найдено {len(ids)}\n\n"
+    kb = types.InlineKeyboardMarkup()
+    if not chunk:
+        text += "📭 Никого не найдено" if query else "📭 Список пуст"
+    elif screen == 'list':
+        text += "\n".join(format_vip_line(uid, VIP_USERS.get(uid, {})) for uid in chunk)
+    else:
+        text += "Выбери клиента для удаления:" if screen == 'remove' else "Выбери клиента для настройки цены:"
+        for uid in chunk:
+            vip_data = VIP_USERS.get(uid, {})
+            name = vip_data.get('name', 'Unknown')
+            if screen == 'remove':
+                kb.add(types.InlineKeyboardButton(f"❌ {name} (ID: {uid})", callback_data=f"admin_delete_vip_{uid}"))
+            else:
+                current_price = vip_data.get('custom_price_repet', 'не установлена')
+                kb.add(types.InlineKeyboardButton(f"💰 {name} (текущая: {current_price}₽/ч)", callback_data=f"admin_price_vip_{uid}"))
+    
+    if pages > 1:
+        nav = []
+        if page > 0:
+            nav.append(types.InlineKeyboardButton("◀️", callback_data=f"admin_vips_{screen}_{page - 1}"))
+        nav.append(types.InlineKeyboardButton(f"{page + 1}/{pages}", callback_data="admin_noop"))
+        if page < pages - 1:
+            nav.append(types.InlineKeyboardButton("▶️", callback_data=f"admin_vips_{screen}_{page + 1}"))
+        kb.row(*nav)
+    if query:
+        kb.add(types.InlineKeyboardButton("✖️ Сбросить поиск", callback_data=f"admin_vipreset_{screen}"))
+    else:
+        kb.add(types.InlineKeyboardButton("🔍 Поиск по имени или ID", callback_data=f"admin_vipsearch_{screen}"))
+    kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
+    
+    result = (text, kb)
+    with _vip_lock:
+        # Пока страница строилась, VIP могли измениться — такую не кэшируем
+        if version == _vip_version:
+            _vip_pages_cache[key] = result
+            while len(_vip_pages_cache) > VIP_PAGE_CACHE_SIZE:
+                _vip_pages_cache.popitem(last=False)
+    return result
+
+# ====== CALLBACK ОБРАБОТЧИКИ ============================================
+
+@bot.callback_query_handler(func=lambda c: c.data == "cancel")
+def cb_cancel(c):
+    chat_id = c.message.chat.id
+    user_states.pop(chat_id, None)
+    bot.edit_message_text("❌ <b>Отменено</b>", chat_id, c.message.message_id, parse_mode='HTML')
+    bot.send_message(chat_id, "🏠 <b>ГЛАВНОЕ МЕНЮ</b>\n\n<b>🎵 Выбери действие:</b>", reply_markup=main_menu_keyboard(chat_id), parse_mode='HTML')
 
 @bot.callback_query_handler(func=lambda c: c.data.startswith("service_"))
 def cb_service(c):
@@ -1213,7 +2469,39 @@ def cb_back_to_service(c):
     
     bot.edit_message_text(text, chat_id, c.message.message_id, reply_markup=kb, parse_mode='HTML')
 
-@bot.callback_query_handler(func=lambda c: c.data == "confirm_times")
+@bot.callback_query_handler(func=lambda c: c.data == "repeat_weeks")
+def cb_repeat_weeks(c):
+    """Переключение числа недель серии: 1 → 2 → 4 → 8 → 1"""
+    chat_id = c.message.chat.id
+    state = user_states.get(chat_id)
+    if not state or not state.get('selected_times'):
+        bot.answer_callback_query(c.id, "❌ Выбери хотя бы один час")
+        return
+    
+    weeks = state.get('weeks', 1)
+    state['weeks'] = RECURRING_WEEKS[(RECURRING_WEEKS.index(weeks) + 1) % len(RECURRING_WEEKS)] if weeks in RECURRING_WEEKS else 1
+    bot.edit_message_reply_markup(chat_id, c.message.message_id, reply_markup=times_keyboard(chat_id, state['date'], state['service']))
+    bot.answer_callback_query(c.id, f"🔁 {state['weeks']} нед." if state['weeks'] > 1 else "Без повтора")
+
+@bot.callback_query_handler(func=lambda c: c.data == "repeat_back")
+def cb_repeat_back(c):
+    """Возврат к выбору времени после конфликта серии"""
+    chat_id = c.message.chat.id
+    state = user_states.get(chat_id)
+    if not state:
+        bot.answer_callback_query(c.id, "⚠️ Начни бронирование заново")
+        return
+    
+    df = datetime.strptime(state['date'], "%Y-%m-%d").strftime("%d.%m.%Y")
+    bot.edit_message_text(
+        f"🎵 <b>ШАГ 2/4: ВЫБОР ВРЕМЕНИ</b>\n\n📅 <b>Дата:</b> {df}\n\n💚 <b>Выбери другое время или число недель</b>",
+        chat_id, c.message.message_id,
+        reply_markup=times_keyboard(chat_id, state['date'], state['service']),
+        parse_mode='HTML'
+    )
+    bot.answer_callback_query(c.id)
+
+@bot.callback_query_handler(func=lambda c: c.data in ("confirm_times", "repeat_free"))
 def cb_confirm_times(c):
     chat_id = c.message.chat.id
     state = user_states.get(chat_id)
@@ -1221,8 +2509,53 @@ def cb_confirm_times(c):
         bot.answer_callback_query(c.id, "❌ Выбери хотя бы один час")
         return
     
+    dates = recurring_dates(state['date'], state.get('weeks', 1))
+    if len(dates) > 1:
+        # Все даты серии проверяются одним запросом
+        conflicts = find_slot_conflicts(dates, state['service'], state['selected_times'])
+        free = [d for d in dates if d not in conflicts]
+        if conflicts and c.data == "repeat_free" and free:
+            dates = free
+        elif conflicts:
+            lines = "\n".join(
+                f"   • {datetime.strptime(d, '%Y-%m-%d').strftime('%d.%m.%Y')}: "
+                + ", ".join(f"{h:02d}:00" for h in hours)
+                for d, hours in conflicts.items()
+            )
+            kb = types.InlineKeyboardMarkup(row_width=1)
+            if free:
+                kb.add(types.InlineKeyboardButton(f"✅ Только свободные даты ({len(free)} из {len(dates)})", callback_data="repeat_free"))
+            kb.add(types.InlineKeyboardButton("🔙 Изменить время", callback_data="repeat_back"))
+            bot.edit_message_text(
+                f"🔁 <b>ЧАСТЬ ДАТ СЕРИИ ЗАНЯТА</b>\n\n🚫 <b>Уже заняты:</b>\n{lines}",
+                chat_id, c.message.message_id,
+                reply_markup=kb,
+                parse_mode='HTML'
+            )
+            bot.answer_callback_query(c.id)
+            return
+    state['dates'] = dates
     state['step'] = 'name'
     
+    profile = get_customer_profile(chat_id)
+    if profile and all(profile.get(k) for k in ('name', 'email', 'phone')):
+        # Повторный клиент: одно нажатие вместо четырёх шагов ввода
+        kb = types.InlineKeyboardMarkup(row_width=1)
+        kb.add(types.InlineKeyboardButton("✅ Да, всё верно", callback_data="profile_use"))
+        kb.add(types.InlineKeyboardButton("✏️ Ввести заново", callback_data="profile_manual"))
+        bot.edit_message_text(
+            "🎵 <b>ШАГ 3/4: КОНТАКТНЫЕ ДАННЫЕ</b>\n\n"
+            "💾 <b>Используем данные из прошлой брони?</b>\n\n"
+            f"👤 {html.escape(profile['name'])}\n"
+            f"📧 {html.escape(profile['email'])}\n"
+            f"☎️ {html.escape(profile['phone'])}",
+            chat_id, c.message.message_id,
+            reply_markup=kb,
+            parse_mode='HTML'
+        )
+        bot.answer_callback_query(c.id)
+        return
+    
     text = """🎵 <b>ШАГ 3/4: КОНТАКТНЫЕ ДАННЫЕ</b>   
 
 👤 <b>Как к тебе обращаться?</b>
@@ -1237,6 +2570,32 @@ def cb_confirm_times(c):
     bot.edit_message_text(text, chat_id, c.message.message_id, parse_mode='HTML')
     bot.send_message(chat_id, "\n👤 <b>ТВОЁ ИМЯ</b>   \n\n\n💡 <b>Как к тебе обращаться?</b>\n\n🎯 Можешь указать:\n   • Имя\n   • Никнейм\n   • Название проекта/группы\n\n<b>Введи ниже:</b>", reply_markup=cancel_keyboard(), parse_mode='HTML')
 
+@bot.callback_query_handler(func=lambda c: c.data in ("profile_use", "profile_manual"))
+def cb_profile(c):
+    """Подстановка сохранённых контактов или ручной ввод"""
+    chat_id = c.message.chat.id
+    state = user_states.get(chat_id)
+    if not state or state.get('step') != 'name':
+        if c.data == "profile_use" and (state or {}).get('step') == 'comment':
+            bot.answer_callback_query(c.id, "✅ Данные уже подставлены")
+            return
+        if c.data == "profile_use" and ((state or {}).get('step') == 'completing' or find_confirmation(chat_id)):
+            bot.answer_callback_query(c.id, "⏳ Бронь уже оформляется")
+            return
+        bot.answer_callback_query(c.id, "⚠️ Начни бронирование заново")
+        return
+    
+    profile = get_customer_profile(chat_id)
+    if c.data == "profile_use" and profile:
+        # Контакты — из профиля, комментарий у каждой брони свой
+        state.update(name=profile['name'], email=profile['email'], phone=profile['phone'])
+        bot.answer_callback_query(c.id, "✅ Данные подставлены")
+        ask_comment(chat_id, state)
+        return
+    
+    bot.answer_callback_query(c.id)
+    bot.send_message(chat_id, "\n👤 <b>ТВОЁ ИМЯ</b>   \n\n\n💡 <b>Как к тебе обращаться?</b>\n\n🎯 Можешь указать:\n   • Имя\n   • Никнейм\n   • Название проекта/группы\n\n<b>Введи ниже:</b>", reply_markup=cancel_keyboard(), parse_mode='HTML')
+
 @bot.callback_query_handler(func=lambda c: c.data == "skip")
 def cb_skip(c):
     bot.answer_callback_query(c.id, "⚠️ Это время занято")
@@ -1309,6 +2668,10 @@ def process_phone(m):
         return
     
     state['phone'] = phone
+    ask_comment(chat_id, state)
+
+def ask_comment(chat_id, state):
+    """Последний шаг ввода: комментарий, который можно пропустить"""
     state['step'] = 'comment'
     
     kb = types.ReplyKeyboardMarkup(row_width=1, resize_keyboard=True)
@@ -1339,6 +2702,69 @@ def process_comment(m):
 
 # ====== ОБРАБОТЧИКИ АДМИН-ПАНЕЛИ VIP ======================================
 
+@bot.message_handler(func=lambda m: m.chat.id in user_states and user_states[m.chat.id].get('admin_step') == 'search')
+def process_admin_search(m):
+    """Поисковый запрос администратора"""
+    chat_id = m.chat.id
+    if not is_admin(chat_id):
+        return
+    user_states.pop(chat_id, None)
+    send_admin_search_results(chat_id, m.text or '')
+
+@bot.message_handler(func=lambda m: m.chat.id in user_states and user_states[m.chat.id].get('admin_step') == 'vip_search')
+def process_admin_vip_search(m):
+    """Поиск VIP по имени или ID на экранах VIP"""
+    chat_id = m.chat.id
+    if not is_admin(chat_id):
+        return
+    state = user_states[chat_id]
+    screen = state.get('vip_screen', 'list')
+    query = (m.text or '').strip()[:64]
+    user_states[chat_id] = {'vip_query': query}
+    text, kb = vip_page(screen if screen in VIP_SCREENS else 'list', 0, query)
+    bot.send_message(chat_id, text, reply_markup=kb, parse_mode='HTML')
+
+@bot.message_handler(content_types=['document'], func=lambda m: m.chat.id in user_states and user_states[m.chat.id].get('admin_step') == 'vip_import')
+def process_admin_vip_import(m):
+    """Массовый импорт VIP или уровней из CSV-документа"""
+    chat_id = m.chat.id
+    if not is_admin(chat_id):
+        return
+    
+    if m.document.file_size and m.document.file_size > VIP_IMPORT_MAX_BYTES:
+        bot.send_message(chat_id, "❌ <b>Файл слишком большой</b> (максимум 1 МБ)", parse_mode='HTML')
+        return
+    
+    try:
+        raw = bot.download_file(bot.get_file(m.document.file_id).file_path)
+    except Exception as e:
+        log_error(f"Ошибка загрузки CSV импорта VIP: {str(e)}", e)
+        bot.send_message(chat_id, "❌ Не удалось скачать файл, попробуй ещё раз")
+        return
+    try:
+        text = raw.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        # Excel под Windows сохраняет CSV в cp1251
+        text = raw.decode('cp1251', errors='replace')
+    
+    kind, records, errors = vip_rules.parse_csv(text, VIP_TIERS)
+    if errors:
+        shown = "\n".join(f"   • {html.escape(e)}" for e in errors[:15])
+        more = f"\n   … и ещё {len(errors) - 15}" if len(errors) > 15 else ""
+        bot.send_message(chat_id, f"❌ <b>Импорт не выполнен</b>, ошибки:\n{shown}{more}\n\nИсправь файл и отправь снова.", parse_mode='HTML')
+        return
+    
+    try:
+        count = import_vip_records(kind, records)
+    except Exception as e:
+        log_error(f"Ошибка импорта VIP: {str(e)}", e)
+        bot.send_message(chat_id, "❌ Ошибка записи — ничего не импортировано, попробуй позже")
+        return
+    
+    user_states.pop(chat_id, None)
+    what = "уровней" if kind == 'tiers' else "VIP клиентов"
+    bot.send_message(chat_id, f"✅ <b>Импортировано {what}: {count}</b>", reply_markup=admin_panel_keyboard(), parse_mode='HTML')
+
 @bot.message_handler(func=lambda m: m.chat.id in user_states and user_states[m.chat.id].get('admin_step') == 'add_vip_id')
 def process_admin_add_vip_id(m):
     """Обработка ID VIP клиента"""
@@ -1394,7 +2820,7 @@ def process_admin_add_vip_discount(m):
             'name': vip_name,
             'discount': discount if discount > 0 else None
         }
-        save_vip_users()
+        save_vip_user(int(vip_id))
         
         bot.send_message(
             chat_id,
@@ -1436,7 +2862,7 @@ def process_admin_set_price_repet(m):
             # Удаляем индивидуальную цену
             if 'custom_price_repet' in vip_data:
                 del vip_data['custom_price_repet']
-            save_vip_users()
+            save_vip_user(target_user)
             bot.send_message(
                 chat_id,
                 f"✅ <b>Индивидуальная цена удалена!</b>\n\n"
@@ -1448,7 +2874,7 @@ def process_admin_set_price_repet(m):
         else:
             # Устанавливаем индивидуальную цену
             vip_data['custom_price_repet'] = price
-            save_vip_users()
+            save_vip_user(target_user)
             bot.send_message(
                 chat_id,
                 f"✅ <b>Цена установлена!</b>\n\n"
@@ -1464,6 +2890,29 @@ def process_admin_set_price_repet(m):
 
 # ====== ЮKASSA API ======================================================
 
+def yookassa_request(operation, method, url, **kwargs):
+    """Запрос к ЮKassa через выключатель; None — выключатель разомкнут.
+
+    Ошибкой для выключателя считаются исключения транспорта, 5xx и 429,
+    медленным — ответ дольше YOOKASSA_BREAKER.slow_seconds.
+    """
+    if not YOOKASSA_BREAKER.allow():
+        YOOKASSA_REJECTED.inc(operation)
+        return None
+    started = time.perf_counter()
+    ok = False
+    try:
+        with YOOKASSA_SECONDS.time(operation):
+            response = yookassa_http(method, url, timeout=YOOKASSA_TIMEOUT, **kwargs)
+        ok = response.status_code < 500 and response.status_code != 429
+        return response
+    finally:
+        changed = YOOKASSA_BREAKER.record(ok, time.perf_counter() - started)
+        if changed == circuit_breaker.OPEN:
+            log_error(f"⚡ ЮKassa: выключатель разомкнут на {YOOKASSA_BREAKER.open_seconds:.0f} с")
+        elif changed == circuit_breaker.CLOSED:
+            log_info("✅ ЮKassa: выключатель снова замкнут")
+
 def check_payment_status(payment_id):
     """Проверка статуса платежа через API ЮKassa"""
     try:
@@ -1480,11 +2929,14 @@ def check_payment_status(payment_id):
             "Authorization": f"Basic {auth_b64}"
         }
         
-        response = requests.get(
-            f"https://api.yookassa.ru/v3/payments/{payment_id}",
-            headers=headers,
-            timeout=10
+        response = yookassa_request(
+            'check_payment',
+            "GET",
+            f"{YOOKASSA_API_URL}/payments/{payment_id}",
+            headers=headers
         )
+        if response is None:
+            return {'success': False, 'error': 'ЮKassa временно недоступна'}
         
         if response.status_code == 200:
             payment_info = response.json()
@@ -1495,17 +2947,24 @@ def check_payment_status(payment_id):
                 'payment_info': payment_info
             }
         else:
+            YOOKASSA_ERRORS.inc('check_payment')
             return {
                 'success': False,
                 'error': f"API вернул код {response.status_code}: {response.text[:300]}"
             }
             
     except Exception as e:
+        YOOKASSA_ERRORS.inc('check_payment')
         log_error(f"Ошибка проверки статуса платежа: {str(e)}", e)
         return {'success': False, 'error': str(e)}
 
-def create_yookassa_payment(amount, description, booking_id, customer_email, customer_phone, receipt_items):
-    """Создание платежа через API ЮKassa"""
+def create_yookassa_payment(amount, description, booking_id, customer_email, customer_phone, receipt_items, booking_ids=None, idempotence_key=None):
+    """Создание платежа через API ЮKassa.
+
+    booking_ids — все брони серии, оплачиваемые одним платежом.
+    idempotence_key — ключ повторов одного и того же платежа.
+    В ответе retryable=True — сбой на стороне ЮKassa, запрос можно повторить.
+    """
     try:
         if not YOOKASSA_SHOP_ID or not YOOKASSA_SECRET_KEY:
             return {'success': False, 'error': 'Ключи ЮKassa не настроены'}
@@ -1541,18 +3000,24 @@ def create_yookassa_payment(amount, description, booking_id, customer_email, cus
             }
         }
         
+        if booking_ids:
+            payment_data["metadata"]["booking_ids"] = ",".join(str(i) for i in booking_ids)
+        
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Basic {auth_b64}",
-            "Idempotence-Key": str(uuid.uuid4())
+            "Idempotence-Key": idempotence_key or str(uuid.uuid4())
         }
         
-        response = requests.post(
-            "https://api.yookassa.ru/v3/payments",
+        response = yookassa_request(
+            'create_payment',
+            "POST",
+            f"{YOOKASSA_API_URL}/payments",
             json=payment_data,
-            headers=headers,
-            timeout=10
+            headers=headers
         )
+        if response is None:
+            return {'success': False, 'error': 'ЮKassa временно недоступна', 'retryable': True}
         
         if response.status_code == 200:
             payment_info = response.json()
@@ -1562,18 +3027,118 @@ def create_yookassa_payment(amount, description, booking_id, customer_email, cus
                 'payment_id': payment_info.get("id")
             }
         else:
+            YOOKASSA_ERRORS.inc('create_payment')
             return {
                 'success': False,
-                'error': f"API вернул код {response.status_code}: {response.text[:300]}"
+                'error': f"API вернул код {response.status_code}: {response.text[:300]}",
+                'retryable': response.status_code >= 500 or response.status_code == 429
             }
             
     except Exception as e:
+        YOOKASSA_ERRORS.inc('create_payment')
         log_error(f"Ошибка создания платежа: {str(e)}", e)
-        return {'success': False, 'error': str(e)}
+        return {'success': False, 'error': str(e), 'retryable': True}
 
 # ====== ЗАВЕРШЕНИЕ БРОНИ ================================================
 
+_payment_executor = concurrent.futures.ThreadPoolExecutor(PAYMENT_WORKERS, thread_name_prefix="payment")
+_payment_futures = set()
+
+def drain_payments(timeout):
+    """Ожидание начатых вторых фаз оплаты не дольше timeout секунд; True — все завершились.
+
+    Незавершённые остаются в очереди отложенных ссылок и повторяются после рестарта.
+    """
+    _, not_done = concurrent.futures.wait(set(_payment_futures), timeout=timeout)
+    return not not_done
+
+# Идемпотентность последнего шага: у сессии брони один токен подтверждения.
+# Пока бронь по чату оформляется, повторные нажатия не запускают вторую;
+# повтор уже оформленной сессии получает тот же платёж, а не новый.
+CONFIRMATION_TTL = 15 * 60  # секунды
+_confirmations_lock = threading.Lock()
+_confirming_chats = set()
+_confirmations = {}  # token -> {'chat_id', 'booking_ids', 'at'}
+_last_confirmation = {}  # chat_id -> token
+
+def confirmation_token(state):
+    """Токен подтверждения сессии брони (создаётся при первом обращении)"""
+    return state.setdefault('confirm_token', uuid.uuid4().hex)
+
+@contextlib.contextmanager
+def confirmation_in_flight(chat_id):
+    """Одно оформление брони на чат; внутри — False, если оформление уже идёт"""
+    with _confirmations_lock:
+        first = chat_id not in _confirming_chats
+        _confirming_chats.add(chat_id)
+    try:
+        yield first
+    finally:
+        if first:
+            with _confirmations_lock:
+                _confirming_chats.discard(chat_id)
+
+def remember_confirmation(chat_id, token, booking_ids):
+    now = time.time()
+    with _confirmations_lock:
+        for old in [t for t, c in _confirmations.items() if now - c['at'] > CONFIRMATION_TTL]:
+            if _last_confirmation.get(_confirmations[old]['chat_id']) == old:
+                del _last_confirmation[_confirmations[old]['chat_id']]
+            del _confirmations[old]
+        _confirmations[token] = {'chat_id': chat_id, 'booking_ids': list(booking_ids), 'at': now}
+        _last_confirmation[chat_id] = token
+
+def find_confirmation(chat_id, token=None):
+    """Уже оформленная бронь по токену сессии или последняя бронь чата"""
+    with _confirmations_lock:
+        token = token or _last_confirmation.get(chat_id)
+        confirmation = _confirmations.get(token)
+    if confirmation and time.time() - confirmation['at'] <= CONFIRMATION_TTL:
+        return confirmation
+    return None
+
+def resend_confirmation(chat_id, confirmation):
+    """Ответ на повторное подтверждение: платёж уже созданной брони"""
+    ids = set(confirmation['booking_ids'])
+    booking = next((b for b in load_bookings() if b.get('id') in ids), None)
+    if booking and booking.get('status') == 'paid':
+        bot.send_message(chat_id, "✅ <b>Эта бронь уже оформлена и оплачена</b>", reply_markup=main_menu_keyboard(chat_id), parse_mode='HTML')
+    elif booking and booking.get('status') == 'awaiting_payment' and booking.get('payment_url'):
+        bot.send_message(
+            chat_id,
+            "💳 <b>Бронь уже оформлена</b> — вот ссылка на её оплату, новый платёж не создаётся.",
+            reply_markup=payment_keyboard(booking['payment_url']),
+            parse_mode='HTML'
+        )
+    elif booking and booking.get('status') == 'awaiting_payment':
+        bot.send_message(chat_id, "⏳ <b>Бронь уже оформлена</b>, платёж создаётся — кнопка оплаты появится в сообщении выше.", parse_mode='HTML')
+    else:
+        bot.send_message(chat_id, "ℹ️ Эта бронь уже была оформлена. Её статус — в «📋 Мои бронирования».", reply_markup=main_menu_keyboard(chat_id), parse_mode='HTML')
+
 def complete_booking(chat_id):
+    """Завершение брони: не больше одного оформления на сессию"""
+    state = user_states.get(chat_id)
+    if not state:
+        confirmation = find_confirmation(chat_id)
+        if confirmation:
+            resend_confirmation(chat_id, confirmation)
+            return
+        _complete_booking(chat_id, None)
+        return
+    
+    token = confirmation_token(state)
+    with confirmation_in_flight(chat_id) as first:
+        if not first:
+            log_info(f"Повторное подтверждение брони во время оформления: chat_id={chat_id}")
+            bot.send_message(chat_id, "⏳ Уже оформляем твою бронь — секунду…")
+            return
+        confirmation = find_confirmation(chat_id, token)
+        if confirmation:
+            resend_confirmation(chat_id, confirmation)
+            return
+        _complete_booking(chat_id, token)
+
+def _complete_booking(chat_id, token):
     """Завершение брони и создание платежа"""
     try:
         state = user_states.get(chat_id)
@@ -1603,57 +3168,24 @@ def complete_booking(chat_id):
         service = state.get('service', 'repet')
         duration = len(sel)
         
-        # Принудительно используем правильные цены
-        prices = config.get('prices', {})
-        
-        # Проверяем индивидуальную цену для VIP на репетицию
-        custom_price_repet = get_user_custom_price_repet(chat_id) if service == 'repet' else None
-        
-        if custom_price_repet is not None:
-            # Используем индивидуальную цену для VIP
-            base_price = custom_price_repet * duration
-            price = base_price
-            discount_text = f" (VIP цена: {custom_price_repet}₽/ч)"
-            log_info(f"Использована индивидуальная цена VIP для репетиции: {custom_price_repet}₽/ч × {duration}ч = {price}₽")
-        else:
-            # Обычный расчет
-            if service == 'full':
-                base_price = prices.get('full', 1500)
-            elif service == 'repet':
-                # 700 рублей за час репетиции
-                base_price = 700 * duration
-                log_info(f"Расчёт цены репетиции: 700₽ × {duration}ч = {base_price}₽")
-            elif service == 'studio':
-                base_price = prices.get('studio', 800) * duration
-            else:
-                base_price = prices.get(service, 700) * duration
-            
-            log_info(f"Расчёт цены: service={service}, duration={duration}, base_price={base_price}₽")
-            
-            price = base_price
-            discount_text = ""
-            
-            vip_discount = get_user_discount(chat_id)
-            if vip_discount > 0:
-                price = int(base_price * (1 - vip_discount / 100))
-                discount_text = f" (VIP -{vip_discount}%)"
-            elif duration >= 5:
-                price = int(base_price * 0.85)
-                discount_text = " (-15%)"
-            elif duration >= 3:
-                price = int(base_price * 0.9)
-                discount_text = " (-10%)"
+        pricing = calculate_price(chat_id, service, duration, config)
+        price = pricing['price']
+        discount_text = format_discount(pricing, "VIP цена")
+        log_debug("Расчёт цены: service=%s, duration=%s, base_price=%s₽, price=%s₽",
+                  service, duration, pricing['base_price'], price)
         
         if price <= 0:
             bot.send_message(chat_id, "❌ <b>Ошибка расчёта цены.</b>", parse_mode='HTML')
             return
         
-        booking_id = int(datetime.now().timestamp() * 1000) % 1000000000
-        booking = {
-            'id': booking_id,
+        # Серия «каждую неделю» — несколько броней с одним общим платежом
+        dates = state.get('dates') or [state.get('date')]
+        booking_id = allocate_booking_ids(len(dates))
+        series = [{
+            'id': booking_id + i,
             'user_id': chat_id,
             'service': service,
-            'date': state.get('date'),
+            'date': date,
             'times': sel,
             'duration': duration,
             'name': state.get('name', 'Unknown'),
@@ -1663,10 +3195,24 @@ def complete_booking(chat_id):
             'price': price,
             'status': 'awaiting_payment',
             'created_at': datetime.now().isoformat(),
-        }
-        
-        add_booking(booking)
+        } for i, date in enumerate(dates)]
+        booking = series[0]
+        total = price * len(series)
         
+        if len(series) > 1:
+            conflicts = add_bookings_atomic(series)
+            if conflicts:
+                busy = ", ".join(datetime.strptime(d, "%Y-%m-%d").strftime("%d.%m") for d in conflicts)
+                bot.send_message(
+                    chat_id,
+                    f"🚫 <b>Пока ты вводил данные, часть дат заняли:</b> {busy}\n\n💡 Начни бронирование заново и выбери другое время.",
+                    reply_markup=main_menu_keyboard(chat_id),
+                    parse_mode='HTML'
+                )
+                user_states.pop(chat_id, None)
+                return
+        else:
+            add_booking(booking)
         names = {
             'repet': '🎸 Репетиция',
             'studio': '🎧 Студия (самостоятельно)',
@@ -1677,6 +3223,9 @@ def complete_booking(chat_id):
         df = d.strftime("%d.%m.%Y")
         start, end = min(sel), max(sel) + 1
         
+        if len(series) > 1:
+            df = ", ".join(datetime.strptime(b['date'], "%Y-%m-%d").strftime("%d.%m") for b in series)
+        
         description = (
             f"🎵 {STUDIO_NAME}\n"
             f"📅 {df}\n"
@@ -1685,71 +3234,68 @@ def complete_booking(chat_id):
         )[:255]
         
         customer_email = state.get('email', '').strip().lower()
-        customer_phone = state.get('phone', '').strip()
-        phone_digits = ''.join(c for c in customer_phone if c.isdigit())
-        if phone_digits.startswith('8') and len(phone_digits) == 11:
-            phone_digits = '7' + phone_digits[1:]
-        elif not phone_digits.startswith('7') and len(phone_digits) == 10:
-            phone_digits = '7' + phone_digits
+        phone_digits = normalize_phone(state.get('phone', ''))
         
+        # Отдельная позиция чека на каждое занятие серии
         receipt_items = [{
-            "description": names.get(service, service)[:128],
+            "description": (names.get(service, service) if len(series) == 1
+                            else f"{names.get(service, service)} {datetime.strptime(b['date'], '%Y-%m-%d').strftime('%d.%m.%Y')}")[:128],
             "quantity": 1,
             "amount": {"value": f"{price:.2f}", "currency": "RUB"},
             "vat_code": 1,
             "payment_mode": "full_payment",
             "payment_subject": "service"
-        }]
-        
-        payment_result = create_yookassa_payment(
-            amount=price,
-            description=description + discount_text,
-            booking_id=booking_id,
-            customer_email=customer_email if re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', customer_email) else None,
-            customer_phone=phone_digits if len(phone_digits) == 11 and phone_digits.startswith('7') else None,
-            receipt_items=receipt_items
-        )
+        } for b in series]
         
-        if not payment_result['success']:
-            bot.send_message(
-                chat_id,
-                f"\n⚠️ <b>ОШИБКА ОПЛАТЫ</b>   \n\n\n❌ <b>Не удалось создать платёж</b>\n\n💡 <b>Что делать:</b>\n   • Попробуй ещё раз через минуту\n   • Или свяжись с нами — мы поможем!\n\n\n\n<b>📞 КОНТАКТЫ:</b>\n📱 <b>Telegram:</b> {STUDIO_TELEGRAM}\n☎️ <b>Телефон:</b> +{STUDIO_CONTACT}\n\n<b>🎵 Мы всегда готовы помочь!</b>",
-                reply_markup=main_menu_keyboard(chat_id),
-                parse_mode='HTML'
-            )
-            cancel_booking_by_id(booking_id)
-            return
-        
-        bookings = load_bookings()
-        for b in bookings:
-            if b.get('id') == booking_id:
-                b['yookassa_payment_id'] = payment_result['payment_id']
-                b['payment_url'] = payment_result['payment_url']
-                break
-        save_bookings(bookings)
-        
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("💳 Оплатить", url=payment_result['payment_url']))
-        kb.add(types.InlineKeyboardButton("📋 Мои бронирования", callback_data="back_to_bookings"))
+        payment_request = {
+            'amount': total,
+            'description': description + discount_text,
+            'booking_id': booking_id,
+            'booking_ids': [b['id'] for b in series] if len(series) > 1 else None,
+            'customer_email': customer_email if re.match(r'^[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}$', customer_email) else None,
+            'customer_phone': phone_digits if len(phone_digits) == 11 and phone_digits.startswith('7') else None,
+            'receipt_items': receipt_items,
+        }
+        # Повтор с тем же токеном не создаст в ЮKassa второй платёж
+        idempotence_key = token or str(uuid.uuid4())
         
+        summary = (
+            f"📅 <b>{'Даты' if len(series) > 1 else 'Дата'}:</b> {df}\n"
+            f"⏰ <b>Время:</b> {start:02d}:00–{end:02d}:00 ({duration}ч)\n"
+            f"💰 <b>Сумма:</b> {total} ₽{discount_text}{f' ({len(series)} × {price} ₽)' if len(series) > 1 else ''}"
+        )
         payment_message = f"""💳 <b>ОПЛАТА БРОНИРОВАНИЯ</b>   
 
 <b>🎵 Почти готово! Осталось оплатить</b>
 
-📅 <b>Дата:</b> {df}
-⏰ <b>Время:</b> {start:02d}:00–{end:02d}:00 ({duration}ч)
-💰 <b>Сумма:</b> {price} ₽{discount_text}
+{summary}
 
 <b>⚡ Нажми кнопку ниже для оплаты:</b>
 💳 <b>Безопасная оплата через ЮKassa</b>
 🔒 <b>Чек придёт на email автоматически</b>"""
         
-        bot.send_message(chat_id, payment_message, reply_markup=kb, parse_mode='HTML')
+        # Фаза 1: бронь записана — сразу отвечаем, платёж создаётся в фоне
+        msg = bot.send_message(
+            chat_id,
+            f"⏳ <b>СОЗДАЁМ ПЛАТЁЖ…</b>\n\n{summary}\n\n💳 Кнопка оплаты появится в этом сообщении через пару секунд.",
+            parse_mode='HTML'
+        )
+        remember_confirmation(chat_id, idempotence_key, [b['id'] for b in series])
         user_states.pop(chat_id, None)
-        log_info(f"Платеж создан: booking_id={booking_id}, сумма={price}₽")
+        log_info(f"Бронь создана, платёж в очереди: booking_id={booking_id}, броней={len(series)}, сумма={total}₽")
+        
+        # Фаза 2: ЮKassa — в пуле платежей, поток обработчика освобождается.
+        # Запрос сначала сохраняется в очередь отложенных платежей: если процесс
+        # перезапустится до finish_payment, ссылку создаст retry_pending_payments
+        pending = defer_payment_link(chat_id, [b['id'] for b in series], payment_request, idempotence_key,
+                                     payment_message, in_flight=True)
+        future = _payment_executor.submit(finish_payment, chat_id, msg.message_id, pending, summary)
+        _payment_futures.add(future)
+        future.add_done_callback(_payment_futures.discard)
         
         # Уведомляем администратора о новом бронировании
-        notify_admin_new_booking(booking)
+        for b in series:
+            notify_admin_new_booking(b)
         
     except Exception as e:
         log_error(f"complete_booking: {str(e)}", e)
@@ -1759,6 +3305,232 @@ def complete_booking(chat_id):
             parse_mode='HTML'
         )
 
+def finish_payment(chat_id, message_id, pending, summary):
+    """Вторая фаза брони: создание платежа и правка сообщения «создаём платёж…».
+
+    pending — запись очереди отложенных платежей (defer_payment_link): она
+    снимается, когда исход известен; если ЮKassa недоступна или поток упал,
+    запись остаётся и платёж повторяет retry_pending_payments.
+    """
+    booking_ids = pending['booking_ids']
+    payment_request = pending['request']
+    try:
+        result = create_yookassa_payment(**payment_request, idempotence_key=pending['idempotence_key'])
+        
+        if result['success']:
+            attach_payment(booking_ids, result)
+            _drop_pending_payment(pending)
+            replace_or_send(chat_id, message_id, pending['message'], payment_keyboard(result['payment_url']))
+            log_info(f"Платеж создан: booking_id={payment_request['booking_id']}, payment_id={result['payment_id']}")
+            return
+        
+        if result.get('retryable'):
+            # ЮKassa недоступна: бронь остаётся за клиентом, ссылка придёт позже —
+            # запрос уже в очереди отложенных платежей
+            replace_or_send(
+                chat_id, message_id,
+                f"⏳ <b>БРОНЬ СОХРАНЕНА</b>\n\n{summary}\n\n"
+                f"💳 Платёжная система сейчас отвечает с задержкой. Время держим за тобой, "
+                f"пока готовим ссылку, — <b>пришлём её сюда</b>, как только она будет готова.\n\n"
+                f"📞 Вопросы: {STUDIO_TELEGRAM}",
+            )
+            log_info(f"Ссылка на оплату отложена: booking_id={payment_request['booking_id']}, причина: {result.get('error')}")
+            return
+        
+        for booking_id in booking_ids:
+            cancel_booking_by_id(booking_id)
+        _drop_pending_payment(pending)
+        replace_or_send(
+            chat_id, message_id,
+            f"\n⚠️ <b>ОШИБКА ОПЛАТЫ</b>   \n\n\n❌ <b>Не удалось создать платёж</b> — бронь снята\n\n💡 <b>Что делать:</b>\n   • Попробуй ещё раз через минуту\n   • Или свяжись с нами — мы поможем!\n\n\n\n<b>📞 КОНТАКТЫ:</b>\n📱 <b>Telegram:</b> {STUDIO_TELEGRAM}\n☎️ <b>Телефон:</b> +{STUDIO_CONTACT}\n\n<b>🎵 Мы всегда готовы помочь!</b>",
+        )
+    except Exception as e:
+        log_error(f"finish_payment: {str(e)}", e)
+    finally:
+        with _pending_payments_lock:
+            _payments_in_flight.discard(pending['idempotence_key'])
+
+def replace_or_send(chat_id, message_id, text, reply_markup=None):
+    """Замена сообщения «создаём платёж…»; если его не отредактировать
+    (удалено, сбой сети) — тот же текст новым сообщением"""
+    try:
+        bot.edit_message_text(text, chat_id, message_id, reply_markup=reply_markup, parse_mode='HTML')
+    except Exception as e:
+        log_error(f"Не удалось отредактировать сообщение {message_id}, отправляю новое: {str(e)}", e)
+        bot.send_message(chat_id, text, reply_markup=reply_markup, parse_mode='HTML')
+
+def attach_payment(booking_ids, payment_result):
+    """Запись ID платежа и ссылки на оплату во все брони серии"""
+    invalidate_booking_pages()
+    if database.is_enabled():
+        database.set_booking_payment(booking_ids, payment_result['payment_id'], payment_result['payment_url'])
+        invalidate_booking_cache(*booking_ids)
+        return
+    
+    ids = set(booking_ids)
+    with _bookings_file_lock:
+        bookings = load_bookings()
+        for b in bookings:
+            if b.get('id') in ids:
+                b['yookassa_payment_id'] = payment_result['payment_id']
+                b['payment_url'] = payment_result['payment_url']
+        save_bookings(bookings)
+
+def payment_keyboard(payment_url):
+    kb = types.InlineKeyboardMarkup()
+    kb.add(types.InlineKeyboardButton("💳 Оплатить", url=payment_url))
+    kb.add(types.InlineKeyboardButton("📋 Мои бронирования", callback_data="back_to_bookings"))
+    return kb
+
+def send_payment_link(chat_id, payment_message, payment_url):
+    bot.send_message(chat_id, payment_message, reply_markup=payment_keyboard(payment_url), parse_mode='HTML')
+
+# ====== ОТЛОЖЕННЫЕ ССЫЛКИ НА ОПЛАТУ ======================================
+
+# Запросы платежей, которые не удалось создать из-за сбоя ЮKassa.
+# Хранятся в bot_state (БД) или в файле; повторяются фоновым потоком
+# с тем же Idempotence-Key, чтобы не создать два платежа.
+_pending_payments = []
+_pending_payments_lock = threading.Lock()
+# Idempotence-Key платежей, которые прямо сейчас создаёт finish_payment: их
+# retry_pending_payments пропускает. После перезапуска множество пустое, и
+# недоделанные вторые фазы подхватывает повтор
+_payments_in_flight = set()
+
+def load_pending_payments():
+    """Загрузка очереди отложенных платежей"""
+    items = None
+    if database.is_enabled():
+        try:
+            items = database.get_state('pending_payments')
+        except Exception as e:
+            log_error(f"load_pending_payments (db): {str(e)}", e)
+    if items is None:
+        try:
+            if os.path.exists(PENDING_PAYMENTS_FILE):
+                with open(PENDING_PAYMENTS_FILE, 'r', encoding='utf-8') as f:
+                    items = json.load(f)
+        except Exception as e:
+            log_error(f"load_pending_payments: {str(e)}", e)
+    with _pending_payments_lock:
+        _pending_payments[:] = items or []
+    if _pending_payments:
+        log_info(f"Отложенных ссылок на оплату: {len(_pending_payments)}")
+
+def save_pending_payments():
+    """Сохранение очереди; вызывается под _pending_payments_lock"""
+    items = list(_pending_payments)
+    if database.is_enabled():
+        try:
+            database.set_state('pending_payments', items)
+            return
+        except Exception as e:
+            log_error(f"save_pending_payments (db): {str(e)}", e)
+    try:
+        tmp_path = f"{PENDING_PAYMENTS_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(items, f, ensure_ascii=False)
+        os.replace(tmp_path, PENDING_PAYMENTS_FILE)
+    except Exception as e:
+        log_error(f"save_pending_payments: {str(e)}", e)
+
+def defer_payment_link(chat_id, booking_ids, payment_request, idempotence_key, payment_message, in_flight=False):
+    """Постановка платежа в очередь повторов; in_flight — его сейчас создаёт finish_payment"""
+    item = {
+        'chat_id': chat_id,
+        'booking_ids': booking_ids,
+        'request': payment_request,
+        'idempotence_key': idempotence_key,
+        'message': payment_message,
+        'created_at': time.time(),
+        'attempts': 0,
+    }
+    with _pending_payments_lock:
+        _pending_payments.append(item)
+        if in_flight:
+            _payments_in_flight.add(idempotence_key)
+        save_pending_payments()
+    return item
+
+def _drop_pending_payment(item):
+    with _pending_payments_lock:
+        if item in _pending_payments:
+            _pending_payments.remove(item)
+            save_pending_payments()
+
+def retry_pending_payments(now=None):
+    """Повтор отложенных платежей; останавливается на первом сбое ЮKassa"""
+    now = now or time.time()
+    with _pending_payments_lock:
+        items = [item for item in _pending_payments if item['idempotence_key'] not in _payments_in_flight]
+    for item in items:
+        if YOOKASSA_BREAKER.retry_after() > 0:
+            return
+        ids = set(item['booking_ids'])
+        waiting = [b for b in load_bookings() if b.get('id') in ids and b.get('status') == 'awaiting_payment']
+        if not waiting:
+            # Клиент отменил бронь, пока ссылка ждала
+            _drop_pending_payment(item)
+            continue
+        
+        if now - item['created_at'] > PENDING_PAYMENTS_MAX_AGE:
+            for booking_id in ids:
+                cancel_booking_by_id(booking_id)
+            _drop_pending_payment(item)
+            log_info(f"Отложенный платёж снят по времени: брони {sorted(ids)}")
+            try:
+                bot.send_message(
+                    item['chat_id'],
+                    f"😔 <b>Платёжная система так и не ответила</b> — бронь снята.\n\n"
+                    f"💡 Попробуй забронировать ещё раз или напиши нам: {STUDIO_TELEGRAM}",
+                    reply_markup=main_menu_keyboard(item['chat_id']),
+                    parse_mode='HTML'
+                )
+            except Exception as e:
+                log_error(f"Ошибка уведомления о снятой брони: {str(e)}", e)
+            continue
+        
+        result = create_yookassa_payment(**item['request'], idempotence_key=item['idempotence_key'])
+        if not result['success']:
+            if result.get('retryable'):
+                with _pending_payments_lock:
+                    item['attempts'] += 1
+                return
+            # ЮKassa ответила, но отказала — повторять бессмысленно
+            log_error(f"Отложенный платёж отклонён: {result.get('error')}")
+            for booking_id in ids:
+                cancel_booking_by_id(booking_id)
+            _drop_pending_payment(item)
+            try:
+                bot.send_message(
+                    item['chat_id'],
+                    f"❌ <b>Не удалось создать платёж</b> — бронь снята.\n\n📞 Напиши нам: {STUDIO_TELEGRAM}",
+                    reply_markup=main_menu_keyboard(item['chat_id']),
+                    parse_mode='HTML'
+                )
+            except Exception as e:
+                log_error(f"Ошибка уведомления об отклонённом платеже: {str(e)}", e)
+            continue
+        
+        attach_payment(item['booking_ids'], result)
+        _drop_pending_payment(item)
+        log_info(f"Отложенная ссылка на оплату создана: брони {sorted(ids)}, попыток: {item['attempts'] + 1}")
+        try:
+            send_payment_link(item['chat_id'], item['message'], result['payment_url'])
+        except Exception as e:
+            log_error(f"Ошибка отправки отложенной ссылки на оплату: {str(e)}", e)
+
+def pending_payments_worker():
+    """Фоновые повторы отложенных платежей"""
+    while True:
+        time.sleep(PENDING_PAYMENTS_RETRY_INTERVAL)
+        if not _pending_payments:
+            continue
+        try:
+            retry_pending_payments()
+        except Exception as e:
+            log_error(f"Ошибка в pending_payments_worker: {str(e)}", e)
+
 # ====== УВЕДОМЛЕНИЯ ======================================================
 
 def notify_admin_new_booking(booking):
@@ -1767,21 +3539,6 @@ def notify_admin_new_booking(booking):
         return
     
     try:
-        names = {
-            'repet': '🎸 Репетиция',
-            'studio': '🎧 Студия (самостоятельная)',
-            'full': '✨ Студия со звукорежем',
-        }
-        
-        date_str = booking.get('date', '')
-        times = booking.get('times', [])
-        if times:
-            start = min(times)
-            end = max(times) + 1
-            time_str = f"{start:02d}:00–{end:02d}:00 ({len(times)}ч)"
-        else:
-            time_str = "Время не указано"
-        
         text = f"""🆕 <b>НОВОЕ БРОНИРОВАНИЕ</b>
 
 {format_admin_booking(booking)}
@@ -1791,7 +3548,7 @@ def notify_admin_new_booking(booking):
 📧 {booking.get('email', 'N/A')}
 
 <b>⏳ Статус:</b> Ожидает оплаты
-💳 Клиенту отправлена ссылка на оплату"""
+💳 Платёж создаётся — клиент получит ссылку на оплату"""
         
         bot.send_message(ADMIN_CHAT_ID, text, parse_mode='HTML')
         log_info(f"Уведомление администратору о новом бронировании {booking.get('id')}")
@@ -1804,21 +3561,6 @@ def notify_admin_payment_success(booking):
         return
     
     try:
-        names = {
-            'repet': '🎸 Репетиция',
-            'studio': '🎧 Студия (самостоятельная)',
-            'full': '✨ Студия со звукорежем',
-        }
-        
-        date_str = booking.get('date', '')
-        times = booking.get('times', [])
-        if times:
-            start = min(times)
-            end = max(times) + 1
-            time_str = f"{start:02d}:00–{end:02d}:00 ({len(times)}ч)"
-        else:
-            time_str = "Время не указано"
-        
         text = f"""✅ <b>БРОНИРОВАНИЕ ОПЛАЧЕНО</b>
 
 {format_admin_booking(booking)}
@@ -1848,15 +3590,9 @@ def notify_payment_success(booking):
             'full': '✨ Студия со звукорежем',
         }
         
-        d = datetime.strptime(booking['date'], "%Y-%m-%d")
-        df = d.strftime("%d.%m.%Y")
-        
-        if booking.get('times'):
-            start = min(booking['times'])
-            end = max(booking['times']) + 1
-            t_str = f"{start:02d}:00 – {end:02d}:00 ({len(booking['times'])}ч)"
-        else:
-            t_str = "-"
+        model = booking_model.as_booking(booking)
+        df = model.date_label()
+        t_str = model.time_range(" – ") or "-"
         
         text = f"""✅ <b>ОПЛАТА ПОЛУЧЕНА!</b>   
 
@@ -1900,8 +3636,7 @@ def notify_payment_success(booking):
 def cb_booking_detail(c):
     chat_id = c.message.chat.id
     booking_id = int(c.data.replace("booking_detail_", ""))
-    bookings = load_bookings()
-    booking = next((b for b in bookings if b.get('id') == booking_id), None)
+    booking = get_booking(booking_id)
     
     if not booking:
         bot.answer_callback_query(c.id, "❌ Бронь не найдена")
@@ -1914,16 +3649,13 @@ def cb_booking_detail(c):
         payment_status = check_payment_status(payment_id)
         if payment_status.get('success') and payment_status.get('paid'):
             # Платеж успешен, обновляем статус
-            for i, b in enumerate(bookings):
+            _, paid = mark_bookings_paid([booking_id], payment_id)
+            for b in paid:
                 if b.get('id') == booking_id:
-                    bookings[i]['status'] = 'paid'
-                    bookings[i]['paid_at'] = datetime.now().isoformat()
-                    save_bookings(bookings)
-                    booking = bookings[i]
-                    log_info(f"Статус брони {booking_id} обновлен на 'paid' после проверки")
-                    notify_payment_success(booking)
-                    notify_admin_payment_success(booking)
-                    break
+                    booking = b
+                log_info(f"Статус брони {b.get('id')} обновлен на 'paid' после проверки")
+                notify_payment_success(b)
+                notify_admin_payment_success(b)
     
     names = {
         'repet': '🎸 Репетиция',
@@ -1931,21 +3663,18 @@ def cb_booking_detail(c):
         'full': '✨ Студия со звукорежем',
     }
     
-    d = datetime.strptime(booking['date'], "%Y-%m-%d")
-    df = d.strftime("%d.%m.%Y")
-    
-    if booking.get('times'):
-        start = min(booking['times'])
-        end = max(booking['times']) + 1
-        t_str = f"{start:02d}:00 – {end:02d}:00 ({len(booking['times'])}ч)"
-    else:
-        t_str = "-"
+    model = booking_model.as_booking(booking)
+    df = model.date_label()
+    t_str = model.time_range(" – ") or "-"
     
     status = booking.get('status', 'pending')
     status_text = "оплачена ✅" if status == 'paid' else "ожидает оплаты ⏳"
     
     # Если есть payment_url и статус awaiting_payment, показываем кнопку оплаты
     payment_url = booking.get('payment_url')
+    payment_note = ""
+    if status == 'awaiting_payment' and not payment_url:
+        payment_note = "\n⏳ <i>Ссылка на оплату придёт сообщением, как только платёжная система ответит</i>\n"
     
     text = f"""📋 <b>ДЕТАЛИ СЕАНСА</b>   
 
@@ -1960,7 +3689,7 @@ def cb_booking_detail(c):
 <b>👤 Имя:</b> {booking['name']}
 <b>☎️ Телефон:</b> {booking['phone']}
 <b>💬 Комментарий:</b> {booking.get('comment', '-')}
-
+{payment_note}
 <b>🎯 Что сделать?</b>"""
     
     kb = types.InlineKeyboardMarkup()
@@ -1980,8 +3709,7 @@ def cb_check_payment(c):
     """Проверка статуса оплаты по запросу пользователя"""
     chat_id = c.message.chat.id
     booking_id = int(c.data.replace("check_payment_", ""))
-    bookings = load_bookings()
-    booking = next((b for b in bookings if b.get('id') == booking_id), None)
+    booking = get_booking(booking_id)
     
     if not booking:
         bot.answer_callback_query(c.id, "❌ Бронь не найдена")
@@ -2013,16 +3741,13 @@ def cb_check_payment(c):
     if payment_status.get('success'):
         if payment_status.get('paid'):
             # Платеж успешен, обновляем статус
-            for i, b in enumerate(bookings):
+            _, paid = mark_bookings_paid([booking_id], payment_id)
+            for b in paid:
                 if b.get('id') == booking_id:
-                    bookings[i]['status'] = 'paid'
-                    bookings[i]['paid_at'] = datetime.now().isoformat()
-                    save_bookings(bookings)
-                    booking = bookings[i]
-                    log_info(f"Статус брони {booking_id} обновлен на 'paid' после ручной проверки")
-                    notify_payment_success(booking)
-                    notify_admin_payment_success(booking)
-                    break
+                    booking = b
+                log_info(f"Статус брони {b.get('id')} обновлен на 'paid' после ручной проверки")
+                notify_payment_success(b)
+                notify_admin_payment_success(b)
             
             bot.answer_callback_query(c.id, "✅ Оплата подтверждена!")
             # Обновляем сообщение - создаём новый callback для cb_booking_detail
@@ -2047,7 +3772,14 @@ def cb_cancel_booking_confirm(c):
     chat_id = c.message.chat.id
     booking_id = int(c.data.replace("cancel_booking_", ""))
     
-    cancelled = cancel_booking_by_id(booking_id)
+    # Статус проверяем до отмены: cancel_booking_by_id возвращает бронь уже
+    # отменённой, и оплаченная бронь отменилась бы без возврата денег
+    booking = get_booking(booking_id)
+    if not booking:
+        bot.answer_callback_query(c.id, "❌ Бронь не найдена")
+        return
+    
+    cancelled = booking if booking.get('status') == 'paid' else cancel_booking_by_id(booking_id)
     
     if cancelled:
         status = cancelled.get('status', '')
@@ -2073,7 +3805,7 @@ def cb_cancel_booking_confirm(c):
 @bot.callback_query_handler(func=lambda c: c.data == "back_to_bookings")
 def cb_back_to_bookings(c):
     chat_id = c.message.chat.id
-    bookings = load_bookings()
+    bookings = load_booking_models()
     kb = bookings_keyboard(bookings, chat_id)
     
     if kb:
@@ -2124,55 +3856,82 @@ def cb_admin(c):
         bot.answer_callback_query(c.id, "❌ Доступ запрещён")
         return
     
-    bookings = load_bookings()
     now = datetime.now()
-    today = now.strftime("%Y-%m-%d")
-    tomorrow = (now + timedelta(days=1)).strftime("%Y-%m-%d")
-    
-    if c.data == "admin_all_bookings":
-        # Все бронирования
-        active_bookings = [b for b in bookings if b.get('status') in ['paid', 'pending', 'awaiting_payment']]
-        if not active_bookings:
-            bot.answer_callback_query(c.id, "📭 Нет активных бронирований")
-            bot.edit_message_text("📭 <b>Нет активных бронирований</b>", chat_id, c.message.message_id, parse_mode='HTML')
-            return
-        
-        text = f"📋 <b>ВСЕ АКТИВНЫЕ БРОНИРОВАНИЯ ({len(active_bookings)})</b>\n\n"
-        for booking in sorted(active_bookings, key=lambda x: (x.get('date', ''), min(x.get('times', [0])))):
-            text += format_admin_booking(booking) + "\n\n"
-        
-        bot.edit_message_text(text, chat_id, c.message.message_id, parse_mode='HTML')
-        bot.answer_callback_query(c.id, f"✅ Найдено {len(active_bookings)} бронирований")
     
-    elif c.data == "admin_today_bookings":
-        # Бронирования сегодня
-        today_bookings = [b for b in bookings if b.get('date') == today and b.get('status') in ['paid', 'pending', 'awaiting_payment']]
-        if not today_bookings:
-            bot.answer_callback_query(c.id, "📭 Нет бронирований на сегодня")
-            bot.edit_message_text(f"📭 <b>Нет бронирований на {today}</b>", chat_id, c.message.message_id, parse_mode='HTML')
+    if c.data in ("admin_all_bookings", "admin_today_bookings", "admin_tomorrow_bookings"):
+        # Первая страница списка
+        view = c.data[len("admin_"):-len("_bookings")]
+        text, kb = admin_bookings_page(view)
+        bot.edit_message_text(text, chat_id, c.message.message_id, reply_markup=kb, parse_mode='HTML')
+        bot.answer_callback_query(c.id)
+    
+    elif c.data.startswith("admin_page_"):
+        # Листание: admin_page_<view>_<p|n>_<date>_<start_hour>_<id>
+        _, _, view, direction, date, hour, booking_id = c.data.split("_")
+        if view not in ADMIN_LIST_VIEWS:
+            bot.answer_callback_query(c.id, "❌ Неизвестный список")
             return
-        
-        text = f"📅 <b>БРОНИРОВАНИЯ СЕГОДНЯ ({len(today_bookings)})</b>\n\n"
-        for booking in sorted(today_bookings, key=lambda x: min(x.get('times', [0]))):
-            text += format_admin_booking(booking) + "\n\n"
-        
-        bot.edit_message_text(text, chat_id, c.message.message_id, parse_mode='HTML')
-        bot.answer_callback_query(c.id, f"✅ Найдено {len(today_bookings)} бронирований")
+        text, kb = admin_bookings_page(view, (date, int(hour), int(booking_id)), backward=direction == "p")
+        bot.edit_message_text(text, chat_id, c.message.message_id, reply_markup=kb, parse_mode='HTML')
+        bot.answer_callback_query(c.id)
+    
+    elif c.data == "admin_search":
+        user_states[chat_id] = {'admin_step': 'search'}
+        bot.send_message(
+            chat_id,
+            "🔍 <b>ПОИСК КЛИЕНТА</b>\n\n"
+            "Введи телефон (в любом формате), часть имени, email или Telegram ID.\n"
+            "💡 Можно и без меню: <code>/find 79991234567</code>",
+            parse_mode='HTML'
+        )
+        bot.answer_callback_query(c.id)
     
-    elif c.data == "admin_tomorrow_bookings":
-        # Бронирования завтра
-        tomorrow_bookings = [b for b in bookings if b.get('date') == tomorrow and b.get('status') in ['paid', 'pending', 'awaiting_payment']]
-        if not tomorrow_bookings:
-            bot.answer_callback_query(c.id, "📭 Нет бронирований на завтра")
-            bot.edit_message_text(f"📭 <b>Нет бронирований на {tomorrow}</b>", chat_id, c.message.message_id, parse_mode='HTML')
+    elif c.data.startswith("admin_stats_"):
+        days = int(c.data.rsplit("_", 1)[1])
+        if days not in STATS_PERIODS:
+            days = 30
+        summary = load_stats_summary(days)
+        try:
+            bot.edit_message_text(format_admin_stats(summary, days), chat_id, c.message.message_id,
+                                  reply_markup=stats_keyboard(days), parse_mode='HTML')
+        except telebot.apihelper.ApiTelegramException as e:
+            # Повторное нажатие того же периода: «message is not modified»
+            if "not modified" not in str(e):
+                raise
+        bot.answer_callback_query(c.id)
+    
+    elif c.data == "admin_history":
+        # Сводка по месяцам, включая архив
+        months = 6
+        # Текущий месяц и months - 1 предыдущих календарных, по сегодняшний день
+        month_index = now.year * 12 + now.month - 1 - (months - 1)
+        date_from = f"{month_index // 12:04d}-{month_index % 12 + 1:02d}-01"
+        history = load_booking_history(date_from=date_from, date_to=now.strftime("%Y-%m-%d"))
+        kb = types.InlineKeyboardMarkup()
+        kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
+        bot.edit_message_text(format_admin_history(history, months), chat_id, c.message.message_id, reply_markup=kb, parse_mode='HTML')
+    
+    elif c.data == "admin_export":
+        bot.edit_message_text(
+            "📤 <b>ВЫГРУЗКА БРОНЕЙ</b>\n\n"
+            "Выбери период и формат — файл придёт отдельным сообщением.\n"
+            "В выгрузку попадают и архивные брони.",
+            chat_id, c.message.message_id,
+            reply_markup=export_keyboard(),
+            parse_mode='HTML'
+        )
+    
+    elif c.data.startswith("admin_export_"):
+        _, _, fmt, code = c.data.split("_", 3)
+        if fmt not in reports.WRITERS:
+            bot.answer_callback_query(c.id, "❌ Неизвестный формат")
             return
-        
-        text = f"📅 <b>БРОНИРОВАНИЯ ЗАВТРА ({len(tomorrow_bookings)})</b>\n\n"
-        for booking in sorted(tomorrow_bookings, key=lambda x: min(x.get('times', [0]))):
-            text += format_admin_booking(booking) + "\n\n"
-        
-        bot.edit_message_text(text, chat_id, c.message.message_id, parse_mode='HTML')
-        bot.answer_callback_query(c.id, f"✅ Найдено {len(tomorrow_bookings)} бронирований")
+        bot.answer_callback_query(c.id, "⏳ Готовлю файл...")
+        try:
+            send_bookings_export(chat_id, fmt, code)
+        except Exception as e:
+            log_error(f"Ошибка выгрузки броней: {str(e)}", e)
+            bot.send_message(chat_id, "❌ Не удалось подготовить выгрузку, попробуй позже")
     
     elif c.data == "admin_add_vip":
         # Добавление VIP клиента
@@ -2188,84 +3947,59 @@ def cb_admin(c):
             parse_mode='HTML'
         )
     
-    elif c.data == "admin_remove_vip":
-        # Удаление VIP клиента
-        if not VIP_USERS:
-            bot.answer_callback_query(c.id, "📭 Список VIP пуст")
+    elif c.data in ("admin_remove_vip", "admin_set_price_repet", "admin_list_vip"):
+        screen = {'admin_remove_vip': 'remove', 'admin_set_price_repet': 'price', 'admin_list_vip': 'list'}[c.data]
+        if screen != 'list' and not VIP_USERS:
+            bot.answer_callback_query(c.id, "📭 Список VIP пуст" if screen == 'remove' else "📭 Список VIP пуст. Сначала добавь VIP клиента.")
             return
-        
-        kb = types.InlineKeyboardMarkup()
-        for user_id, vip_data in VIP_USERS.items():
-            name = vip_data.get('name', 'Unknown')
-            kb.add(types.InlineKeyboardButton(
-                f"❌ {name} (ID: {user_id})",
-                callback_data=f"admin_delete_vip_{user_id}"
-            ))
-        kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
-        
-        bot.edit_message_text(
-            "<b>➖ УДАЛЕНИЕ VIP КЛИЕНТА</b>\n\n"
-            "Выбери клиента для удаления:",
-            chat_id, c.message.message_id,
-            reply_markup=kb,
-            parse_mode='HTML'
-        )
+        user_states.get(chat_id, {}).pop('vip_query', None)
+        text, kb = vip_page(screen)
+        bot.edit_message_text(text, chat_id, c.message.message_id, reply_markup=kb, parse_mode='HTML')
     
-    elif c.data == "admin_set_price_repet":
-        # Настройка цены на репетицию
-        if not VIP_USERS:
-            bot.answer_callback_query(c.id, "📭 Список VIP пуст. Сначала добавь VIP клиента.")
+    elif c.data.startswith("admin_vips_"):
+        # Листание экранов VIP: admin_vips_{экран}_{страница}
+        screen, page = c.data[len("admin_vips_"):].rsplit("_", 1)
+        if screen not in VIP_SCREENS:
+            bot.answer_callback_query(c.id, "❌ Неизвестный список")
             return
-        
+        query = user_states.get(chat_id, {}).get('vip_query', '')
+        text, kb = vip_page(screen, int(page), query)
+        bot.edit_message_text(text, chat_id, c.message.message_id, reply_markup=kb, parse_mode='HTML')
+        bot.answer_callback_query(c.id)
+    
+    elif c.data.startswith("admin_vipsearch_"):
+        user_states[chat_id] = {'admin_step': 'vip_search', 'vip_screen': c.data[len("admin_vipsearch_"):]}
+        bot.answer_callback_query(c.id)
+        bot.send_message(chat_id, "🔍 <b>Введи часть имени или начало Telegram ID:</b>", parse_mode='HTML')
+    
+    elif c.data.startswith("admin_vipreset_"):
+        user_states.get(chat_id, {}).pop('vip_query', None)
+        screen = c.data[len("admin_vipreset_"):]
+        text, kb = vip_page(screen if screen in VIP_SCREENS else 'list')
+        bot.edit_message_text(text, chat_id, c.message.message_id, reply_markup=kb, parse_mode='HTML')
+        bot.answer_callback_query(c.id)
+    
+    elif c.data == "admin_vip_import":
+        user_states[chat_id] = {'admin_step': 'vip_import'}
+        tiers = ", ".join(html.escape(t) for t in sorted(VIP_TIERS)) or "пока нет"
         kb = types.InlineKeyboardMarkup()
-        for user_id, vip_data in VIP_USERS.items():
-            name = vip_data.get('name', 'Unknown')
-            current_price = vip_data.get('custom_price_repet', 'не установлена')
-            kb.add(types.InlineKeyboardButton(
-                f"💰 {name} (текущая: {current_price}₽/ч)",
-                callback_data=f"admin_price_vip_{user_id}"
-            ))
         kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
-        
         bot.edit_message_text(
-            "<b>💰 НАСТРОЙКА ЦЕНЫ НА РЕПЕТИЦИЮ</b>\n\n"
-            "Выбери клиента для настройки цены:",
+            "<b>📥 ИМПОРТ VIP ИЗ CSV</b>\n\n"
+            "Отправь CSV-файл документом (разделитель <code>,</code> или <code>;</code>, UTF-8).\n\n"
+            "<b>VIP клиенты:</b>\n"
+            f"<code>{','.join(vip_rules.VIP_CSV_COLUMNS)}</code>\n\n"
+            "<b>Уровни</b> (скидка % и цены ₽/ч по услугам):\n"
+            f"<code>{','.join(vip_rules.TIER_CSV_COLUMNS)}</code>\n\n"
+            f"🏷 Уровни сейчас: {tiers}\n\n"
+            "💡 Пустая ячейка — значение не задано. Файл с ошибками не импортируется целиком.",
             chat_id, c.message.message_id,
             reply_markup=kb,
             parse_mode='HTML'
         )
     
-    elif c.data == "admin_list_vip":
-        # Список VIP клиентов
-        if not VIP_USERS:
-            bot.edit_message_text(
-                "<b>📋 СПИСОК VIP КЛИЕНТОВ</b>\n\n"
-                "📭 Список пуст",
-                chat_id, c.message.message_id,
-                parse_mode='HTML'
-            )
-            return
-        
-        text = "<b>📋 СПИСОК VIP КЛИЕНТОВ</b>\n\n"
-        for user_id, vip_data in VIP_USERS.items():
-            name = vip_data.get('name', 'Unknown')
-            discount = vip_data.get('discount', 0)
-            custom_price = vip_data.get('custom_price_repet')
-            
-            text += f"👤 <b>{name}</b>\n"
-            text += f"   ID: <code>{user_id}</code>\n"
-            if custom_price is not None:
-                text += f"   💰 Репетиция: <b>{custom_price}₽/ч</b> (индивидуальная цена)\n"
-            elif discount and discount > 0:
-                text += f"   💎 Скидка: <b>{discount}%</b>\n"
-            else:
-                text += f"   ⚙️ Настройки не заданы\n"
-            text += "\n"
-        
-        kb = types.InlineKeyboardMarkup()
-        kb.add(types.InlineKeyboardButton("🔙 Назад", callback_data="admin_back"))
-        
-        bot.edit_message_text(text, chat_id, c.message.message_id, reply_markup=kb, parse_mode='HTML')
+    elif c.data == "admin_noop":
+        bot.answer_callback_query(c.id)
     
     elif c.data == "admin_vip_id_hint":
         # Подсказка для клиента по поиску ID
@@ -2298,15 +4032,7 @@ def cb_admin(c):
     
     elif c.data == "admin_back":
         # Возврат в админ-панель
-        kb = types.InlineKeyboardMarkup(row_width=1)
-        kb.add(types.InlineKeyboardButton("📋 Все бронирования", callback_data="admin_all_bookings"))
-        kb.add(types.InlineKeyboardButton("📅 Бронирования сегодня", callback_data="admin_today_bookings"))
-        kb.add(types.InlineKeyboardButton("📅 Бронирования завтра", callback_data="admin_tomorrow_bookings"))
-        kb.add(types.InlineKeyboardButton("➕ Добавить VIP клиента", callback_data="admin_add_vip"))
-        kb.add(types.InlineKeyboardButton("➖ Удалить VIP клиента", callback_data="admin_remove_vip"))
-        kb.add(types.InlineKeyboardButton("💰 Настроить цену на репетицию", callback_data="admin_set_price_repet"))
-        kb.add(types.InlineKeyboardButton("📝 Список VIP клиентов", callback_data="admin_list_vip"))
-        kb.add(types.InlineKeyboardButton("📱 Подсказка для клиента (ID)", callback_data="admin_vip_id_hint"))
+        kb = admin_panel_keyboard()
         
         bot.edit_message_text(
             "👨‍💼 <b>АДМИН-ПАНЕЛЬ</b>\n\n"
@@ -2322,19 +4048,11 @@ def cb_admin(c):
         if user_id in VIP_USERS:
             name = VIP_USERS[user_id].get('name', 'Unknown')
             del VIP_USERS[user_id]
-            save_vip_users()
+            save_vip_user(user_id)
             bot.answer_callback_query(c.id, "✅ VIP клиент удален")
             
             # Возвращаемся в админ-панель
-            kb = types.InlineKeyboardMarkup(row_width=1)
-            kb.add(types.InlineKeyboardButton("📋 Все бронирования", callback_data="admin_all_bookings"))
-            kb.add(types.InlineKeyboardButton("📅 Бронирования сегодня", callback_data="admin_today_bookings"))
-            kb.add(types.InlineKeyboardButton("📅 Бронирования завтра", callback_data="admin_tomorrow_bookings"))
-            kb.add(types.InlineKeyboardButton("➕ Добавить VIP клиента", callback_data="admin_add_vip"))
-            kb.add(types.InlineKeyboardButton("➖ Удалить VIP клиента", callback_data="admin_remove_vip"))
-            kb.add(types.InlineKeyboardButton("💰 Настроить цену на репетицию", callback_data="admin_set_price_repet"))
-            kb.add(types.InlineKeyboardButton("📝 Список VIP клиентов", callback_data="admin_list_vip"))
-            kb.add(types.InlineKeyboardButton("📱 Подсказка для клиента (ID)", callback_data="admin_vip_id_hint"))
+            kb = admin_panel_keyboard()
             
             bot.edit_message_text(
                 "👨‍💼 <b>АДМИН-ПАНЕЛЬ</b>\n\n"
@@ -2375,21 +4093,6 @@ def send_admin_notification(booking, notification_type):
     if not ADMIN_CHAT_ID or ADMIN_CHAT_ID <= 0:
         return
     
-    names = {
-        'repet': '🎸 Репетиция',
-        'studio': '🎧 Студия (самостоятельная)',
-        'full': '✨ Студия со звукорежем',
-    }
-    
-    date_str = booking.get('date', '')
-    times = booking.get('times', [])
-    if times:
-        start = min(times)
-        end = max(times) + 1
-        time_str = f"{start:02d}:00–{end:02d}:00 ({len(times)}ч)"
-    else:
-        time_str = "Время не указано"
-    
     if notification_type == "24h":
         emoji = "⏰"
         title = "НАПОМИНАНИЕ: Бронь через 24 часа"
@@ -2419,48 +4122,31 @@ def check_and_send_notifications():
         return
     
     try:
-        bookings = load_bookings()
         now = datetime.now()
+        today = now.toordinal()
         
-        for booking in bookings:
-            if booking.get('status') not in ['paid', 'pending', 'awaiting_payment']:
+        for booking in load_booking_models():
+            # Напоминания нужны только броням на сегодня, завтра и послезавтра
+            if booking.ordinal is None or not today <= booking.ordinal <= today + 2:
                 continue
-            
-            date_str = booking.get('date', '')
-            times = booking.get('times', [])
-            if not date_str or not times:
+            if booking.get('status') not in ACTIVE_STATUSES:
                 continue
             
             try:
-                booking_date = datetime.strptime(date_str, "%Y-%m-%d")
-                start_hour = min(times)
-                booking_datetime = booking_date.replace(hour=start_hour, minute=0, second=0, microsecond=0)
+                starts_at = booking.starts_at()
+                if starts_at is None:
+                    continue
+                hours_until = (starts_at - now).total_seconds() / 3600
                 
-                # Проверяем уведомление за 24 часа
-                time_until = booking_datetime - now
-                hours_until = time_until.total_seconds() / 3600
-                
-                # Проверяем, не отправляли ли уже уведомление за 24 часа
-                notified_24h = booking.get('notified_24h', False)
-                if 23.5 <= hours_until <= 24.5 and not notified_24h:
+                # Уведомление за 24 часа, если ещё не отправляли
+                if 23.5 <= hours_until <= 24.5 and not booking.get('notified_24h', False):
                     send_admin_notification(booking, "24h")
-                    # Помечаем, что уведомление отправлено
-                    for i, b in enumerate(bookings):
-                        if b.get('id') == booking.get('id'):
-                            bookings[i]['notified_24h'] = True
-                            save_bookings(bookings)
-                            break
+                    set_booking_flag(booking.get('id'), 'notified_24h')
                 
-                # Проверяем уведомление за 30 минут
-                notified_30m = booking.get('notified_30m', False)
-                if 0.4 <= hours_until <= 0.6 and not notified_30m:
+                # Уведомление за 30 минут
+                if 0.4 <= hours_until <= 0.6 and not booking.get('notified_30m', False):
                     send_admin_notification(booking, "30m")
-                    # Помечаем, что уведомление отправлено
-                    for i, b in enumerate(bookings):
-                        if b.get('id') == booking.get('id'):
-                            bookings[i]['notified_30m'] = True
-                            save_bookings(bookings)
-                            break
+                    set_booking_flag(booking.get('id'), 'notified_30m')
             except Exception as e:
                 log_error(f"Ошибка проверки уведомления для брони {booking.get('id')}: {str(e)}", e)
     except Exception as e:
@@ -2477,10 +4163,126 @@ def notification_worker():
             log_error(f"Ошибка в notification_worker: {str(e)}", e)
             time.sleep(60)
 
+def maintenance_worker():
+    """Фоновое обслуживание: перенос старых броней в архив"""
+    while True:
+        try:
+            archive_old_bookings()
+        except Exception as e:
+            log_error(f"Ошибка в maintenance_worker: {str(e)}", e)
+        time.sleep(ARCHIVE_INTERVAL)
+
+# ====== ДЕДУПЛИКАЦИЯ АПДЕЙТОВ ============================================
+
+# Кольцевой буфер последних update_id: deque хранит порядок, set — быстрый поиск.
+# Сохраняется в bot_state (БД) или в файл раз в PROCESSED_UPDATES_FLUSH_INTERVAL.
+_processed_updates = collections.deque()
+_processed_update_ids = set()
+_processed_updates_lock = threading.Lock()
+_processed_updates_dirty = False
+
+def load_processed_updates():
+    """Загрузка буфера обработанных update_id"""
+    ids = None
+    if database.is_enabled():
+        try:
+            ids = database.get_state('processed_updates')
+        except Exception as e:
+            log_error(f"load_processed_updates (db): {str(e)}", e)
+    if ids is None:
+        try:
+            if os.path.exists(PROCESSED_UPDATES_FILE):
+                with open(PROCESSED_UPDATES_FILE, 'r', encoding='utf-8') as f:
+                    ids = json.load(f)
+        except Exception as e:
+            log_error(f"load_processed_updates: {str(e)}", e)
+    
+    with _processed_updates_lock:
+        _processed_updates.clear()
+        _processed_update_ids.clear()
+        for update_id in (ids or [])[-PROCESSED_UPDATES_LIMIT:]:
+            _processed_updates.append(update_id)
+            _processed_update_ids.add(update_id)
+    log_info(f"Загружено обработанных update_id: {len(_processed_updates)}")
+
+def claim_update(update_id):
+    """Отмечает апдейт обработанным; False — если он уже был"""
+    global _processed_updates_dirty
+    with _processed_updates_lock:
+        if update_id in _processed_update_ids:
+            return False
+        _processed_updates.append(update_id)
+        _processed_update_ids.add(update_id)
+        if len(_processed_updates) > PROCESSED_UPDATES_LIMIT:
+            _processed_update_ids.discard(_processed_updates.popleft())
+        _processed_updates_dirty = True
+    return True
+
+def save_processed_updates():
+    """Сохранение буфера, если он изменился с прошлого раза"""
+    global _processed_updates_dirty
+    with _processed_updates_lock:
+        if not _processed_updates_dirty:
+            return
+        ids = list(_processed_updates)
+        _processed_updates_dirty = False
+    
+    if database.is_enabled():
+        try:
+            database.set_state('processed_updates', ids)
+            return
+        except Exception as e:
+            log_error(f"save_processed_updates (db): {str(e)}", e)
+    
+    try:
+        tmp_path = f"{PROCESSED_UPDATES_FILE}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(ids, f)
+        os.replace(tmp_path, PROCESSED_UPDATES_FILE)
+    except Exception as e:
+        log_error(f"save_processed_updates: {str(e)}", e)
+
+def processed_updates_worker():
+    """Периодическое сохранение буфера обработанных update_id"""
+    while True:
+        time.sleep(PROCESSED_UPDATES_FLUSH_INTERVAL)
+        try:
+            save_processed_updates()
+        except Exception as e:
+            log_error(f"Ошибка в processed_updates_worker: {str(e)}", e)
+
+def process_updates(updates):
+    """Передача апдейтов в обработчики без повторов; возвращает число новых"""
+    fresh = [u for u in updates if claim_update(u.update_id)]
+    if len(fresh) < len(updates):
+        log_info(f"Пропущено повторных апдейтов: {len(updates) - len(fresh)}")
+    if fresh:
+        bot.process_new_updates(fresh)
+    return len(fresh)
+
+def drain_pending_updates():
+    """Разбор очереди апдейтов через getUpdates, пока webhook не установлен"""
+    started = time.perf_counter()
+    offset = None
+    total = 0
+    while True:
+        updates = bot.get_updates(offset=offset, limit=100, timeout=0)
+        if not updates:
+            break
+        total += process_updates(updates)
+        offset = updates[-1].update_id + 1
+    if offset is not None:
+        # Подтверждаем последнюю пачку, чтобы Telegram не отдал её ещё раз
+        bot.get_updates(offset=offset, limit=1, timeout=0)
+    log_info(f"⏱ Накопленные апдейты разобраны: {total} за {(time.perf_counter() - started) * 1000:.0f} мс")
+    return total
+
 # ====== FLASK И WEBHOOK ==================================================
 
 app = Flask(__name__)
 PORT = int(os.environ.get("PORT", 10000))
+# Режим webhook-сервера: threaded (Flask + пул потоков telebot) или asyncio (aiohttp)
+BOT_RUNTIME = os.environ.get("BOT_RUNTIME", "threaded").strip().lower()
 
 # Определение публичного URL для разных платформ
 RAILWAY_PUBLIC_DOMAIN = os.environ.get("RAILWAY_PUBLIC_DOMAIN", "")
@@ -2536,13 +4338,18 @@ def detect_platform():
 def health():
     return "🎵 MACHATA bot работает!", 200
 
+@app.route("/metrics", methods=["GET"])
+def metrics_endpoint():
+    return metrics.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+
 @app.route(f"/{API_TOKEN}/", methods=["POST"])
 def webhook():
     try:
         json_data = request.get_json()
         if json_data:
+            log_debug("Webhook update %s", json_data.get('update_id'), sample_every=100)
             update = telebot.types.Update.de_json(json_data)
-            bot.process_new_updates([update])
+            process_updates([update])
         return "ok", 200
     except Exception as e:
         log_error(f"webhook: {str(e)}", e)
@@ -2551,7 +4358,14 @@ def webhook():
 @app.route("/payment", methods=["POST"])
 def yookassa_webhook():
     try:
-        json_data = request.get_json()
+        return handle_payment_notification(request.get_json())
+    except Exception as e:
+        log_error(f"yookassa_webhook: {str(e)}", e)
+        return "error", 500
+
+def handle_payment_notification(json_data):
+    """Уведомление ЮKassa о платеже; возвращает (тело ответа, HTTP-код)"""
+    try:
         if not json_data:
             log_error("yookassa_webhook: пустой запрос")
             return "error", 400
@@ -2571,31 +4385,19 @@ def yookassa_webhook():
                 log_error(f"yookassa_webhook: booking_id не найден в metadata для payment_id={payment_id}")
                 return "error", 400
             
-            bookings = load_bookings()
-            booking = None
-            booking_index = None
+            # Общий платёж серии закрывает все её брони
+            booking_ids = (metadata.get("booking_ids") or str(booking_id)).split(",")
+            found, paid = mark_bookings_paid(booking_ids, payment_id)
             
-            for i, b in enumerate(bookings):
-                if str(b.get('id')) == str(booking_id):
-                    booking = b
-                    booking_index = i
-                    break
-            
-            if not booking:
+            if not found:
                 log_error(f"yookassa_webhook: бронь {booking_id} не найдена")
                 return "error", 404
-        
-            # Обновляем статус только если ещё не оплачена
-            if booking.get('status') != 'paid':
-                log_info(f"Обновление статуса брони {booking_id} на 'paid' после успешной оплаты")
-                bookings[booking_index]['status'] = 'paid'
-                bookings[booking_index]['paid_at'] = datetime.now().isoformat()
-                bookings[booking_index]['yookassa_payment_id'] = payment_id
-                save_bookings(bookings)
-                notify_payment_success(bookings[booking_index])
-                notify_admin_payment_success(bookings[booking_index])
-                log_info(f"Бронь {booking_id} успешно подтверждена после оплаты")
-            else:
+            
+            for b in paid:
+                notify_payment_success(b)
+                notify_admin_payment_success(b)
+                log_info(f"Бронь {b.get('id')} успешно подтверждена после оплаты")
+            if not paid:
                 log_info(f"Бронь {booking_id} уже была оплачена ранее")
             
             return "ok", 200
@@ -2611,23 +4413,102 @@ def yookassa_webhook():
         log_error(f"yookassa_webhook: {str(e)}", e)
         return "error", 500
 
+# ====== ЗАПУСК ===========================================================
+
+WEBHOOK_REGISTER_ATTEMPTS = 5
+
+_startup_phases = []
+
+@contextlib.contextmanager
+def startup_phase(name):
+    """Замер фазы запуска для log_startup_report()"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _startup_phases.append((name, time.perf_counter() - started))
+
+def log_startup_report():
+    """Сводка: сколько заняла каждая фаза запуска"""
+    total = time.perf_counter() - _BOOT_STARTED
+    phases = {name: round(seconds * 1000, 1) for name, seconds in _startup_phases}
+    parts = ", ".join(f"{name} {ms:.0f} мс" for name, ms in phases.items())
+    log_info(f"⏱ Запуск за {total * 1000:.0f} мс: {parts}", startup_ms=round(total * 1000, 1), phases=phases)
+
+def register_webhook(webhook_url):
+    """Установка webhook в фоне, пока Flask уже принимает запросы"""
+    started = time.perf_counter()
+    for attempt in range(1, WEBHOOK_REGISTER_ATTEMPTS + 1):
+        try:
+            webhook_info = bot.get_webhook_info()
+            if webhook_info.url == webhook_url:
+                # Telegram уже шлёт апдейты куда нужно — перерегистрация только теряет время
+                log_info(f"✅ Webhook уже установлен, пропускаю регистрацию (pending: {webhook_info.pending_update_count})")
+            else:
+                if not webhook_info.url:
+                    # Без webhook очередь доступна через getUpdates — разбираем её сразу
+                    drain_pending_updates()
+                log_info(f"Установка webhook (было: {webhook_info.url or 'не задан'})...")
+                # set_webhook заменяет старый адрес, отдельный remove_webhook не нужен.
+                # Очередь не сбрасываем: накопленные апдейты Telegram доставит на новый адрес
+                result = bot.set_webhook(url=webhook_url, drop_pending_updates=False)
+                log_info(f"Результат установки webhook: {result}")
+            if webhook_info.last_error_message:
+                log_error(f"   Last error: {webhook_info.last_error_message}")
+            log_info(f"⏱ Webhook готов за {(time.perf_counter() - started) * 1000:.0f} мс")
+            return True
+        except Exception as e:
+            log_error(f"Ошибка webhook (попытка {attempt}/{WEBHOOK_REGISTER_ATTEMPTS}): {str(e)}", e)
+            time.sleep(min(2 ** attempt, 30))
+    return False
+
 # ====== ТОЧКА ВХОДА ======================================================
 
 if __name__ == "__main__":
+    _startup_phases.append(("импорт", time.perf_counter() - _BOOT_STARTED))
     log_info("=" * 60)
     log_info("🎵 MACHATA studio бот запущен!")
     log_info("✨ С полной поддержкой фискализации через ЮKassa")
 
     # Инициализация базы данных PostgreSQL (если настроена)
     log_info("Инициализация базы данных...")
-    database.init_database()
+    with startup_phase("база данных"):
+        try:
+            database.init_database()
+        except database.DatabaseInitError as e:
+            # Не обслуживаем апдейты: оркестратор перезапустит процесс и миграция повторится
+            log_error(f"❌ База данных не готова: {e} — завершаю работу")
+            sys.exit(1)
     if database.is_enabled():
         log_info("✅ База данных PostgreSQL активна!")
     else:
         log_info("⚠️ База данных не настроена — используются JSON файлы")
 
     # Загружаем VIP пользователей при запуске
-    load_vip_users()
+    with startup_phase("VIP"):
+        load_vip_users()
+        load_vip_tiers()
+    
+    # Архивация прошедших броней держит рабочий набор маленьким
+    threading.Thread(target=maintenance_worker, daemon=True).start()
+
+    # Агрегаты статистики: первичное заполнение и фоновый пересчёт
+    with startup_phase("статистика"):
+        try:
+            ensure_stats()
+        except Exception as e:
+            log_error(f"Ошибка заполнения статистики: {str(e)}", e)
+    threading.Thread(target=stats_worker, daemon=True).start()
+    
+    # Повторно доставленные после рестарта апдейты не обрабатываются дважды
+    with startup_phase("update_id"):
+        load_processed_updates()
+    threading.Thread(target=processed_updates_worker, daemon=True).start()
+    atexit.register(save_processed_updates)
+    
+    # Ссылки на оплату, отложенные из-за сбоя ЮKassa
+    load_pending_payments()
+    threading.Thread(target=pending_payments_worker, daemon=True).start()
 
     log_info(f"☎️ Контакт: {STUDIO_CONTACT}")
     log_info(f"📍 Telegram: {STUDIO_TELEGRAM}")
@@ -2659,6 +4540,7 @@ if __name__ == "__main__":
     
     if IS_LOCAL:
         log_info("🚀 ЛОКАЛЬНЫЙ РЕЖИМ (polling)")
+        log_startup_report()
         try:
             bot.infinity_polling()
         except KeyboardInterrupt:
@@ -2681,28 +4563,18 @@ if __name__ == "__main__":
             log_info(f"Webhook URL: {webhook_url}")
             
             try:
-                # Удаляем старый webhook
-                log_info("Удаление старого webhook...")
-                bot.remove_webhook()
-                time.sleep(1)
-                
-                # Устанавливаем новый webhook
-                log_info("Установка нового webhook...")
-                result = bot.set_webhook(url=webhook_url, drop_pending_updates=True)
-                log_info(f"Результат установки webhook: {result}")
-                
-                # Проверяем статус webhook
-                time.sleep(2)
-                webhook_info = bot.get_webhook_info()
-                log_info(f"✅ Webhook установлен")
-                log_info(f"   URL: {webhook_info.url}")
-                log_info(f"   Pending updates: {webhook_info.pending_update_count}")
-                log_info(f"   Last error date: {webhook_info.last_error_date}")
-                if webhook_info.last_error_message:
-                    log_error(f"   Last error: {webhook_info.last_error_message}")
-                
-                log_info(f"🚀 Flask запущен на порту {PORT}")
-                app.run(host="0.0.0.0", port=PORT, debug=False)
+                # Регистрация webhook идёт параллельно со стартом Flask:
+                # апдейты начинают приниматься сразу после bind порта
+                threading.Thread(target=register_webhook, args=(webhook_url,), name="webhook-register", daemon=True).start()
+                log_startup_report()
+                if BOT_RUNTIME == "asyncio" and async_runtime.available():
+                    log_info(f"🚀 asyncio (aiohttp) запущен на порту {PORT}")
+                    async_runtime.run(sys.modules[__name__], "0.0.0.0", PORT)
+                else:
+                    if BOT_RUNTIME == "asyncio":
+                        log_error("⚠️ BOT_RUNTIME=asyncio, но aiohttp не установлен (pip install aiohttp) — запускаю Flask")
+                    log_info(f"🚀 Flask запущен на порту {PORT}")
+                    app.run(host="0.0.0.0", port=PORT, debug=False)
             except Exception as e:
                 log_error(f"Ошибка webhook: {str(e)}", e)
                 log_info("Переключаюсь на polling...")
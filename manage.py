@@ -0,0 +1,346 @@
+# -*- coding: utf-8 -*-
+"""Служебные команды MACHATA studio бота.
+
+Импорт и экспорт броней и VIP между JSON-файлами бота, CSV и PostgreSQL.
+Файлы читаются потоково (без загрузки целиком в память), в PostgreSQL
+данные пишутся пачками через COPY (по умолчанию) или execute_values.
+После загрузки результат сверяется, в конце печатается статистика.
+
+Примеры:
+    python manage.py import bookings machata_bookings.json
+    python manage.py import vip vip_users.json --method values
+    python manage.py export bookings bookings.csv
+    python manage.py convert bookings machata_bookings.json bookings.csv
+    python manage.py migrate
+
+Формат файла определяется по расширению: .json или .csv.
+"""
+import argparse
+import csv
+import json
+import os
+import time
+
+import database
+import structured_log
+
+ENTITIES = {
+    "bookings": "bookings",
+    "vip": "vip_users",
+}
+
+_INT_COLUMNS = {"id", "user_id", "duration", "price", "discount", "custom_price_repet"}
+
+_decoder = json.JSONDecoder()
+
+
+# ====== ПОТОКОВОЕ ЧТЕНИЕ JSON ============================================
+
+class _JsonStream:
+    """Буфер над файлом для raw_decode по одному значению за раз"""
+
+    def __init__(self, f, chunk_size=1 << 16):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buf = ""
+        self.pos = 0
+        self.eof = False
+
+    def _more(self):
+        if self.eof:
+            return False
+        chunk = self.f.read(self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """Следующий непробельный символ ('' в конце файла)"""
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buf):
+                return self.buf[self.pos]
+            if not self._more():
+                return ""
+
+    def take(self):
+        ch = self.peek()
+        self.pos += 1
+        return ch
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buf, self.pos)
+            except json.JSONDecodeError:
+                # Значение обрезано границей чанка — дочитываем
+                if not self._more():
+                    raise
+                continue
+            if end == len(self.buf) and self._more():
+                # Число на границе чанка могло быть прочитано не полностью
+                continue
+            self.pos = end
+            return value
+
+
+def iter_json(path):
+    """Элементы JSON-массива или пары (ключ, значение) JSON-объекта верхнего уровня"""
+    with open(path, "r", encoding="utf-8") as f:
+        stream = _JsonStream(f)
+        opening = stream.take()
+        if opening not in ("[", "{"):
+            raise ValueError(f"{path}: ожидался JSON-массив или объект")
+        closing = "]" if opening == "[" else "}"
+        if stream.peek() == closing:
+            return
+        while True:
+            if opening == "{":
+                key = stream.value()
+                if stream.take() != ":":
+                    raise ValueError(f"{path}: ожидалось ':' после ключа {key!r}")
+                yield key, stream.value()
+            else:
+                yield stream.value()
+            separator = stream.take()
+            if separator == closing:
+                return
+            if separator != ",":
+                raise ValueError(f"{path}: ожидалось ',' или '{closing}'")
+
+
+# ====== ЧТЕНИЕ И ЗАПИСЬ ФАЙЛОВ ===========================================
+
+def _file_format(path):
+    ext = os.path.splitext(path)[1].lower()
+    if ext not in (".json", ".csv"):
+        raise SystemExit(f"❌ Неизвестный формат файла: {path} (нужен .json или .csv)")
+    return ext[1:]
+
+
+def _parse_csv_value(column, value):
+    if value == "":
+        return None
+    if column == "times":
+        return json.loads(value)
+    if column in _INT_COLUMNS:
+        return int(value)
+    return value
+
+
+def read_records(entity, path):
+    """Потоковое чтение записей из JSON или CSV в виде словарей"""
+    table = ENTITIES[entity]
+    if _file_format(path) == "csv":
+        with open(path, "r", encoding="utf-8", newline="") as f:
+            for row in csv.DictReader(f):
+                yield {col: _parse_csv_value(col, value) for col, value in row.items()}
+        return
+
+    for item in iter_json(path):
+        if table == "vip_users" and isinstance(item, tuple):
+            # vip_users.json: {"<user_id>": {"name": ..., "discount": ...}}
+            key, data = item
+            yield {**data, "user_id": int(key)}
+        else:
+            yield item
+
+
+class RecordWriter:
+    """Потоковая запись в JSON (формат файлов бота) или CSV"""
+
+    def __init__(self, entity, path):
+        self.table = ENTITIES[entity]
+        self.columns = database.BOOKING_COLUMNS if self.table == "bookings" else database.VIP_COLUMNS
+        self.format = _file_format(path)
+        self.f = open(path, "w", encoding="utf-8", newline="")
+        self.count = 0
+        if self.format == "csv":
+            self.csv = csv.writer(self.f)
+            self.csv.writerow(self.columns)
+        else:
+            self.f.write("{\n" if self.table == "vip_users" else "[\n")
+
+    def write(self, record):
+        if self.format == "csv":
+            self.csv.writerow(
+                "" if record.get(col) is None
+                else json.dumps(record[col]) if col == "times"
+                else record[col]
+                for col in self.columns
+            )
+        else:
+            prefix = ",\n" if self.count else ""
+            if self.table == "vip_users":
+                data = {k: v for k, v in record.items() if k != "user_id"}
+                self.f.write(f"{prefix}  {json.dumps(str(record['user_id']))}: {json.dumps(data, ensure_ascii=False)}")
+            else:
+                self.f.write(prefix + "  " + json.dumps(record, ensure_ascii=False, default=str))
+        self.count += 1
+
+    def close(self):
+        if self.format == "json":
+            self.f.write("\n}\n" if self.table == "vip_users" else "\n]\n")
+        self.f.close()
+
+
+def batched(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# ====== КОМАНДЫ ==========================================================
+
+class Stats:
+    """Счётчики прогона и итоговая строка со скоростью"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.rows = 0
+        self.batches = 0
+
+    def counted(self, batches):
+        for batch in batches:
+            self.rows += len(batch)
+            self.batches += 1
+            yield batch
+
+    def report(self, action, path=None):
+        elapsed = time.perf_counter() - self.started
+        rate = self.rows / elapsed if elapsed else 0.0
+        line = f"✅ {action}: {self.rows} строк за {elapsed:.2f} с ({rate:.0f} строк/с, пачек: {self.batches})"
+        if path and os.path.exists(path):
+            size_mb = os.path.getsize(path) / 1024 / 1024
+            line += f", файл {size_mb:.1f} МБ ({size_mb / elapsed if elapsed else 0:.1f} МБ/с)"
+        print(line)
+
+
+def _require_database():
+    try:
+        database.init_database()
+    except database.DatabaseInitError as e:
+        raise SystemExit(f"❌ {e}")
+    if not database.is_enabled():
+        raise SystemExit("❌ PostgreSQL недоступен — проверь DATABASE_URL")
+
+
+def cmd_import(args):
+    _require_database()
+    table = ENTITIES[args.entity]
+    stats = Stats()
+    batches = stats.counted(batched(read_records(args.entity, args.path), args.batch_size))
+    if args.method == "copy":
+        copy = database.copy_bookings if table == "bookings" else database.copy_vip_users
+        _, written, mismatched = copy(batches)
+    else:
+        upsert = database.upsert_bookings if table == "bookings" else database.upsert_vip_users
+        written = sum(upsert(batch, page_size=args.batch_size) for batch in batches)
+        mismatched = None
+    stats.report(f"импорт {args.path} → {table}", args.path)
+    print(f"   Записано строк: {written}, всего в {table}: {database.count_rows(table)}")
+
+    if mismatched is None:
+        return
+    if mismatched:
+        raise SystemExit(f"❌ Проверка: {mismatched} строк в {table} не совпадают с файлом")
+    print("   Проверка: все строки файла совпадают с таблицей")
+
+
+def cmd_export(args):
+    _require_database()
+    table = ENTITIES[args.entity]
+    stats = Stats()
+    writer = RecordWriter(args.entity, args.path)
+    try:
+        order_by = "date, id" if table == "bookings" else "user_id"
+        for batch in stats.counted(batched(database.iter_rows(table, args.batch_size, order_by), args.batch_size)):
+            for record in batch:
+                writer.write(record)
+    finally:
+        writer.close()
+    stats.report(f"экспорт {table} → {args.path}", args.path)
+    _verify_file(args.entity, args.path, stats.rows)
+
+
+def cmd_convert(args):
+    stats = Stats()
+    writer = RecordWriter(args.entity, args.dest)
+    try:
+        for batch in stats.counted(batched(read_records(args.entity, args.path), args.batch_size)):
+            for record in batch:
+                writer.write(record)
+    finally:
+        writer.close()
+    stats.report(f"конвертация {args.path} → {args.dest}", args.path)
+    _verify_file(args.entity, args.dest, stats.rows)
+
+
+def cmd_migrate(args):
+    """Применение миграций схемы и список применённых с длительностью"""
+    _require_database()
+    migrations = database.get_migrations()
+    if not migrations:
+        raise SystemExit("❌ Миграции не применены — смотри лог инициализации БД")
+    print(f"{'версия':>6}  {'миграция':<30}{'применена':<28}{'мс':>8}")
+    for m in migrations:
+        print(f"{m['version']:>6}  {m['name']:<30}{m['applied_at']:<28}{m['duration_ms'] or 0:>8}")
+    latest = max(version for version, *_ in database.MIGRATIONS)
+    if migrations[-1]["version"] != latest:
+        raise SystemExit(f"❌ Схема не на последней версии ({latest}) — смотри лог инициализации БД")
+
+
+def _verify_file(entity, path, expected):
+    """Повторное потоковое чтение записанного файла и сверка числа строк"""
+    actual = sum(1 for _ in read_records(entity, path))
+    if actual != expected:
+        raise SystemExit(f"❌ Проверка: в {path} {actual} строк, ожидалось {expected}")
+    print(f"   Проверка: {path} читается, строк {actual}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_import = sub.add_parser("import", help="загрузка JSON/CSV в PostgreSQL")
+    p_import.add_argument("entity", choices=ENTITIES)
+    p_import.add_argument("path")
+    p_import.add_argument("--method", choices=("copy", "values"), default="copy",
+                          help="COPY через временную таблицу или execute_values")
+    p_import.set_defaults(func=cmd_import)
+
+    p_export = sub.add_parser("export", help="выгрузка из PostgreSQL в JSON/CSV")
+    p_export.add_argument("entity", choices=ENTITIES)
+    p_export.add_argument("path")
+    p_export.set_defaults(func=cmd_export)
+
+    p_convert = sub.add_parser("convert", help="конвертация между JSON и CSV без БД")
+    p_convert.add_argument("entity", choices=ENTITIES)
+    p_convert.add_argument("path")
+    p_convert.add_argument("dest")
+    p_convert.set_defaults(func=cmd_convert)
+
+    p_migrate = sub.add_parser("migrate", help="миграции схемы PostgreSQL и их длительность")
+    p_migrate.set_defaults(func=cmd_migrate)
+
+    for p in (p_import, p_export, p_convert):
+        p.add_argument("--batch-size", type=int, default=5000, help="строк в пачке")
+
+    args = parser.parse_args()
+    # Служебные логи database.py не смешиваем с отчётом команды
+    structured_log.set_level(os.environ.get("LOG_LEVEL", "WARNING"))
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
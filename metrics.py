@@ -0,0 +1,263 @@
+# -*- coding: utf-8 -*-
+"""Метрики в текстовом формате Prometheus (exposition format 0.0.4).
+
+Запись в горячем пути идёт без блокировок: каждый поток пишет в свой
+шард, а при чтении (/metrics) шарды сливаются. Блокировка берётся только
+при регистрации метрики и при первом обращении нового потока.
+"""
+import bisect
+import functools
+import threading
+import time
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Сколько шардов держим, прежде чем сливать шарды завершившихся потоков
+_MAX_LIVE_SHARDS = 64
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    """Общая часть метрик с потоколокальными шардами"""
+    kind = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._local = threading.local()
+        self._shards = []  # [(thread, dict)]
+        self._retired = {}
+        self._lock = threading.Lock()
+
+    def _shard(self):
+        shard = getattr(self._local, "shard", None)
+        if shard is None:
+            shard = {}
+            self._local.shard = shard
+            with self._lock:
+                if len(self._shards) >= _MAX_LIVE_SHARDS:
+                    self._retire_dead_shards()
+                self._shards.append((threading.current_thread(), shard))
+        return shard
+
+    def _retire_dead_shards(self):
+        # Вызывается под self._lock. Мёртвый поток больше не пишет в шард,
+        # поэтому его можно безопасно слить в общий агрегат.
+        alive = []
+        for thread, shard in self._shards:
+            if thread.is_alive():
+                alive.append((thread, shard))
+            else:
+                self._merge_into(self._retired, shard)
+        self._shards = alive
+
+    def _merge_into(self, target, shard):
+        raise NotImplementedError
+
+    def _collect(self):
+        with self._lock:
+            self._retire_dead_shards()
+            merged = self._empty_copy(self._retired)
+            shards = [shard.copy() for _, shard in self._shards]
+        for shard in shards:
+            self._merge_into(merged, shard)
+        return merged
+
+    def _empty_copy(self, data):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        lines.extend(self._render_samples(self._collect()))
+        return lines
+
+
+class Counter(_Metric):
+    """Монотонный счётчик"""
+    kind = "counter"
+
+    def inc(self, *labelvalues, amount=1):
+        shard = self._shard()
+        shard[labelvalues] = shard.get(labelvalues, 0) + amount
+
+    def _merge_into(self, target, shard):
+        for key, value in shard.items():
+            target[key] = target.get(key, 0) + value
+
+    def _empty_copy(self, data):
+        return dict(data)
+
+    def _render_samples(self, data):
+        for key in sorted(data):
+            yield f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(data[key])}"
+
+
+class Histogram(_Metric):
+    """Гистограмма с фиксированными бакетами"""
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, *labelvalues):
+        shard = self._shard()
+        cell = shard.get(labelvalues)
+        if cell is None:
+            # [счётчики по бакетам..., +Inf, сумма]
+            cell = [0] * (len(self.buckets) + 1) + [0.0]
+            shard[labelvalues] = cell
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def time(self, *labelvalues):
+        return _Timer(self, labelvalues)
+
+    def _merge_into(self, target, shard):
+        for key, cell in shard.items():
+            acc = target.get(key)
+            if acc is None:
+                target[key] = list(cell)
+            else:
+                for i, value in enumerate(cell):
+                    acc[i] += value
+
+    def _empty_copy(self, data):
+        return {key: list(cell) for key, cell in data.items()}
+
+    def _render_samples(self, data):
+        bounds = self.buckets + (float("inf"),)
+        for key in sorted(data):
+            cell = data[key]
+            cumulative = 0
+            for bound, count in zip(bounds, cell):
+                cumulative += count
+                le = 'le="' + _format_value(float(bound)) + '"'
+                yield f"{self.name}_bucket{_format_labels(self.labelnames, key, le)} {cumulative}"
+            labels = _format_labels(self.labelnames, key)
+            yield f"{self.name}_sum{labels} {_format_value(cell[-1])}"
+            yield f"{self.name}_count{labels} {cumulative}"
+
+
+class Gauge:
+    """Gauge, значение которого вычисляется в момент сбора метрик"""
+    kind = "gauge"
+
+    def __init__(self, name, documentation, callback, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        try:
+            value = self.callback()
+        except Exception:
+            return lines
+        if isinstance(value, dict):
+            for key in sorted(value):
+                labelvalues = key if isinstance(key, tuple) else (key,)
+                lines.append(f"{self.name}{_format_labels(self.labelnames, labelvalues)} {_format_value(value[key])}")
+        elif value is not None:
+            lines.append(f"{self.name} {_format_value(value)}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ("histogram", "labelvalues", "started")
+
+    def __init__(self, histogram, labelvalues):
+        self.histogram = histogram
+        self.labelvalues = labelvalues
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.histogram.observe(time.perf_counter() - self.started, *self.labelvalues)
+        return False
+
+
+def _register(metric):
+    with _registry_lock:
+        existing = _registry.get(metric.name)
+        if existing is not None:
+            return existing
+        _registry[metric.name] = metric
+        return metric
+
+
+def counter(name, documentation, labelnames=()):
+    """Регистрация (или получение уже зарегистрированного) счётчика"""
+    return _register(Counter(name, documentation, labelnames))
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    """Регистрация (или получение уже зарегистрированной) гистограммы"""
+    return _register(Histogram(name, documentation, labelnames, buckets))
+
+
+def gauge(name, documentation, callback, labelnames=()):
+    """Регистрация gauge с функцией, вычисляющей значение при сборе"""
+    return _register(Gauge(name, documentation, callback, labelnames))
+
+
+def timed(hist, *labelvalues, errors=None):
+    """Декоратор: время вызова в гистограмму, исключения — в счётчик ошибок"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            except Exception:
+                if errors is not None:
+                    errors.inc(*labelvalues)
+                raise
+            finally:
+                hist.observe(time.perf_counter() - started, *labelvalues)
+        return wrapper
+    return decorator
+
+
+def render():
+    """Текст для эндпоинта /metrics"""
+    with _registry_lock:
+        metrics = list(_registry.values())
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""Выгрузка отчётов по броням в CSV и XLSX.
+
+Строки пишутся в файл по одной, по мере чтения из источника: расход
+памяти не зависит от числа броней. XLSX собирается вручную (zipfile +
+потоковая запись листа), без сторонних библиотек.
+"""
+import csv
+import zipfile
+from xml.sax.saxutils import escape
+
+SERVICE_NAMES = {
+    'repet': 'Репетиция',
+    'studio': 'Студия (самостоятельная)',
+    'full': 'Студия со звукорежем',
+}
+
+STATUS_NAMES = {
+    'pending': 'Ожидает оплаты',
+    'awaiting_payment': 'Ожидает оплаты',
+    'paid': 'Оплачено',
+    'cancelled': 'Отменено',
+}
+
+# (заголовок, функция значения); числа остаются числами — в XLSX по ним можно считать
+COLUMNS = (
+    ("ID", lambda b: b.get('id')),
+    ("Дата", lambda b: b.get('date', '')),
+    ("Время", lambda b: _time_range(b.get('times') or [])),
+    ("Часов", lambda b: len(b.get('times') or [])),
+    ("Услуга", lambda b: SERVICE_NAMES.get(b.get('service', ''), b.get('service', ''))),
+    ("Сумма, ₽", lambda b: b.get('price') or 0),
+    ("Статус", lambda b: STATUS_NAMES.get(b.get('status', ''), b.get('status', ''))),
+    ("Имя", lambda b: b.get('name') or ''),
+    ("Телефон", lambda b: b.get('phone') or ''),
+    ("Email", lambda b: b.get('email') or ''),
+    ("Комментарий", lambda b: b.get('comment') or ''),
+    ("Telegram ID", lambda b: b.get('user_id')),
+    ("Создана", lambda b: b.get('created_at') or ''),
+    ("Оплачена", lambda b: b.get('paid_at') or ''),
+    ("ID платежа", lambda b: b.get('yookassa_payment_id') or ''),
+)
+
+
+def _time_range(times):
+    if not times:
+        return ''
+    return f"{min(times):02d}:00–{max(times) + 1:02d}:00"
+
+
+def _row(booking):
+    return [value(booking) for _, value in COLUMNS]
+
+
+def write_csv(bookings, path):
+    """CSV (UTF-8 с BOM, разделитель «;» — открывается в Excel); возвращает число строк"""
+    count = 0
+    with open(path, 'w', encoding='utf-8-sig', newline='') as f:
+        writer = csv.writer(f, delimiter=';')
+        writer.writerow(title for title, _ in COLUMNS)
+        for booking in bookings:
+            writer.writerow(_row(booking))
+            count += 1
+    return count
+
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+</Types>"""
+
+_ROOT_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name="{name}" sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+</Relationships>"""
+
+_SHEET_HEAD = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>"""
+
+_SHEET_TAIL = "</sheetData></worksheet>"
+
+
+def _xlsx_row(values):
+    cells = []
+    for value in values:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f"<c><v>{value}</v></c>")
+        elif value is None or value == '':
+            cells.append("<c/>")
+        else:
+            # Инлайновые строки: не нужна таблица sharedStrings, которую пришлось бы держать в памяти
+            cells.append(f'<c t="inlineStr"><is><t xml:space="preserve">{escape(str(value))}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+
+def write_xlsx(bookings, path, sheet_name="Брони"):
+    """XLSX с одним листом; лист пишется в архив потоком. Возвращает число строк."""
+    count = 0
+    with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as zf:
+        zf.writestr("[Content_Types].xml", _CONTENT_TYPES)
+        zf.writestr("_rels/.rels", _ROOT_RELS)
+        zf.writestr("xl/workbook.xml", _WORKBOOK.format(name=escape(sheet_name)))
+        zf.writestr("xl/_rels/workbook.xml.rels", _WORKBOOK_RELS)
+        with zf.open("xl/worksheets/sheet1.xml", 'w', force_zip64=True) as sheet:
+            sheet.write(_SHEET_HEAD.encode('utf-8'))
+            sheet.write(_xlsx_row([title for title, _ in COLUMNS]).encode('utf-8'))
+            for booking in bookings:
+                sheet.write(_xlsx_row(_row(booking)).encode('utf-8'))
+                count += 1
+            sheet.write(_SHEET_TAIL.encode('utf-8'))
+    return count
+
+
+WRITERS = {
+    'csv': write_csv,
+    'xlsx': write_xlsx,
+}
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Неблокирующее структурированное логирование.
+
+Вызывающий поток только проверяет уровень и кладёт запись в очередь.
+Форматирование в JSON, запись в stdout/stderr и flush выполняет фоновый
+поток пачками, поэтому потоки обработчиков не ждут друг друга на flush.
+
+Уровень задаётся переменной окружения LOG_LEVEL (DEBUG/INFO/WARNING/ERROR).
+"""
+import atexit
+import json
+import os
+import queue
+import sys
+import threading
+import time
+import traceback
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+_LEVEL_NAMES = {DEBUG: "debug", INFO: "info", WARNING: "warning", ERROR: "error"}
+_LEVELS_BY_NAME = {"DEBUG": DEBUG, "INFO": INFO, "WARNING": WARNING, "ERROR": ERROR}
+
+# Максимум записей, которые пишутся между двумя flush
+BATCH_SIZE = 256
+
+_level = _LEVELS_BY_NAME.get(os.environ.get("LOG_LEVEL", "INFO").strip().upper(), INFO)
+_queue = queue.SimpleQueue()
+_writer = None
+_writer_lock = threading.Lock()
+_sample_counters = {}
+
+
+def set_level(level):
+    """Смена минимального уровня логирования"""
+    global _level
+    if isinstance(level, str):
+        level = _LEVELS_BY_NAME.get(level.strip().upper(), INFO)
+    _level = level
+
+
+def is_enabled_for(level):
+    return level >= _level
+
+
+def queue_size():
+    return _queue.qsize()
+
+
+def log(level, msg, *args, source="bot", exc=False, **fields):
+    """Постановка записи в очередь. msg % args вычисляется уже в фоновом потоке."""
+    if level < _level:
+        return
+    # Трассировку можно снять только в потоке, где поймано исключение
+    exc_text = traceback.format_exc() if exc else None
+    _queue.put((time.time(), level, source, threading.current_thread().name, msg, args, exc_text, fields))
+    if _writer is None:
+        _start_writer()
+
+
+def debug(msg, *args, sample_every=1, sample_key=None, **fields):
+    """Отладочная запись; sample_every=N пропускает в лог только каждую N-ю"""
+    if DEBUG < _level:
+        return
+    if sample_every > 1:
+        key = sample_key or msg
+        # Счётчик без блокировки: для сэмплинга гонки допустимы
+        seen = _sample_counters.get(key, 0)
+        _sample_counters[key] = seen + 1
+        if seen % sample_every:
+            return
+        fields["sampled"] = sample_every
+    log(DEBUG, msg, *args, **fields)
+
+
+def info(msg, *args, **fields):
+    log(INFO, msg, *args, **fields)
+
+
+def warning(msg, *args, **fields):
+    log(WARNING, msg, *args, **fields)
+
+
+def error(msg, *args, **fields):
+    log(ERROR, msg, *args, **fields)
+
+
+def _format(record):
+    ts, level, source, thread, msg, args, exc_text, fields = record
+    if args:
+        try:
+            msg = msg % args
+        except (TypeError, ValueError):
+            msg = f"{msg} {args!r}"
+    entry = {
+        "ts": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(ts)) + f".{int(ts % 1 * 1000):03d}",
+        "level": _LEVEL_NAMES.get(level, str(level)),
+        "source": source,
+        "thread": thread,
+        "msg": str(msg),
+    }
+    if exc_text:
+        entry["exc"] = exc_text
+    if fields:
+        entry.update(fields)
+    return json.dumps(entry, ensure_ascii=False, default=str) + "\n"
+
+
+def _write_batch(batch):
+    out, err = [], []
+    for record in batch:
+        line = _format(record)
+        (err if record[1] >= ERROR else out).append(line)
+    if out:
+        sys.stdout.write("".join(out))
+        sys.stdout.flush()
+    if err:
+        sys.stderr.write("".join(err))
+        sys.stderr.flush()
+
+
+def _writer_loop():
+    while True:
+        item = _queue.get()
+        batch = []
+        waiters = []
+        while True:
+            if isinstance(item, threading.Event):
+                waiters.append(item)
+            else:
+                batch.append(item)
+            if len(batch) >= BATCH_SIZE:
+                break
+            try:
+                item = _queue.get_nowait()
+            except queue.Empty:
+                break
+        try:
+            if batch:
+                _write_batch(batch)
+        except Exception:
+            # Логгер не должен ронять процесс; пишем как есть
+            traceback.print_exc()
+        for event in waiters:
+            event.set()
+
+
+def _start_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            thread = threading.Thread(target=_writer_loop, name="log-writer", daemon=True)
+            thread.start()
+            _writer = thread
+
+
+def flush(timeout=2.0):
+    """Дождаться записи всего, что уже стоит в очереди"""
+    if _writer is None:
+        return
+    event = threading.Event()
+    _queue.put(event)
+    event.wait(timeout)
+
+
+atexit.register(flush)
@@ -0,0 +1,96 @@
+# -*- coding: utf-8 -*-
+"""Время броней проходит через PostgreSQL без сдвига зоны.
+
+Нужна пустая тестовая база: TEST_DATABASE_URL=postgresql://... python -m unittest
+Сервер читает время в зоне UTC (PGTZ), бот живёт в Europe/Moscow — при
+хранении с зоной время вернулось бы сдвинутым на три часа.
+"""
+import os
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TEST_DATABASE_URL = os.environ.get("TEST_DATABASE_URL", "")
+
+
+def _booking(booking_id, **fields):
+    booking = {
+        "id": booking_id, "user_id": 7, "service": "repet", "date": "2020-01-10", "times": [10, 11],
+        "duration": 2, "name": "Band", "email": "a@b.ru", "phone": "+79990000000", "comment": "-",
+        "price": 1400, "status": "paid", "created_at": "2026-10-19T10:00:00",
+        "paid_at": "2026-10-19T10:05:00.123456", "yookassa_payment_id": None, "payment_url": None,
+    }
+    booking.update(fields)
+    return booking
+
+
+@unittest.skipUnless(TEST_DATABASE_URL, "TEST_DATABASE_URL не задан")
+class TimestampRoundTripTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls._env = {key: os.environ.get(key) for key in ("DATABASE_URL", "PGTZ", "TZ")}
+        os.environ["DATABASE_URL"] = TEST_DATABASE_URL
+        os.environ["PGTZ"] = "UTC"
+        os.environ["TZ"] = "Europe/Moscow"
+        time.tzset()
+        import database
+        cls.db = database
+        database._is_enabled_cache = None
+        database.init_database()
+
+    @classmethod
+    def tearDownClass(cls):
+        for key, value in cls._env.items():
+            if value is None:
+                os.environ.pop(key, None)
+            else:
+                os.environ[key] = value
+        time.tzset()
+
+    def _sql(self, *statements):
+        conn = self.db._get_connection()
+        try:
+            conn.autocommit = True
+            cur = conn.cursor()
+            for statement in statements:
+                cur.execute(statement)
+            cur.close()
+        finally:
+            conn.close()
+
+    def test_booking_round_trip(self):
+        self.db.add_booking(_booking(9001))
+        stored = self.db.get_booking_by_id(9001)
+        self.assertEqual(stored["created_at"], "2026-10-19T10:00:00")
+        self.assertEqual(stored["paid_at"], "2026-10-19T10:05:00.123456")
+
+    def test_archive_round_trip(self):
+        self.db.add_booking(_booking(9002, date="2020-01-11"))
+        self.db.archive_bookings("2020-01-12", "2020-01-01")
+        archived = {b["id"]: b for b in self.db.get_archived_bookings("2020-01-11", "2020-01-11")}
+        self.assertEqual(archived[9002]["created_at"], "2026-10-19T10:00:00")
+        self.assertEqual(archived[9002]["paid_at"], "2026-10-19T10:05:00.123456")
+
+    def test_timestamptz_columns_are_converted_back(self):
+        # База, где typed_booking_columns успела сделать колонки TIMESTAMPTZ
+        self.db.add_booking(_booking(9003))
+        self._sql(
+            "ALTER TABLE bookings ALTER COLUMN created_at TYPE TIMESTAMPTZ, "
+            "ALTER COLUMN paid_at TYPE TIMESTAMPTZ",
+            "DELETE FROM schema_migrations WHERE version = 4",
+        )
+        conn = self.db._get_connection()
+        try:
+            self.db.migrate(conn)
+        finally:
+            conn.close()
+        stored = self.db.get_booking_by_id(9003)
+        self.assertEqual(stored["created_at"], "2026-10-19T10:00:00")
+        self.assertEqual(stored["paid_at"], "2026-10-19T10:05:00.123456")
+
+
+if __name__ == "__main__":
+    unittest.main()
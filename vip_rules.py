@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+"""Уровни VIP, правила цен и разбор CSV для массового импорта.
+
+Уровень (tier) — именованный набор: скидка в процентах и индивидуальные
+цены за час по услугам. Собственные скидка и цена на репетицию у VIP
+важнее уровня. Правила всех VIP заранее компилируются в словарь
+user_id → VipRule, и расчёт цены читает его за O(1).
+"""
+import csv
+import io
+from collections import namedtuple
+
+SERVICES = ('repet', 'studio', 'full')
+
+VIP_CSV_COLUMNS = ('user_id', 'name', 'tier', 'discount', 'custom_price_repet')
+TIER_CSV_COLUMNS = ('tier', 'discount') + tuple(f'price_{s}' for s in SERVICES)
+
+# Предел строк одного импорта: файл целиком разбирается в памяти
+MAX_IMPORT_ROWS = 10000
+
+VipRule = namedtuple('VipRule', 'discount prices tier')
+
+
+def compile_rules(vip_users, tiers):
+    """Таблица user_id → VipRule(скидка %, {услуга: цена за час}, уровень)"""
+    rules = {}
+    for user_id, vip in vip_users.items():
+        tier = tiers.get(vip.get('tier') or '') or {}
+        prices = dict(tier.get('prices') or {})
+        if vip.get('custom_price_repet') is not None:
+            prices['repet'] = vip['custom_price_repet']
+        discount = vip.get('discount') or tier.get('discount') or 0
+        rules[user_id] = VipRule(discount, prices, vip.get('tier'))
+    return rules
+
+
+def _int(value, row, column, errors, low=None, high=None):
+    """Целое из ячейки CSV; пустая ячейка — None, ошибка дописывается в errors"""
+    value = (value or '').strip()
+    if not value:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        errors.append(f"строка {row}: {column} — не число ({value[:20]})")
+        return None
+    if (low is not None and number < low) or (high is not None and number > high):
+        errors.append(f"строка {row}: {column} вне диапазона ({number})")
+        return None
+    return number
+
+
+def parse_csv(text, tiers):
+    """Разбор CSV с VIP или с уровнями.
+
+    Вид определяется по заголовку: есть user_id — VIP, иначе tier — уровни.
+    Возвращает (вид 'vip' | 'tiers', записи, ошибки); при ошибках импорт
+    не выполняется целиком. tiers — уже известные уровни для проверки ссылок.
+    """
+    sample = text[:4096]
+    try:
+        dialect = csv.Sniffer().sniff(sample.splitlines()[0] if sample else '', delimiters=',;\t')
+    except csv.Error:
+        dialect = csv.excel
+    reader = csv.DictReader(io.StringIO(text), dialect=dialect)
+    header = {(h or '').strip().lower() for h in reader.fieldnames or ()}
+    if 'user_id' in header:
+        kind = 'vip'
+    elif 'tier' in header:
+        kind = 'tiers'
+    else:
+        return None, [], [f"нет колонки user_id или tier; ожидаются {', '.join(VIP_CSV_COLUMNS)} "
+                          f"или {', '.join(TIER_CSV_COLUMNS)}"]
+
+    records, errors = [], []
+    for row_number, raw in enumerate(reader, start=2):
+        if row_number - 1 > MAX_IMPORT_ROWS:
+            errors.append(f"больше {MAX_IMPORT_ROWS} строк — раздели файл")
+            break
+        row = {(k or '').strip().lower(): (v or '').strip() for k, v in raw.items() if k}
+        if not any(row.values()):
+            continue
+        if kind == 'vip':
+            user_id = _int(row.get('user_id'), row_number, 'user_id', errors, low=1)
+            if user_id is None:
+                if not row.get('user_id'):
+                    errors.append(f"строка {row_number}: пустой user_id")
+                continue
+            tier = row.get('tier') or None
+            if tier and tier not in tiers:
+                errors.append(f"строка {row_number}: неизвестный уровень {tier[:30]}")
+            records.append({
+                'user_id': user_id,
+                'name': row.get('name') or 'Unknown',
+                'tier': tier,
+                'discount': _int(row.get('discount'), row_number, 'discount', errors, low=0, high=100),
+                'custom_price_repet': _int(row.get('custom_price_repet'), row_number, 'custom_price_repet', errors, low=1),
+            })
+        else:
+            name = row.get('tier')
+            if not name:
+                errors.append(f"строка {row_number}: пустое имя уровня")
+                continue
+            prices = {}
+            for service in SERVICES:
+                price = _int(row.get(f'price_{service}'), row_number, f'price_{service}', errors, low=1)
+                if price is not None:
+                    prices[service] = price
+            records.append({
+                'name': name[:64],
+                'discount': _int(row.get('discount'), row_number, 'discount', errors, low=0, high=100) or 0,
+                'prices': prices,
+            })
+    if not records and not errors:
+        errors.append("в файле нет строк с данными")
+    return kind, records, errors